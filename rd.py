@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import os
+import sys
+import json
+import getopt
+import signal
+import socket
+import importlib
+import threading
+import traceback
+
+# Single entry point of the scripts: rd.py COMMAND ARGS runs the main function
+# of the script of COMMAND with ARGS. Only that script is imported, and the
+# scripts import pandas, pytablewriter and matplotlib only where they use
+# them, so that usage messages and small runs start quickly.
+commands = {
+    "collect": ("rd_collect", "Generate compressed images and their metrics"),
+    "distributed": ("rd_distributed", "Run rd_collect.py on several hosts"),
+    "average": ("rd_average", "Average the results of a subset"),
+    "plot": ("rd_plot", "Plot the averages of a subset"),
+    "select": ("rd_select", "Select images at five quality levels"),
+    "manifest": ("generate_files_json", "Write comparisonfiles.json"),
+    "store": ("rd_store", "Import results files into the results database"),
+    "cache": ("rd_cache", "Manage the metric cache"),
+    "trace": ("rd_trace", "Summarize a trace of rd_collect.py"),
+    "probe": ("rd_probe", "Print the dimensions of images"),
+    "metrics": ("rd_metrics", "Compare the in-process metrics with the tools"),
+    "bench": ("rd_bench", "Benchmark the scripts"),
+}
+
+# Libraries imported by the daemon before serving, besides the scripts
+preloaded = ["numpy", "pandas", "six", "pytablewriter"]
+
+
+# Runs a command in this process, returning its exit status
+def run_command(command, args):
+    module = importlib.import_module(commands[command][0])
+    try:
+        module.main([module.__name__ + ".py"] + args)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+# Runs a command sent by rd.py --daemon in a process forked by the daemon,
+# with the working directory, the environment and the standard streams of
+# rd.py, and sends back its exit status. Never returns.
+def serve_request(conn):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.setpgid(0, 0)
+    data, fds, flags, address = socket.recv_fds(conn, 1 << 16, 3)
+    while not data.endswith(b"\n"):
+        data += conn.recv(1 << 16)
+    request = json.loads(data.decode("utf-8"))
+    for fd, stream in zip(fds, (0, 1, 2)):
+        os.dup2(fd, stream)
+        os.close(fd)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+    # rd.py closes the connection when interrupted: stop the command, its
+    # processes and the tools they run
+    def watch():
+        if not conn.recv(1):
+            os.killpg(0, signal.SIGTERM)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        status = run_command(request["command"], request["args"])
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(json.dumps({"status": status}).encode("utf-8") + b"\n")
+    os._exit(0)
+
+
+# Keeps the scripts and their libraries loaded, and runs every command sent
+# to socket_path in a forked process, so that the state a run leaves in the
+# modules never reaches the next one.
+def serve(socket_path):
+    for module, description in commands.values():
+        importlib.import_module(module)
+    for module in preloaded:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    try:
+        sys.modules["rd_plot"].import_pyplot()
+    except (ImportError, ValueError):
+        pass
+    # Parsed again by the commands only if it changed
+    if os.path.isfile("recipes.json"):
+        sys.modules["rd_collect"].read_recipes()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # Removes the socket when stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("rd.py: serving on {}".format(socket_path))
+    sys.stdout.flush()
+    try:
+        while True:
+            conn, address = server.accept()
+            if os.fork() == 0:
+                server.close()
+                serve_request(conn)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+# Runs a command on the daemon listening on socket_path, returning its exit
+# status, or None if there is no daemon.
+def run_on_daemon(socket_path, command, args):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+
+    request = json.dumps({
+        "command": command,
+        "args": args,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ)
+    }) + "\n"
+    socket.send_fds(client, [request.encode("utf-8")], [0, 1, 2])
+    response = b""
+    while True:
+        data = client.recv(1 << 16)
+        if not data:
+            break
+        response += data
+    client.close()
+    if not response:
+        print("rd.py: the daemon stopped before the end of the command",
+              file=sys.stderr)
+        return 1
+    return json.loads(response.decode("utf-8"))["status"]
+
+
+def usage():
+    print("rd.py: Run a command of the image comparison scripts")
+    print("Usage: rd.py [--daemon SOCKET] COMMAND [ARGS]")
+    print("       rd.py daemon SOCKET")
+    print("Commands:")
+    for command, (module, description) in commands.items():
+        print("  {:<12} {} ({}.py)".format(command, description, module))
+    print("  {:<12} {}".format(
+        "daemon", "Keep the scripts loaded and run the commands sent to SOCKET"))
+    print("Option --daemon SOCKET: run the command on the daemon listening on SOCKET, or in this process if there is none")
+    print("Run rd.py COMMAND without arguments for the arguments of COMMAND")
+
+
+def main(argv):
+    # The daemon passes the standard streams with socket.send_fds
+    if sys.version_info[:2] < (3, 9):
+        raise Exception("Python 3.9 or a more recent version is required.")
+
+    socket_path = None
+    try:
+        # Options after the command are the command's own
+        opts, args = getopt.getopt(argv[1:], "h", ["daemon=", "help"])
+        for opt, value in opts:
+            if opt == "--daemon":
+                socket_path = value
+            else:
+                args = []
+    except getopt.GetoptError:
+        args = []
+
+    if args and args[0] == "daemon" and len(args) == 2:
+        serve(args[1])
+        return 0
+    if not args or args[0] not in commands:
+        usage()
+        return 2
+
+    if socket_path is not None:
+        status = run_on_daemon(socket_path, args[0], args[1:])
+        if status is not None:
+            return status
+    return run_command(args[0], args[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -31,59 +31,221 @@
 import os
 import sys
 import glob
-import numpy as np
-import pandas as pd
-import six
-import pytablewriter
+import getopt
+import rd_store
 from multiprocessing import Pool
 
+# Memory in MB for the results files read at once, shared by the processes,
+# when the sums are computed from the per-image results files
+max_memory = 1024
+
+# Number of processes averaging the lossy results, by default the number of
+# CPUs
+jobs = os.cpu_count()
+
+# The lossy rows of the images are averaged by their rank in the image, so
+# every image must have the same number of rows and, unless they are the
+# results of rd_collect.py --target-bpp, the same qualities
+target_bpp = False
+
+# Columns summed as they are, the other ones being weighted by pixels. Sizes
+# are read and summed as 64-bit integers, as the sums of a subset go over
+# 2 GB. The other columns, as quality, times and scores, are read and summed
+# as float64, so that reading them does not change the averages.
+summed_columns = [("orig_file_size", "int64"),
+                  ("compressed_file_size", "int64"), ("pixels", "int64")]
+
+
+# Returns the number of rows of results files to read at once, so that they
+# and the temporary columns of their sums fit in max_memory
+def get_chunk_rows(columns):
+    import numpy as np
+
+    row_bytes = sum(np.dtype(type).itemsize for name, type in columns) * 4
+    return max(1, max_memory * 2**20 // (jobs * row_bytes))
+
+
+# Adds the sums of the rows of data to sums, which is None at first. extra
+# are the float columns summed as they are.
+def add_sums(sums, data, extra, weighted):
+    import pandas as pd
+
+    groups = data.groupby("row_index")
+    part = pd.DataFrame({"images": groups.size()})
+    for name, type in summed_columns:
+        part[name] = groups[name].sum()
+    for column in extra:
+        part[column] = groups[column].sum()
+        part[column + "_sq"] = (data[column]**2).groupby(
+            data["row_index"]).sum()
+    for column in weighted:
+        if column in data:
+            part["w_" + column] = (data[column] *
+                                   data["pixels"].astype("float64")).groupby(
+                                       data["row_index"]).sum()
+            part["n_" + column] = groups[column].count()
+        else:
+            part["w_" + column] = 0.0
+            part["n_" + column] = 0
+    if sums is None:
+        return part
+    # Not sums.add, which turns the integer sums into floats when part has
+    # rows that sums does not have
+    return pd.concat([sums, part]).groupby(level=0).sum()
+
+
+# Same as load_sums(path, format, kind) is not None, without reading the
+# results
+def has_results(path, format, kind):
+    if os.path.isfile(rd_store.store_path(path)):
+        conn = rd_store.open_store(rd_store.store_path(path))
+        found = rd_store.has_format(conn, kind, format)
+        conn.close()
+        if found:
+            return True
+    return bool(glob.glob(path + "/" + format + "/" + kind + "/*.out"))
+
+
+# Returns the sums of the results of a format as rd_store.read_sums does,
+# computed from the per-image results files if the results database does not
+# have them. Returns None if there are no results.
+def load_sums(path, format, kind):
+    import numpy as np
+    import pandas as pd
+
+    if os.path.isfile(rd_store.store_path(path)):
+        conn = rd_store.open_store(rd_store.store_path(path))
+        sums = rd_store.read_sums(conn, kind, format)
+        conn.close()
+        if sums is not None:
+            return sums
+
+    files = sorted(glob.glob(path + "/" + format + "/" + kind + "/*.out"))
+    if not files:
+        return None
+
+    if kind == "lossy":
+        weighted = rd_store.lossy_weighted
+        extra = ["quality"]
+    else:
+        weighted = rd_store.lossless_weighted
+        extra = []
+    columns = summed_columns + [(name, "float64")
+                                for name in extra + weighted]
+    types = dict(columns)
+    chunk_rows = get_chunk_rows(columns)
+
+    # The results files are read one chunk at a time, each file holding the
+    # rows of one image. Rows are matched between images by their rank in
+    # the image, as every image has the same list of qualities (or of target
+    # bpp).
+    sums = None
+    chunk = []
+    rows = 0
+    for i, f in enumerate(files):
+        data = pd.read_csv(
+            f, sep=":", usecols=lambda name: name in types, dtype=types)
+        data["row_index"] = np.arange(len(data), dtype=np.int32)
+        chunk.append(data)
+        rows += len(data)
+        if rows >= chunk_rows or i == len(files) - 1:
+            sums = add_sums(sums, pd.concat(chunk, ignore_index=True), extra,
+                            weighted)
+            chunk = []
+            rows = 0
+    return sums.rename_axis("row_index").reset_index()
+
+
+# Raises ValueError if the images of a format do not all have the same
+# number of rows, or the same quality at each row.
+def check_sums(sums, format, kind):
+    if sums["images"].nunique() > 1:
+        raise ValueError(
+            "The {} results of format {} do not have the same number of rows "
+            "for every image (from {} to {} images per row), run rd_collect.py "
+            "again to complete them.".format(kind, format,
+                                             sums["images"].min(),
+                                             sums["images"].max()))
+    if kind != "lossy" or target_bpp:
+        return
+    mean = sums["quality"] / sums["images"]
+    variance = sums["quality_sq"] / sums["images"] - mean**2
+    for row_index, spread in variance.items():
+        if spread > 1e-9 * max(1, mean[row_index]**2):
+            raise ValueError(
+                "The lossy results of format {} do not have the same quality "
+                "for every image at row {}, run rd_collect.py again with the "
+                "same qualities, or pass --target-bpp for the results of "
+                "rd_collect.py --target-bpp.".format(format, row_index))
+
+
+# Returns the averages of sums. As with np.average, a value missing from an
+# image makes its average NaN.
+def get_averages(sums, weighted):
+    import pandas as pd
+
+    averages = pd.DataFrame({
+        "avg_bpp":
+        sums["compressed_file_size"] * 8 / sums["pixels"],
+        "avg_compression_ratio":
+        sums["orig_file_size"] / sums["compressed_file_size"]
+    })
+    averages["avg_space_saving"] = 1 - (1 / averages["avg_compression_ratio"])
+    for column in weighted:
+        averages["wavg_" + column] = (
+            sums["w_" + column] / sums["pixels"]).where(
+                sums["n_" + column] == sums["images"])
+    return averages
+
+
+def get_available_formats(path):
+    formats = set(next(os.walk(path))[1])
+    if os.path.isfile(rd_store.store_path(path)):
+        conn = rd_store.open_store(rd_store.store_path(path))
+        formats.update(rd_store.get_formats(conn, "lossy"))
+        conn.close()
+    return sorted(formats)
+
 
 def get_lossless_average(path, reference_format):
-    merged_data = {}
+    import numpy as np
+    import pandas as pd
+    import six
+    import pytablewriter
+
     columns = [
-        "format", "avg_bpp", "avg_compression_ratio", "avg_space_saving",
-        "wavg_encode_time", "wavg_decode_time"
-    ]
+        "format", "avg_bpp", "avg_compression_ratio", "avg_space_saving"
+    ] + ["wavg_" + column for column in rd_store.lossless_weighted]
     final_data = pd.DataFrame(columns=columns)
     final_data.set_index("format", drop=False, inplace=True)
 
-    for format in next(os.walk(path))[1]:
-        if not glob.glob(path + "/" + format + "/lossless/*.out"):
+    for format in get_available_formats(path):
+        sums = load_sums(path, format, "lossless")
+        if sums is None:
             print("Lossless results files could not be found for format {}.".
                   format(format))
             continue
 
-        rawdata = []
-        data_path = path + "/" + format + "/lossless/"
-
-        for f in glob.glob(data_path + "/*.out"):
-            rawdata.append(pd.read_csv(f, sep=":"))
-
-        merged_data[format] = pd.concat(rawdata)
-        sum_orig_file_size = np.sum(merged_data[format]["orig_file_size"])
-        sum_compressed_file_size = np.sum(
-            merged_data[format]["compressed_file_size"])
-        sum_pixels = np.sum(merged_data[format]["pixels"])
-        avg_bpp = sum_compressed_file_size * 8 / sum_pixels
-        avg_compression_ratio = sum_orig_file_size / sum_compressed_file_size
-        avg_space_saving = 1 - (1 / avg_compression_ratio)
-        wavg_encode_time = np.average(
-            merged_data[format]["encode_time"],
-            weights=merged_data[format]["pixels"])
-        wavg_decode_time = np.average(
-            merged_data[format]["decode_time"],
-            weights=merged_data[format]["pixels"])
-        final_data.loc[format] = [
-            format, avg_bpp, avg_compression_ratio, avg_space_saving,
-            wavg_encode_time, wavg_decode_time
-        ]
+        averages = get_averages(sums, rd_store.lossless_weighted)
+        final_data.loc[format] = [format] + list(averages.iloc[0])
 
     final_data = final_data.assign(weissman_score=lambda x: x.avg_compression_ratio / x.loc[reference_format, "avg_compression_ratio"] * np.log(x.loc[reference_format, "wavg_encode_time"] * 1000) / np.log(x.wavg_encode_time * 1000))
     final_data.sort_values("weissman_score", ascending=False, inplace=True)
+    # The times which no format has, as the ones added to rd_collect.py after
+    # the results files were written, are left out of the tables
+    final_data = final_data.drop(columns=[
+        column for column in final_data.columns
+        if column.startswith("wavg_") and final_data[column].isna().all()
+    ])
     results_file = path + "/" + os.path.basename(path) + ".lossless.out"
 
     final_data.to_csv(results_file, sep=":")
 
+    conn = rd_store.open_store(rd_store.store_path(path))
+    rd_store.write_average(conn, "lossless_average",
+                           final_data.reset_index(drop=True))
+    conn.close()
+
     file = open(path + "/" + os.path.basename(path) + ".lossless.md", "w")
     markdown_writer = pytablewriter.MarkdownTableWriter()
     markdown_writer.from_dataframe(final_data)
@@ -96,86 +258,50 @@ def get_lossless_average(path, reference_format):
         "Lossless results file successfully saved to {}.".format(results_file))
 
 
+# Runs in a worker process, and returns the averages, or None if there are no
+# results. They are written to the results database by the parent process, as
+# workers creating the lossy_average table at the same time would conflict.
 def get_lossy_average(args):
     [path, format, reference_format] = args
 
-    if not glob.glob(path + "/" + format + "/lossy/*.out"):
+    sums = load_sums(path, format, "lossy")
+    if sums is None:
         print("Lossy results files could not be found for format {}.".format(
             format))
-        return
+        return None
+    check_sums(sums, format, "lossy")
+
+    final_data = get_averages(sums, rd_store.lossy_weighted)
+    final_data.insert(0, "quality", sums["quality"] / sums["images"])
 
-    rawdata = []
-    merged_data = []
-    columns = [
-        "file_name", "quality", "orig_file_size", "compressed_file_size",
-        "pixels", "bpp", "compression_ratio", "encode_time", "decode_time",
-        "y_ssim_score", "rgb_ssim_score", "msssim_score", "psnrhvsm_score",
-        "vmaf_score"
-    ]
-    final_columns = [
-        "quality", "avg_bpp", "avg_compression_ratio", "avg_space_saving",
-        "wavg_encode_time", "wavg_decode_time", "wavg_y_ssim_score",
-        "wavg_rgb_ssim_score", "wavg_msssim_score", "wavg_psnrhvsm_score",
-        "wavg_vmaf_score"
-    ]
-    final_data = pd.DataFrame(columns=final_columns)
-
-    data_path = path + "/" + format + "/lossy/"
-
-    for f in glob.glob(data_path + "*.out"):
-        rawdata.append(pd.read_csv(f, sep=":"))
-
-    quality_length = len(rawdata[0].index)
-
-    for i in range(quality_length):
-        merged_data.insert(i, pd.DataFrame(columns=columns))
-
-        for data in rawdata:
-            merged_data[i] = merged_data[i].append(data.iloc[[i]])
-
-        merged_data[i].sort_values("file_name", ascending=True, inplace=True)
-
-        quality = np.mean(merged_data[i]["quality"])
-        sum_orig_file_size = np.sum(merged_data[i]["orig_file_size"])
-        sum_compressed_file_size = np.sum(
-            merged_data[i]["compressed_file_size"])
-        sum_pixels = np.sum(merged_data[i]["pixels"])
-        avg_bpp = sum_compressed_file_size * 8 / sum_pixels
-        avg_compression_ratio = sum_orig_file_size / sum_compressed_file_size
-        avg_space_saving = 1 - (1 / avg_compression_ratio)
-        wavg_encode_time = np.average(
-            merged_data[i]["encode_time"], weights=merged_data[i]["pixels"])
-        wavg_decode_time = np.average(
-            merged_data[i]["decode_time"], weights=merged_data[i]["pixels"])
-        wavg_y_ssim_score = np.average(
-            merged_data[i]["y_ssim_score"], weights=merged_data[i]["pixels"])
-        wavg_rgb_ssim_score = np.average(
-            merged_data[i]["rgb_ssim_score"], weights=merged_data[i]["pixels"])
-        wavg_msssim_score = np.average(
-            merged_data[i]["msssim_score"], weights=merged_data[i]["pixels"])
-        wavg_psnrhvsm_score = np.average(
-            merged_data[i]["psnrhvsm_score"], weights=merged_data[i]["pixels"])
-        wavg_vmaf_score = np.average(
-            merged_data[i]["vmaf_score"], weights=merged_data[i]["pixels"])
-
-        final_data.loc[i] = [
-            quality, avg_bpp, avg_compression_ratio, avg_space_saving,
-            wavg_encode_time, wavg_decode_time, wavg_y_ssim_score,
-            wavg_rgb_ssim_score, wavg_msssim_score, wavg_psnrhvsm_score,
-            wavg_vmaf_score
-        ]
     results_file = path + "/" + os.path.basename(
         path) + "." + format + ".lossy.out"
     final_data.to_csv(results_file, sep=":", index=False)
     print("Lossy results file for format {} successfully saved to {}.".format(
         format, results_file))
+    return final_data
 
 
 def main(argv):
     if sys.version_info[0] < 3 and sys.version_info[1] < 5:
         raise Exception("Python 3.5 or a more recent version is required.")
 
-    if len(argv) < 2 or len(argv) > 3:
+    global max_memory, jobs, target_bpp
+
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "j:",
+                                       ["jobs=", "memory=", "target-bpp"])
+        for opt, value in opts:
+            if opt in ("-j", "--jobs"):
+                jobs = int(value)
+            elif opt == "--memory":
+                max_memory = int(value)
+            elif opt == "--target-bpp":
+                target_bpp = True
+    except (getopt.GetoptError, ValueError):
+        args = []
+
+    if len(args) < 1 or len(args) > 2 or jobs < 1 or max_memory < 1:
         print(
             "rd_average.py: Calculate a per format weighted averages of the results files generated by rd_collect.py"
         )
@@ -184,28 +310,36 @@ def main(argv):
         print("       For ex: rd_average.py \"results/subset1\"")
         print("Arg 2: Reference format with which to compare other formats.")
         print("       Default to mozjpeg")
+        print("Option -j N, --jobs N: number of formats averaged at once (default: number of CPUs)")
+        print("Option --memory MB: memory for the results files read at once when there is no results database (default 1024)")
+        print("Option --target-bpp: the lossy results are of rd_collect.py --target-bpp, the qualities of each target differing between images")
         return
 
-    results_folder = os.path.normpath(argv[1])
-    available_formats = next(os.walk(results_folder))[1]
+    results_folder = os.path.normpath(args[0])
+    if not os.path.isdir(results_folder):
+        print(
+            "Could not find all results file. Please make sure the path provided is correct."
+        )
+        return
+    available_formats = get_available_formats(results_folder)
 
     # Check is there is actually results files in the path provided
-    if (not os.path.isdir(results_folder) or not available_formats
-            or not glob.glob(results_folder + "/**/*.out", recursive=True)):
+    if (not available_formats
+            or (not glob.glob(results_folder + "/**/*.out", recursive=True)
+                and not os.path.isfile(rd_store.store_path(results_folder)))):
         print(
             "Could not find all results file. Please make sure the path provided is correct."
         )
         return
 
     try:
-        reference_format = argv[2]
+        reference_format = args[1]
     except IndexError:
         reference_format = "mozjpeg"
 
-    if (reference_format not in available_formats or not glob.glob(
-            results_folder + "/" + reference_format + "/lossless/*.out")
-            or not glob.glob(results_folder + "/" + reference_format +
-                             "/lossy/*.out")):
+    if (reference_format not in available_formats
+            or not has_results(results_folder, reference_format, "lossless")
+            or not has_results(results_folder, reference_format, "lossy")):
         print(
             "Could not find reference format results files. Please choose a format among {} or check if the reference format results files are present.".
             format(available_formats))
@@ -213,9 +347,23 @@ def main(argv):
 
     get_lossless_average(results_folder, reference_format)
 
-    Pool().map(get_lossy_average,
-               [(results_folder, format, reference_format)
-                for format in next(os.walk(results_folder))[1]])
+    pool = Pool(processes=jobs)
+    try:
+        averages = pool.map(get_lossy_average,
+                            [(results_folder, format, reference_format)
+                             for format in available_formats])
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+
+    conn = rd_store.open_store(rd_store.store_path(results_folder))
+    for format, final_data in zip(available_formats, averages):
+        if final_data is not None:
+            rd_store.write_average(conn, "lossy_average", final_data, format)
+    conn.close()
 
 
 if __name__ == "__main__":
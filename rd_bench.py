@@ -0,0 +1,515 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import struct
+import getopt
+import shutil
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+
+# Benchmark of the scripts themselves: rd_collect.py, rd_average.py and
+# rd_select.py are run over a synthetic subset, with stand-ins for the
+# codec, ffmpeg and the metric tools which sleep for a given latency. The
+# stand-ins log how long they ran, so that the time spent in the scripts
+# can be told apart from the time spent in the tools.
+
+# Runs are appended to this file, and compared with the last run with the
+# same settings.
+history_file = "bench_history.jsonl"
+
+# Settings of a run
+images = 4
+width = 64
+height = 64
+latency = 0.01
+metric_engine = "external"
+
+# Recipe of the stand-in codec. rd_select.py compares with BPG at quality 24,
+# for which the file of quality_reference is used.
+recipe = {
+    "quality_start": 10,
+    "quality_end": 100,
+    "quality_step": 10,
+    "encode_extension": "rdb",
+    "decode_extension": "y4m",
+    "encode_cmd": "rd_bench_enc -q $quality -o $target $origpng",
+    "lossless_cmd": "rd_bench_enc -q 100 -o $target $origpng",
+    "decode_cmd": "rd_bench_dec $target -o $target_dec",
+    "export_to_png": False
+}
+quality_reference = 50
+
+tools = [
+    "rd_bench_enc", "rd_bench_dec", "rd_bench_convert", "dump_ssim",
+    "dump_msssim", "dump_psnrhvs", "vmafossexec"
+]
+
+#############################################################################
+# Images
+
+
+def write_png(path, rgb):
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data + struct.pack(
+            ">I",
+            zlib.crc32(kind + data) & 0xffffffff))
+
+    rows = np.hstack([
+        np.zeros((rgb.shape[0], 1), dtype=np.uint8),
+        rgb.reshape(rgb.shape[0], -1)
+    ])
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(
+            chunk(b"IHDR",
+                  struct.pack(">IIBBBBB", rgb.shape[1], rgb.shape[0], 8, 2,
+                              0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 1)))
+        file.write(chunk(b"IEND", b""))
+
+
+# Reads the PNG files written by write_png only
+def read_png(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    pos = 8
+    idat = b""
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if kind == b"IHDR":
+            png_width, png_height = struct.unpack(">II", body[:8])
+        elif kind == b"IDAT":
+            idat += body
+        pos += length + 12
+    rows = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(
+        png_height, -1)
+    return rows[:, 1:].reshape(png_height, png_width, 3)
+
+
+def rgb_to_yuv420(rgb):
+    rgb = rgb.astype(np.float64)
+    y = 0.299 * rgb[..., 0] + 0.587 * rgb[..., 1] + 0.114 * rgb[..., 2]
+    u = 128 + (rgb[..., 2] - y) * 0.564
+    v = 128 + (rgb[..., 0] - y) * 0.713
+    h, w = y.shape
+    pad = ((0, h % 2), (0, w % 2))
+    u = np.pad(u, pad, mode="edge")
+    v = np.pad(v, pad, mode="edge")
+    u = u.reshape(u.shape[0] // 2, 2, u.shape[1] // 2, 2).mean(axis=(1, 3))
+    v = v.reshape(v.shape[0] // 2, 2, v.shape[1] // 2, 2).mean(axis=(1, 3))
+    return [
+        np.clip(np.round(plane), 0, 255).astype(np.uint8)
+        for plane in (y, u, v)
+    ]
+
+
+def yuv420_to_rgb(planes):
+    y = planes[0].astype(np.float64)
+    u = np.repeat(np.repeat(planes[1], 2, axis=0), 2,
+                  axis=1)[:y.shape[0], :y.shape[1]] - 128.0
+    v = np.repeat(np.repeat(planes[2], 2, axis=0), 2,
+                  axis=1)[:y.shape[0], :y.shape[1]] - 128.0
+    rgb = np.stack([y + 1.402 * v, y - 0.344 * u - 0.714 * v, y + 1.772 * u],
+                   axis=-1)
+    return np.clip(np.round(rgb), 0, 255).astype(np.uint8)
+
+
+def write_y4m(path, planes):
+    with open(path, "wb") as file:
+        file.write(b"YUV4MPEG2 W%d H%d F25:1 Ip A0:0 C420jpeg\nFRAME\n" %
+                   (planes[0].shape[1], planes[0].shape[0]))
+        for plane in planes:
+            file.write(plane.tobytes())
+
+
+def read_y4m(path):
+    import rd_metrics
+    return list(rd_metrics.read_y4m(path)[0])
+
+
+# Reads a PNG or y4m file as yuv420 planes
+def read_planes(path):
+    with open(path, "rb") as file:
+        magic = file.read(9)
+    if magic == b"YUV4MPEG2":
+        return read_y4m(path)
+    return rgb_to_yuv420(read_png(path))
+
+
+def make_image(path, index):
+    rng = np.random.RandomState(index)
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:, None]
+    rgb = np.stack([
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)), (x + y) / 2
+    ], axis=-1)
+    rgb = rgb + rng.normal(0, 12, rgb.shape)
+    write_png(path, np.clip(rgb, 0, 255).astype(np.uint8))
+
+
+#############################################################################
+# Stand-in tools
+
+
+# Seconds since the process started, interpreter startup included
+def process_time_since_start():
+    with open("/proc/self/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - start
+
+
+def log_tool(name):
+    path = os.environ.get("RD_BENCH_LOG")
+    if path:
+        with open(path, "a") as file:
+            file.write("%s %f\n" % (name, process_time_since_start()))
+
+
+def arg_after(args, option):
+    return args[args.index(option) + 1]
+
+
+def score_planes(ref, dist):
+    mse = np.mean((ref[0].astype(np.float64) - dist[0])**2)
+    return 10 * np.log10(255.0**2 / max(mse, 1e-10))
+
+
+def tool_main(name, args):
+    time.sleep(float(os.environ.get("RD_BENCH_LATENCY", "0")))
+
+    if name == "rd_bench_enc":
+        # The bitstream holds the quality and the source, and grows with the
+        # quality
+        quality = float(arg_after(args, "-q"))
+        source = os.path.abspath(args[-1])
+        pixels = np.prod(read_png(source).shape[:2])
+        header = ("RDB %f %s\n" % (quality, source)).encode("utf-8")
+        size = max(int(pixels * quality / 400), 1)
+        payload = random.Random(quality).getrandbits(8 * size).to_bytes(
+            size, "little")
+        with open(arg_after(args, "-o"), "wb") as file:
+            file.write(header + payload)
+    elif name == "rd_bench_dec":
+        with open(args[0], "rb") as file:
+            header = file.readline().decode("utf-8").split(" ", 2)
+        quality, source = float(header[1]), header[2].strip()
+        planes = rgb_to_yuv420(read_png(source))
+        rng = np.random.RandomState(int(quality))
+        planes = [
+            np.clip(plane + rng.normal(0, (100 - quality) / 10 + 0.01,
+                                       plane.shape), 0, 255).astype(np.uint8)
+            for plane in planes
+        ]
+        write_y4m(arg_after(args, "-o"), planes)
+    elif name == "rd_bench_convert":
+        planes = read_planes(arg_after(args, "-i"))
+        out = args[-1]
+        extension = os.path.splitext(out)[1]
+        if extension == ".y4m":
+            write_y4m(out, planes)
+        elif extension == ".yuv":
+            with open(out, "wb") as file:
+                for plane in planes:
+                    file.write(plane.tobytes())
+        elif extension == ".ppm":
+            rgb = yuv420_to_rgb(planes)
+            with open(out, "wb") as file:
+                file.write(b"P6\n%d %d\n255\n" % (rgb.shape[1], rgb.shape[0]))
+                file.write(rgb.tobytes())
+        else:
+            write_png(out, yuv420_to_rgb(planes))
+    elif name in ("dump_ssim", "dump_msssim", "dump_psnrhvs"):
+        files = [arg for arg in args if not arg.startswith("-")]
+        score = score_planes(read_y4m(files[0]), read_y4m(files[1]))
+        print("0 %f\nTotal: %f" % (score, score))
+    elif name == "vmafossexec":
+        frame_width, frame_height = int(args[1]), int(args[2])
+        frames = []
+        for path in args[3:5]:
+            # The distorted frame may come from a named pipe
+            with open(path, "rb") as file:
+                data = np.frombuffer(file.read(), dtype=np.uint8)
+            frames.append([data[:frame_width * frame_height]])
+        score = min(score_planes(frames[0], frames[1]) * 2, 100.0)
+        print("Start\nVMAF score = %f" % score)
+
+    log_tool(name)
+
+
+def install_tools(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in tools:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as file:
+            file.write("#!%s\nimport sys\nsys.path.insert(0, %r)\n"
+                       "import rd_bench\nrd_bench.tool_main(%r, sys.argv[1:])\n"
+                       % (sys.executable, os.path.dirname(
+                           os.path.abspath(__file__)), name))
+        os.chmod(path, 0o755)
+
+
+#############################################################################
+# Benchmark
+
+
+# Returns tuple containing:
+#   (tool_time, tool_calls)
+# logged by the stand-in tools since the last call.
+def read_tool_log(path):
+    tool_time = 0.0
+    tool_calls = 0
+    try:
+        with open(path) as file:
+            for line in file:
+                tool_time += float(line.split()[1])
+                tool_calls += 1
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return (tool_time, tool_calls)
+
+
+def run_stage(name, func, log_path, image_count, point_count):
+    read_tool_log(log_path)
+    start = time.perf_counter()
+    # The scripts report every image they process
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+            devnull):
+        func()
+    wall = time.perf_counter() - start
+    tool_time, tool_calls = read_tool_log(log_path)
+    return {
+        "stage": name,
+        "wall": wall,
+        "tool_time": tool_time,
+        "tool_calls": tool_calls,
+        "overhead": wall - tool_time,
+        "images_per_s": image_count / wall,
+        "points_per_s": point_count / wall if point_count else None
+    }
+
+
+def run_benchmark(workdir):
+    import rd_collect
+    import rd_average
+    import rd_select
+
+    bin_dir = os.path.join(workdir, "bin")
+    install_tools(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["RD_BENCH_LATENCY"] = str(latency)
+    log_path = os.path.join(workdir, "tools.log")
+    os.environ["RD_BENCH_LOG"] = log_path
+
+    rd_collect.convert = rd_select.convert = "rd_bench_convert"
+    rd_collect.yssim = "dump_ssim -y"
+    rd_collect.rgbssim = "dump_ssim"
+    rd_collect.msssim = "dump_msssim -y"
+    rd_collect.psnrhvsm = "dump_psnrhvs -y"
+    rd_collect.vmaf = "vmafossexec yuv420p"
+    rd_collect.metric_engine = metric_engine
+    rd_collect.tmpdir = rd_select.tmpdir = workdir + "/tmp/"
+    rd_collect.refcache_dir = rd_collect.tmpdir + "rd_refcache/"
+    os.makedirs(rd_collect.tmpdir, exist_ok=True)
+
+    subset_name = "bench"
+    os.makedirs(subset_name, exist_ok=True)
+    origpngs = []
+    for index in range(images):
+        origpngs.append(subset_name + "/img%03d.png" % index)
+        make_image(origpngs[-1], index)
+    with open("recipes.json", "w") as json_file:
+        json.dump({"recipes": {"bench": recipe}}, json_file)
+    points = images * len(rd_collect.get_quality_list(recipe))
+
+    stages = []
+
+    def collect():
+        for origpng in origpngs:
+            rd_collect.process_image(["bench", recipe, subset_name, origpng])
+
+    stages.append(run_stage("collect", collect, log_path, images, points))
+
+    stages.append(
+        run_stage("average",
+                  lambda: rd_average.main(
+                      ["rd_average.py", "results/" + subset_name, "bench"]),
+                  log_path, images, points))
+
+    # Reference files looked up by rd_select.py
+    for origpng in origpngs:
+        name = os.path.splitext(os.path.basename(origpng))[0]
+        reference = "BPG_out/" + subset_name + "/" + name + "/" + name + "-q24.bpg"
+        os.makedirs(os.path.dirname(reference), exist_ok=True)
+        shutil.copy(
+            rd_collect.get_lossy_target(subset_name, origpng, "bench", recipe,
+                                        quality_reference), reference)
+
+    stages.append(
+        run_stage("select",
+                  lambda: rd_select.main(
+                      ["rd_select.py", "bench", subset_name, subset_name]),
+                  log_path, images, 0))
+    return stages
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history():
+    entries = []
+    try:
+        with open(history_file) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def print_report(stages, previous):
+    print("%-8s %9s %9s %9s %6s %10s %9s %9s" %
+          ("stage", "wall (s)", "tools (s)", "ovh (s)", "calls", "points/s",
+           "images/s", "ovh diff"))
+    previous_stages = {}
+    if previous is not None:
+        previous_stages = {stage["stage"]: stage for stage in previous["stages"]}
+    for stage in stages:
+        diff = ""
+        before = previous_stages.get(stage["stage"])
+        if before is not None and before["overhead"] > 0:
+            diff = "%+.1f%%" % (
+                (stage["overhead"] / before["overhead"] - 1) * 100)
+        print("%-8s %9.3f %9.3f %9.3f %6d %10s %9.2f %9s" %
+              (stage["stage"], stage["wall"], stage["tool_time"],
+               stage["overhead"], stage["tool_calls"], "%.2f" %
+               stage["points_per_s"] if stage["points_per_s"] else "-",
+               stage["images_per_s"], diff))
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    global images, width, height, latency, metric_engine, history_file
+
+    keep = False
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "", [
+            "images=", "size=", "latency=", "metric-engine=", "history=",
+            "keep"
+        ])
+        for opt, value in opts:
+            if opt == "--images":
+                images = int(value)
+            elif opt == "--size":
+                width, height = [int(side) for side in value.split("x")]
+            elif opt == "--latency":
+                latency = float(value)
+            elif opt == "--metric-engine":
+                metric_engine = value
+            elif opt == "--history":
+                history_file = value
+            elif opt == "--keep":
+                keep = True
+    except (getopt.GetoptError, ValueError):
+        args = None
+
+    if args is None or args or metric_engine not in ("numpy", "external"):
+        print("rd_bench.py: Measure the time spent in the scripts apart from the codecs and metric tools")
+        print("Option --images N: number of images of the synthetic subset (default {})".format(images))
+        print("Option --size WxH: size of the images (default {}x{})".format(width, height))
+        print("Option --latency S: seconds slept by every stand-in tool (default {})".format(latency))
+        print("Option --metric-engine E: metric engine of rd_collect.py, numpy or external (default {})".format(metric_engine))
+        print("Option --history FILE: file the runs are appended to (default {})".format(history_file))
+        print("Option --keep: keep the working directory")
+        return
+
+    history_file = os.path.abspath(history_file)
+    config = {
+        "images": images,
+        "width": width,
+        "height": height,
+        "latency": latency,
+        "metric_engine": metric_engine,
+        "recipe": recipe
+    }
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="rd_bench_")
+    os.chdir(workdir)
+    try:
+        stages = run_benchmark(workdir)
+    finally:
+        os.chdir(cwd)
+        if keep:
+            print("Working directory kept in {}".format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    for entry in read_history():
+        if entry["config"] == config:
+            previous = entry
+    print_report(stages, previous)
+
+    entry = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": get_commit(),
+        "config": config,
+        "stages": stages
+    }
+    with open(history_file, "a") as file:
+        file.write(json.dumps(entry) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# Scores of decoded images, shared by every run and every subset, and keyed
+# by the hashes of the reference and of the encoded image and by the
+# versions of the decoder and of the metrics. Encoders often produce the
+# same bitstream for neighbouring qualities at the ends of their range,
+# which is then decoded and scored only once.
+cache_file = "results/metric_cache.sqlite"
+
+# Number of entries above which the least recently used ones are removed,
+# checked every evict_interval new entries.
+max_entries = 1000000
+evict_interval = 1000
+
+# Seconds after which a hit updates the last use time of an entry. Hits on
+# entries used more recently do not write to the cache.
+touch_interval = 24 * 3600
+
+schema = """
+CREATE TABLE IF NOT EXISTS scores (
+    key TEXT PRIMARY KEY, decode_timing TEXT, y_ssim_score REAL,
+    rgb_ssim_score REAL, msssim_score REAL, psnrhvsm_score REAL,
+    vmaf_score REAL, last_used REAL);
+CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used);
+"""
+
+#############################################################################
+
+# Connections are not shared with the processes forked by a Pool, nor with
+# the executor threads of the pipeline of rd_collect.py, and are closed with
+# their thread
+connections = threading.local()
+inserted = 0
+
+
+def open_cache():
+    if getattr(connections, "pid", None) != os.getpid():
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        conn = sqlite3.connect(
+            cache_file, timeout=600, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(schema)
+        connections.conn = conn
+        connections.pid = os.getpid()
+    return connections.conn
+
+
+def make_key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+# Returns tuple containing:
+#   (decode_timing, yssim_score, rgbssim_score, msssim_score, psnrhvsm_score,
+#   vmaf_score)
+# or None if the key is not in the cache.
+def lookup(key):
+    conn = open_cache()
+    row = conn.execute(
+        "SELECT decode_timing, y_ssim_score, rgb_ssim_score, msssim_score, "
+        "psnrhvsm_score, vmaf_score, last_used FROM scores WHERE key = ?",
+        (key, )).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[6] > touch_interval:
+        with conn:
+            conn.execute("UPDATE scores SET last_used = ? WHERE key = ?",
+                         (now, key))
+    return (tuple(json.loads(row[0])), ) + tuple(row[1:6])
+
+
+def store(key, results):
+    global inserted
+
+    conn = open_cache()
+    decode_timing = [float(value) for value in results[0]]
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, json.dumps(decode_timing)) +
+            tuple(float(score) for score in results[1:]) + (time.time(), ))
+    inserted += 1
+    if inserted % evict_interval == 0:
+        evict(conn)
+
+
+def evict(conn):
+    with conn:
+        conn.execute(
+            "DELETE FROM scores WHERE key IN (SELECT key FROM scores "
+            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (max_entries, ))
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) != 2 or argv[1] not in ("stats", "evict", "clear"):
+        print("rd_cache.py: Manage the cache of the metric scores")
+        print("Arg 1: stats, evict (down to {} entries) or clear".format(
+            max_entries))
+        return
+
+    conn = open_cache()
+    if argv[1] == "evict":
+        evict(conn)
+    elif argv[1] == "clear":
+        with conn:
+            conn.execute("DELETE FROM scores")
+        conn.execute("VACUUM")
+    count = conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+    print("{}: {} entries, {} bytes".format(cache_file, count,
+                                            os.path.getsize(cache_file)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -38,26 +38,134 @@ import sys
 import glob
 import re
 import shlex
+import shutil
 import string
 import json
+import getopt
+import hashlib
+import time
+import threading
+import contextvars
+import collections
+import queue
+import statistics
 from multiprocessing import Pool
-from timeit import Timer
-import numpy as np
+import rd_cache
+import rd_probe
+import rd_store
+import rd_trace
 
 # Paths to various programs and config files used by the tests #
 # Conversion
 convert = "ffmpeg"
 
 # Tests
+# "numpy" computes Y-SSIM, RGB-SSIM, MS-SSIM and PSNR-HVS-M in process with
+# rd_metrics, "external" runs the programs below for each of them. "numpy" is
+# only for rd_bench.py and experiments, and is not offered as an option until
+# tests/test_rd_metrics.py passes against the scores recorded from these
+# programs.
+metric_engine = "external"
 rgbssim = "dump_ssim"
 yssim = "dump_ssim -y"
 psnrhvsm = "dump_psnrhvs -y"
 msssim = "dump_msssim -y"
 vmaf = "vmafossexec yuv420p"
+# Model of vmafossexec, which also reads the file of the same name ending
+# with .model
+vmaf_model = "vmaf_v0.6.1.pkl"
 
 # Path to tmp dir to be used by the tests
 tmpdir = "/tmp/"
 
+# Results are stored in results/<subset>/<subset>.sqlite. Set to True to also
+# write a results file per image, as older versions did.
+out_files = False
+
+# Number of untimed runs before, and of timed runs of each encode and decode
+lossless_warmup = 0
+lossless_repeat = 5
+lossy_warmup = 0
+lossy_repeat = 1
+
+# Recipes with a decode_pipe_target have their decoded image read from the
+# decoder output and scored from memory, without temporary files. The
+# external metric tools read it from named pipes.
+stream_decode = True
+
+# Converted versions of the original images (y4m, yuv, ppm) are shared by
+# every quality and every format, and kept in this directory until its size
+# goes over the limit, in which case the least recently used are removed.
+refcache_dir = tmpdir + "rd_refcache/"
+refcache_size = 4 * 1024 * 1024 * 1024
+# Files used more recently than this (in seconds) are never removed, as
+# another worker may be about to read them.
+refcache_grace = 600
+
+# With target bits per pixel, the qualities are found by bisection until the
+# bpp of the encoded image is within bpp_tolerance (relative) of the target,
+# or after bisect_max_steps encodes per target.
+bpp_tolerance = 0.05
+bisect_max_steps = 8
+
+# With pipeline_depth above 0, the lossy quality points of an image are run
+# as a single task, through an asyncio pipeline in which the conversions and
+# the metrics of a quality point run at the same time as each other, as the
+# ones of the other quality points and as the encodes and decodes, for at
+# most pipeline_depth quality points at once. Encodes and decodes, which are
+# timed, run one at a time.
+pipeline_depth = 0
+
+# With metric_batch above 0, the lossy quality points of an image are run as
+# a single task, which decodes up to metric_batch of them and then runs each
+# metric program once on all their frames, against as many copies of the
+# reference, reading back the score of each frame. The programs are started,
+# and the vmaf model loaded, once per batch instead of once per quality
+# point. Encodes and decodes are timed as usual.
+metric_batch = 0
+
+# Scores are looked up in the metric cache of rd_cache.py, keyed by the
+# reference, the encoded image and the versions of the decoder and metrics,
+# before decoding and scoring an image. A hit also reuses the decode timing
+# measured for the same bitstream. With metrics_only, the cache is not looked
+# up but still updated.
+metric_cache = True
+
+# Every encode is recorded in <FORMAT>_out/<subset>/manifest.jsonl with the
+# hash of the original image, the encode command, the hash of the encoder
+# and the quality. With metrics_only, the encoded images whose inputs did
+# not change are decoded and scored again without encoding them, reusing
+# their recorded encode timing, and the images already done are processed
+# again.
+metrics_only = False
+
+# With keep_decoded, the decoded images are kept in
+# <FORMAT>_decoded/<subset>/<image>/, for rd_select.py to export them to PNG
+# without decoding them again. Decoding to a pipe is then disabled.
+keep_decoded = False
+
+# Tasks run at once only while the threads of their encoders and decoders fit
+# in cores and their memory fits in memory_budget (MB), a task too large for
+# them running alone. Recipes may declare encode_threads, decode_threads,
+# encode_memory and decode_memory, memory being the peak in MB per megapixel,
+# images under a megapixel counting as one. What a recipe does not declare
+# is learned from the encodes and decodes of the previous runs, kept in
+# resources_file, or else taken from default_threads and default_memory.
+# A task running several quality points also counts metric_processes
+# threads per quality point scored at once. cores and memory_budget are
+# read again by main at each run.
+cores = os.cpu_count()
+memory_budget = os.sysconf("SC_PHYS_PAGES") * os.sysconf(
+    "SC_PAGE_SIZE") // 2**20
+default_threads = 1
+default_memory = 256
+# Metric programs run at once for a quality point of --pipeline: the four
+# metrics and vmaf
+metric_processes = 5
+# Memory of a worker process and of its metrics, in MB per megapixel
+metric_memory = 128
+resources_file = "results/resources.json"
+
 #############################################################################
 
 
@@ -69,9 +177,29 @@ def split(cmd):
     return list(lex)
 
 
+# CPU time of the child processes waited for by the current thread. Timings
+# only count the processes they ran, and not the ones run at the same time
+# by other threads or by the pipeline.
+child_times = threading.local()
+
+
+def wait_child(proc):
+    pid, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    child_times.cpu_time = getattr(child_times, "cpu_time",
+                                   0.0) + usage.ru_utime + usage.ru_stime
+    child_times.maxrss = max(
+        getattr(child_times, "maxrss", 0), usage.ru_maxrss)
+    return proc.returncode
+
+
 def run_silent(cmd):
-    FNULL = open(os.devnull, 'w')
-    rv = subprocess.call(split(cmd), stdout=FNULL, stderr=FNULL)
+    proc = subprocess.Popen(
+        split(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rv = wait_child(proc)
     if rv != 0:
         sys.stderr.write("Failure from subprocess:\n")
         sys.stderr.write("\t" + cmd + "\n")
@@ -87,6 +215,45 @@ def wrapper(func, *args, **kwargs):
     return wrapped
 
 
+# Threads and peak memory (KB) of the child processes timed by the current
+# task, by stage ("encode" or "decode")
+stage_usage = {}
+
+
+# Statistics returned by time_func, also part of the keys under which
+# timings are cached and recorded
+timing_fields = ["total", "min", "stddev", "cpu", "median"]
+
+
+# Returns tuple containing:
+#   (total_time, min_time, stddev_time, cpu_time, median_time)
+# in seconds, total_time being the wall time of all the timed runs, as
+# timeit reported it, and the others per run. cpu_time is the user and
+# system time of the child processes run by func. The threads they used,
+# estimated from their CPU time, and their peak memory are recorded in
+# stage_usage under stage.
+def time_func(func, warmup, repeat, stage=None):
+    for i in range(warmup):
+        func()
+
+    times = []
+    before = getattr(child_times, "cpu_time", 0.0)
+    child_times.maxrss = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    cpu_time = (getattr(child_times, "cpu_time", 0.0) - before) / repeat
+    if stage is not None:
+        threads = max(1, round(cpu_time * repeat / sum(times)))
+        usage = stage_usage.setdefault(stage, [1, 0])
+        usage[0] = max(usage[0], threads)
+        usage[1] = max(usage[1], child_times.maxrss)
+    return (sum(times), min(times), statistics.pstdev(times), cpu_time,
+            statistics.median(times))
+
+
 def create_dir(path):
     if not os.path.exists(os.path.dirname(path)):
         try:
@@ -100,39 +267,98 @@ def path_for_file_in_tmp(path):
     return tmpdir + str(os.getpid()) + os.path.basename(path)
 
 
-def get_img_width(path):
-    cmd = "identify -format %%w %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding="utf-8")
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: identify\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    return int(lines[0].strip())
+def convert_img(inn, out):
+    with rd_trace.span("convert"):
+        cmd = "%s -y -i %s -pix_fmt yuv420p %s" % (convert, inn, out)
+        run_silent(cmd)
 
 
-def get_img_height(path):
-    cmd = "identify -format %%h %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding="utf-8")
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: identify\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    return int(lines[0].strip())
+def remove_files(*paths):
+    for path in set(paths):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
-def convert_img(inn, out):
-    cmd = "%s -y -i %s -pix_fmt yuv420p %s" % (convert, inn, out)
-    run_silent(cmd)
+def decoded_path(target, extension):
+    parts = os.path.normpath(target).split(os.sep)
+    parts[0] = parts[0][:-len("_out")] + "_decoded"
+    return os.path.splitext(os.sep.join(parts))[0] + "." + extension
+
+
+# Removes a decoded image, or keeps it with keep_decoded
+def release_decoded(target_dec, target):
+    if not keep_decoded:
+        remove_files(target_dec)
+        return
+    path = decoded_path(target, os.path.splitext(target_dec)[1][1:])
+    create_dir(path)
+    shutil.move(target_dec, path)
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Hashes of the files hashed again and again: original images, programs and
+# models. Encoded images, hashed once, go through hash_file.
+file_hashes = {}
+
+
+def get_file_hash(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in file_hashes:
+        file_hashes[key] = hash_file(path)
+    return file_hashes[key]
+
+
+def evict_references():
+    entries = []
+    for f in os.listdir(refcache_dir):
+        try:
+            stat = os.stat(refcache_dir + f)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, refcache_dir + f))
+
+    total_size = sum(entry[1] for entry in entries)
+    now = time.time()
+    for mtime, size, path in sorted(entries):
+        if total_size <= refcache_size or now - mtime < refcache_grace:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+# Returns the path of the original image converted to the given extension,
+# converting it only if no worker did it before.
+def get_reference(origpng, extension):
+    path = refcache_dir + get_file_hash(origpng) + "." + extension
+    if os.path.isfile(path):
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+    create_dir(path)
+    # Converted under a private name then renamed, so that other workers
+    # never see a partial file.
+    tmp_path = os.path.splitext(path)[0] + "." + str(
+        os.getpid()) + ".tmp." + extension
+    convert_img(origpng, tmp_path)
+    os.replace(tmp_path, path)
+    evict_references()
+    return path
 
 
 def score_y_ssim(y4m1, y4m2):
@@ -201,7 +427,7 @@ def score_msssim(y4m1, y4m2):
 
 def score_vmaf(width, height, yuv1, yuv2):
     cmd = "%s %s %s %s %s %s" % (vmaf, width, height, yuv1, yuv2,
-                                 "vmaf_v0.6.1.pkl")
+                                 vmaf_model)
     proc = subprocess.Popen(
         split(cmd),
         stdout=subprocess.PIPE,
@@ -217,14 +443,180 @@ def score_vmaf(width, height, yuv1, yuv2):
     return qscore
 
 
+def write_pipe(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
+def run_capture(cmd, data=None):
+    proc = subprocess.Popen(
+        split(cmd),
+        stdin=subprocess.DEVNULL if data is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    if data is not None:
+        thread = threading.Thread(target=write_pipe, args=(proc.stdin, data))
+        thread.daemon = True
+        thread.start()
+    out = proc.stdout.read()
+    proc.stdout.close()
+    if data is not None:
+        thread.join()
+    return (wait_child(proc), out)
+
+
+def write_fifo(path, data):
+    try:
+        with open(path, "wb") as fifo:
+            fifo.write(data)
+    except BrokenPipeError:
+        pass
+
+
+# Runs func(*args, fifo), fifo being a named pipe from which data can be read
+# once, as a file.
+def with_fifo(name, data, func, *args):
+    fifo = tmpdir + str(os.getpid()) + "-" + str(
+        threading.get_ident()) + "-" + name + ".fifo"
+    os.mkfifo(fifo)
+    thread = threading.Thread(target=write_fifo, args=(fifo, data))
+    thread.daemon = True
+    thread.start()
+    try:
+        return func(*args, fifo)
+    finally:
+        if thread.is_alive():
+            # The tool did not read the whole pipe, unblock the writer
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        thread.join()
+        os.remove(fifo)
+
+
+# Scores a yuv420p frame held in memory, handed to vmafossexec through a
+# named pipe.
+def score_vmaf_data(width, height, yuv, data):
+    with rd_trace.span("score_vmaf"):
+        return with_fifo("vmaf", data, score_vmaf, width, height, yuv)
+
+
+def manifest_path(target):
+    return os.path.dirname(os.path.dirname(target)) + "/manifest.jsonl"
+
+
+def encode_inputs(origpng, cmd, quality, repeat):
+    program = shutil.which(split(cmd)[0])
+    return json.loads(
+        json.dumps({
+            "source": get_file_hash(origpng),
+            "cmd": cmd,
+            "encoder": get_file_hash(program) if program else split(cmd)[0],
+            "quality": quality,
+            "repeat": repeat,
+            "timing": timing_fields
+        }))
+
+
+# Manifests read by this process, the last record of a file being the one
+# of its current version
+manifests = {}
+
+
+def read_manifest(path):
+    if path not in manifests:
+        entries = {}
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[record["target"]] = record
+        except FileNotFoundError:
+            pass
+        manifests[path] = entries
+    return manifests[path]
+
+
+# Appends a record to the manifest of its target, the size and modification
+# time of the target being the ones it has now
+def append_manifest(record):
+    target = record["target"]
+    stat = os.stat(target)
+    record = dict(record, size=stat.st_size, mtime=stat.st_mtime)
+    # A single write in append mode, so that the records of several workers
+    # are not interleaved
+    fd = os.open(
+        manifest_path(target), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+    return record
+
+
+def record_encode(target, inputs, encode_timing):
+    encode_records.append(
+        append_manifest(
+            dict(
+                inputs,
+                target=target,
+                encode_timing=[float(value) for value in encode_timing])))
+
+
+# Returns the encode timing recorded for target if it was encoded from the
+# same inputs and was not changed since, or None.
+def reuse_encode(target, inputs):
+    record = read_manifest(manifest_path(target)).get(target)
+    if record is None or any(record.get(key) != value
+                             for key, value in inputs.items()):
+        return None
+    try:
+        stat = os.stat(target)
+    except FileNotFoundError:
+        return None
+    if stat.st_size != record["size"] or stat.st_mtime != record["mtime"]:
+        return None
+    return tuple(record["encode_timing"])
+
+
+# Encoded images written, or reused, by run_encode for the task running in
+# this process, and their manifest records, from which rd_distributed.py
+# uploads them
+encoded_targets = []
+encode_records = []
+
+
+# Encodes target with cmd, unless metrics_only is set and the manifest shows
+# it is up to date.
+# Returns the encode timing, as returned by time_func.
+def run_encode(target, cmd, origpng, quality, warmup, repeat):
+    encoded_targets.append(target)
+    with rd_trace.span("encode"):
+        inputs = encode_inputs(origpng, cmd, quality, repeat)
+        if metrics_only:
+            encode_timing = reuse_encode(target, inputs)
+            if encode_timing is not None:
+                encode_records.append(
+                    read_manifest(manifest_path(target))[target])
+                return encode_timing
+
+        wrapped = wrapper(run_silent, cmd)
+        encode_timing = time_func(wrapped, warmup, repeat, "encode")
+        record_encode(target, inputs, encode_timing)
+        return encode_timing
+
+
 # Returns tuple containing:
-#   (target_file_size, encode_time, decode_time)
+#   (target_file_size, encode_timing, decode_timing)
+# with timings as returned by time_func.
 def get_lossless_results(subset_name, origpng, format, format_recipe):
 
-    origpng_y4m = path_for_file_in_tmp(origpng) + ".y4m"
-    convert_img(origpng, origpng_y4m)
-    origpng_ppm = path_for_file_in_tmp(origpng) + ".ppm"
-    convert_img(origpng, origpng_ppm)
+    origpng_y4m = get_reference(origpng, "y4m")
+    origpng_ppm = get_reference(origpng, "ppm")
 
     target = format.upper() + "_out/" + subset_name + "/" + os.path.splitext(
         os.path.basename(origpng))[0] + "/" + os.path.splitext(
@@ -234,53 +626,59 @@ def get_lossless_results(subset_name, origpng, format, format_recipe):
 
     target += "." + format_recipe['encode_extension']
     cmd = string.Template(format_recipe['lossless_cmd']).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    encode_time = Timer(wrapped).timeit(5)
+    encode_timing = run_encode(target, cmd, origpng, None, lossless_warmup,
+                               lossless_repeat)
 
     target_dec += "." + format_recipe['decode_extension']
     cmd = string.Template(format_recipe['decode_cmd']).substitute(locals())
     wrapped = wrapper(run_silent, cmd)
-    decode_time = Timer(wrapped).timeit(5)
+    decode_timing = time_func(wrapped, lossless_warmup, lossless_repeat,
+                              "decode")
 
-    target_file_size = os.path.getsize(target)
+    target_file_size = get_size(target)
 
-    try:
-        os.remove(origpng_y4m)
-        os.remove(origpng_ppm)
-        os.remove(target_dec)
-    except FileNotFoundError:
-        pass
+    release_decoded(target_dec, target)
 
-    return (target_file_size, encode_time, decode_time)
+    return (target_file_size, encode_timing, decode_timing)
 
 
-# Returns tuple containing:
-#   (target_file_size, encode_time, decode_time, yssim_score, rgbssim_score,
-#   psnrhvsm_score, msssim_score)
-def get_lossy_results(subset_name, origpng, width, height, format,
-                      format_recipe, quality):
-    origpng_y4m = path_for_file_in_tmp(origpng) + ".y4m"
-    convert_img(origpng, origpng_y4m)
-    origpng_yuv = path_for_file_in_tmp(origpng) + ".yuv"
-    convert_img(origpng, origpng_yuv)
-    origpng_ppm = path_for_file_in_tmp(origpng) + ".ppm"
-    convert_img(origpng, origpng_ppm)
+def score_y4m(y4m1, y4m2):
+    import rd_metrics
 
-    target = format.upper() + "_out/" + subset_name + "/" + os.path.splitext(
-        os.path.basename(origpng))[0] + "/" + os.path.splitext(
-            os.path.basename(origpng))[0] + "-q" + str(quality)
-    create_dir(target)
-    target_dec = path_for_file_in_tmp(target)
+    with rd_trace.span("score_numpy"):
+        return rd_metrics.score_y4m(y4m1, y4m2)
 
-    target += "." + format_recipe['encode_extension']
-    cmd = string.Template(format_recipe['encode_cmd']).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    encode_time = Timer(wrapped).timeit(1)
 
-    target_dec += "." + format_recipe['decode_extension']
-    cmd = string.Template(format_recipe['decode_cmd']).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    decode_time = Timer(wrapped).timeit(1)
+def get_size(path):
+    with rd_trace.span("getsize"):
+        return os.path.getsize(path)
+
+
+# Formats whose decode_pipe_target did not work in this process
+unstreamable_formats = set()
+
+
+# Returns tuple containing:
+#   (decode_timing, target_dec)
+def decode_file(format_recipe, variables):
+    with rd_trace.span("decode"):
+        target_dec = variables['target_dec'] + "." + format_recipe[
+            'decode_extension']
+        cmd = string.Template(format_recipe['decode_cmd']).substitute(
+            variables, target_dec=target_dec)
+        wrapped = wrapper(run_silent, cmd)
+        decode_timing = time_func(wrapped, lossy_warmup, lossy_repeat,
+                                  "decode")
+        return (decode_timing, target_dec)
+
+
+# Decodes to a file, converted to y4m and yuv for the metrics.
+# Returns tuple containing:
+#   (decode_timing, (yssim_score, rgb_ssim_score, msssim_score, psnrhvsm_score,
+#   vmaf_score))
+def get_file_scores(format_recipe, variables, width, height, origpng_y4m,
+                    origpng_yuv):
+    decode_timing, target_dec = decode_file(format_recipe, variables)
 
     if format_recipe['decode_extension'] == 'y4m':
         target_y4m = target_dec
@@ -294,40 +692,711 @@ def get_lossy_results(subset_name, origpng, width, height, format,
         target_yuv = path_for_file_in_tmp(target_dec) + ".yuv"
         convert_img(target_dec, target_yuv)
 
-    yssim_score = score_y_ssim(origpng_y4m, target_y4m)
-    rgb_ssim_score = score_rgb_ssim(origpng_y4m, target_y4m)
-    psnrhvsm_score = score_psnrhvsm(origpng_y4m, target_y4m)
-    msssim_score = score_msssim(origpng_y4m, target_y4m)
-    vmaf_score = score_vmaf(width, height, origpng_yuv, target_yuv)
+    if metric_engine == "numpy":
+        (yssim_score, rgb_ssim_score, msssim_score,
+         psnrhvsm_score) = score_y4m(origpng_y4m, target_y4m)
+    else:
+        with rd_trace.span("score_y_ssim"):
+            yssim_score = score_y_ssim(origpng_y4m, target_y4m)
+        with rd_trace.span("score_rgb_ssim"):
+            rgb_ssim_score = score_rgb_ssim(origpng_y4m, target_y4m)
+        with rd_trace.span("score_psnrhvsm"):
+            psnrhvsm_score = score_psnrhvsm(origpng_y4m, target_y4m)
+        with rd_trace.span("score_msssim"):
+            msssim_score = score_msssim(origpng_y4m, target_y4m)
+    with rd_trace.span("score_vmaf"):
+        vmaf_score = score_vmaf(width, height, origpng_yuv, target_yuv)
+
+    remove_files(*{target_yuv, target_y4m} - {target_dec})
+    release_decoded(target_dec, variables['target'])
+
+    return (decode_timing, (yssim_score, rgb_ssim_score, msssim_score,
+                            psnrhvsm_score, vmaf_score))
+
 
-    target_file_size = os.path.getsize(target)
+# Decodes to a pipe.
+# Returns tuple containing:
+#   (decode_timing, frame)
+# or None if the decoder output could not be used.
+def decode_streamed(format_recipe, variables, width, height):
+    import rd_metrics
+
+    cmd = string.Template(format_recipe['decode_cmd']).substitute(
+        variables, target_dec=format_recipe['decode_pipe_target'])
+    output = []
+
+    def decode():
+        output[:] = [run_capture(cmd)]
+
+    with rd_trace.span("decode"):
+        decode_timing = time_func(decode, lossy_warmup, lossy_repeat,
+                                  "decode")
+    returncode, data = output[0]
+    if returncode != 0 or not data:
+        return None
+
+    frame = None
+    if format_recipe['decode_extension'] == 'y4m':
+        try:
+            frame = rd_metrics.parse_y4m(data)[0]
+        except (ValueError, IndexError):
+            return None
+    if frame is None or frame[1].shape != ((height + 1) // 2,
+                                           (width + 1) // 2):
+        cmd = "%s -i pipe:0 -f yuv4mpegpipe -pix_fmt yuv420p pipe:1" % (
+            convert)
+        returncode, data = run_capture(cmd, data)
+        if returncode != 0:
+            return None
+        try:
+            frame = rd_metrics.parse_y4m(data)[0]
+        except (ValueError, IndexError):
+            return None
+
+    return (decode_timing, frame)
+
+
+# Scores a decoded frame held in memory.
+# Returns tuple containing:
+#   (yssim_score, rgb_ssim_score, msssim_score, psnrhvsm_score, vmaf_score)
+def score_frame(width, height, origpng_y4m, origpng_yuv, frame):
+    yuv = b"".join(plane.tobytes() for plane in frame)
+    if metric_engine == "numpy":
+        import rd_metrics
+
+        with rd_trace.span("score_numpy"):
+            scores = rd_metrics.score_frames(
+                rd_metrics.load_y4m(origpng_y4m)[0], frame)
+    else:
+        # The frame is in yuv420p, as the reference, and is handed to each
+        # tool under the header of the reference
+        with open(origpng_y4m, "rb") as y4m:
+            data = y4m.readline() + b"FRAME\n" + yuv
+        scores = []
+        for stage, score in (("score_y_ssim", score_y_ssim),
+                             ("score_rgb_ssim", score_rgb_ssim),
+                             ("score_msssim", score_msssim),
+                             ("score_psnrhvsm", score_psnrhvsm)):
+            with rd_trace.span(stage):
+                scores.append(with_fifo(stage, data, score, origpng_y4m))
+        scores = tuple(scores)
+    vmaf_score = score_vmaf_data(width, height, origpng_yuv, yuv)
+    return scores + (vmaf_score, )
+
+
+# Decodes to a pipe and scores the decoded image from memory.
+# Returns the same tuple as get_file_scores, or None if the decoder output
+# could not be used.
+def get_streamed_scores(format_recipe, variables, width, height, origpng_y4m,
+                        origpng_yuv):
+    streamed = decode_streamed(format_recipe, variables, width, height)
+    if streamed is None:
+        return None
+    decode_timing, frame = streamed
+    return (decode_timing,
+            score_frame(width, height, origpng_y4m, origpng_yuv, frame))
+
+
+def get_lossy_target(subset_name, origpng, format, format_recipe, quality):
+    return format.upper() + "_out/" + subset_name + "/" + os.path.splitext(
+        os.path.basename(origpng))[0] + "/" + os.path.splitext(
+            os.path.basename(origpng))[0] + "-q" + str(
+                quality) + "." + format_recipe['encode_extension']
 
+
+# Returns tuple containing:
+#   (target, target_file_size, encode_timing)
+def encode_lossy(subset_name, origpng, format, format_recipe, quality):
+    origpng_y4m = get_reference(origpng, "y4m")
+    origpng_yuv = get_reference(origpng, "yuv")
+    origpng_ppm = get_reference(origpng, "ppm")
+
+    target = get_lossy_target(subset_name, origpng, format, format_recipe,
+                              quality)
+    create_dir(target)
+
+    cmd = string.Template(format_recipe['encode_cmd']).substitute(locals())
+    encode_timing = run_encode(target, cmd, origpng, quality, lossy_warmup,
+                               lossy_repeat)
+
+    return (target, get_size(target), encode_timing)
+
+
+def no_stream(format):
+    sys.stderr.write(
+        "Could not stream the decoded image, using files for format %s\n" %
+        format)
+    unstreamable_formats.add(format)
+
+
+tool_versions = {}
+
+
+# Returns a list identifying the program run by a command: its path, size and
+# modification time.
+def tool_version(cmd):
+    program = split(cmd)[0]
+    if program not in tool_versions:
+        path = shutil.which(program)
+        if path is None:
+            tool_versions[program] = [program]
+        else:
+            stat = os.stat(path)
+            tool_versions[program] = [path, stat.st_size, stat.st_mtime]
+    return tool_versions[program]
+
+
+# Returns the hashes of the files of the vmaf model, keyed as the tools are,
+# by their name when they are missing
+def vmaf_model_version():
+    return [
+        get_file_hash(path) if os.path.isfile(path) else path
+        for path in (vmaf_model, vmaf_model + ".model")
+    ]
+
+
+def metric_cache_key(origpng, format, format_recipe, target):
+    import rd_metrics
+
+    if metric_engine == "numpy":
+        metrics = ["numpy", rd_metrics.version]
+    else:
+        metrics = [[cmd] + tool_version(cmd)
+                   for cmd in (yssim, rgbssim, msssim, psnrhvsm)]
+    return rd_cache.make_key(
+        get_file_hash(origpng), hash_file(target),
+        format_recipe['decode_cmd'], format_recipe['decode_extension'],
+        tool_version(format_recipe['decode_cmd']), tool_version(convert),
+        streamable(format, format_recipe), metrics,
+        [vmaf] + tool_version(vmaf) + vmaf_model_version(),
+        lossy_warmup, lossy_repeat, timing_fields)
+
+
+# Returns tuple containing:
+#   (key, results)
+# results being the cached results of score_lossy, or None.
+def get_cached_scores(origpng, format, format_recipe, target):
+    with rd_trace.span("metric_cache"):
+        if not metric_cache:
+            return (None, None)
+        key = metric_cache_key(origpng, format, format_recipe, target)
+        # metrics_only is meant to score again, the fresh scores replacing
+        # the cached ones, and a decoded image to keep is only made by
+        # decoding
+        if metrics_only or keep_decoded and not os.path.isfile(
+                decoded_path(target, format_recipe['decode_extension'])):
+            return (key, None)
+        return (key, rd_cache.lookup(key))
+
+
+# Variables of the decode_cmd of a recipe
+def get_decode_variables(subset_name, origpng, width, height, format, quality,
+                         target):
+    origpng_y4m = get_reference(origpng, "y4m")
+    origpng_yuv = get_reference(origpng, "yuv")
+    origpng_ppm = get_reference(origpng, "ppm")
+    target_dec = path_for_file_in_tmp(os.path.splitext(target)[0])
+    return dict(locals())
+
+
+def streamable(format, format_recipe):
+    return (stream_decode and not keep_decoded
+            and 'decode_pipe_target' in format_recipe
+            and format not in unstreamable_formats)
+
+
+# Returns tuple containing:
+#   (decode_timing, yssim_score, rgbssim_score, msssim_score, psnrhvsm_score,
+#   vmaf_score)
+def score_lossy(subset_name, origpng, width, height, format, format_recipe,
+                quality, target):
+    key, cached = get_cached_scores(origpng, format, format_recipe, target)
+    if cached is not None:
+        return cached
+
+    variables = get_decode_variables(subset_name, origpng, width, height,
+                                     format, quality, target)
+    origpng_y4m = variables['origpng_y4m']
+    origpng_yuv = variables['origpng_yuv']
+    scores = None
+    if streamable(format, format_recipe):
+        streamed = get_streamed_scores(format_recipe, variables, width,
+                                       height, origpng_y4m, origpng_yuv)
+        if streamed is None:
+            no_stream(format)
+        else:
+            decode_timing, scores = streamed
+
+    if scores is None:
+        decode_timing, scores = get_file_scores(format_recipe, variables,
+                                              width, height, origpng_y4m,
+                                              origpng_yuv)
+
+    if key is not None:
+        rd_cache.store(key, (decode_timing, ) + scores)
+    return (decode_timing, ) + scores
+
+
+# Returns tuple containing:
+#   (target_file_size, encode_timing, decode_timing, yssim_score, rgbssim_score,
+#   psnrhvsm_score, msssim_score)
+def get_lossy_results(subset_name, origpng, width, height, format,
+                      format_recipe, quality):
+    target, target_file_size, encode_timing = encode_lossy(
+        subset_name, origpng, format, format_recipe, quality)
+    scores = score_lossy(subset_name, origpng, width, height, format,
+                         format_recipe, quality, target)
+
+    return (target_file_size, encode_timing) + scores
+
+
+# Decodes an image of a batch, to a pipe if the recipe allows it, or to a
+# file otherwise.
+# Returns tuple containing:
+#   (decode_timing, frame)
+# the frame being in yuv420p, as the reference.
+def decode_frame(format, format_recipe, variables, width, height):
+    import rd_metrics
+
+    if streamable(format, format_recipe):
+        streamed = decode_streamed(format_recipe, variables, width, height)
+        if streamed is not None:
+            return streamed
+        no_stream(format)
+
+    decode_timing, target_dec = decode_file(format_recipe, variables)
+    frame = None
+    if format_recipe['decode_extension'] == 'y4m':
+        frame = rd_metrics.read_y4m(target_dec)[0]
+    if frame is None or frame[1].shape != ((height + 1) // 2,
+                                           (width + 1) // 2):
+        target_y4m = path_for_file_in_tmp(target_dec) + ".y4m"
+        if target_y4m == target_dec:
+            target_y4m = path_for_file_in_tmp(target_dec) + ".420.y4m"
+        convert_img(target_dec, target_y4m)
+        frame = rd_metrics.read_y4m(target_y4m)[0]
+        remove_files(target_y4m)
+    release_decoded(target_dec, variables['target'])
+    return (decode_timing, frame)
+
+
+# Writes frames to path.yuv, and to path.y4m under the given header unless it
+# is None.
+def write_batch(path, header, frames):
+    with open(path + ".yuv", "wb") as yuv:
+        for frame in frames:
+            for plane in frame:
+                yuv.write(plane.tobytes())
+    if header is not None:
+        with open(path + ".y4m", "wb") as y4m:
+            y4m.write(header)
+            for frame in frames:
+                y4m.write(b"FRAME\n")
+                for plane in frame:
+                    y4m.write(plane.tobytes())
+
+
+# Runs a metric program, exiting if it fails, and returns its output
+def run_metric(tool, cmd):
+    proc = subprocess.Popen(
+        split(cmd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8")
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        sys.stderr.write("Failed process: %s\n" % (tool))
+        sys.exit(proc.returncode)
+    return out.split(os.linesep)
+
+
+# Runs a daala metric program on count frames. Returns the score of each
+# frame, read from the "<frame>: <score>" lines printed before the total, or
+# the total for a single frame, or None if the program did not print a score
+# per frame.
+def score_batch_tool(stage, tool, y4m1, y4m2, count):
+    with rd_trace.span(stage):
+        lines = run_metric(tool, "%s %s %s" % (tool, y4m1, y4m2))
+    if count == 1:
+        return [
+            float(re.search(r'(?<=Total: )\d+\.?\d*', lines[-2]).group(0))
+        ]
+    scores = []
+    for line in lines:
+        match = re.match(r'\s*\d+:\s+(\S+)', line)
+        if match:
+            scores.append(float(match.group(1)))
+    return scores if len(scores) == count else None
+
+
+# Same as score_batch_tool for vmafossexec, whose scores per frame are read
+# from its JSON log.
+def score_vmaf_batch(width, height, yuv1, yuv2, count):
+    if count == 1:
+        with rd_trace.span("score_vmaf"):
+            return [score_vmaf(width, height, yuv1, yuv2)]
+
+    log = yuv2 + ".json"
+    cmd = "%s %s %s %s %s %s --log %s --log-fmt json" % (
+        vmaf, width, height, yuv1, yuv2, vmaf_model, log)
+    with rd_trace.span("score_vmaf"):
+        run_metric(vmaf, cmd)
     try:
-        os.remove(origpng_yuv)
-        os.remove(origpng_y4m)
-        os.remove(origpng_ppm)
-        os.remove(target_dec)
-        os.remove(target_yuv)
-        os.remove(target_y4m)
-    except FileNotFoundError:
-        pass
+        with open(log) as json_file:
+            scores = [
+                float(frame["metrics"]["vmaf"])
+                for frame in json.load(json_file)["frames"]
+            ]
+    except (OSError, ValueError, KeyError, TypeError):
+        scores = []
+    remove_files(log)
+    return scores if len(scores) == count else None
+
+
+# Scores the decoded frames of a batch against the reference.
+# Returns a list of tuples containing, for each frame:
+#   (yssim_score, rgb_ssim_score, msssim_score, psnrhvsm_score, vmaf_score)
+def score_batch(width, height, origpng_y4m, frames):
+    import rd_metrics
+
+    reference = rd_metrics.load_y4m(origpng_y4m)[0]
+    header = None
+    if metric_engine != "numpy":
+        with open(origpng_y4m, "rb") as y4m:
+            header = y4m.readline()
+
+    path = tmpdir + str(os.getpid()) + "-batch"
+    write_batch(path + "-ref", header, [reference] * len(frames))
+    write_batch(path + "-dis", header, frames)
+    try:
+        if metric_engine == "numpy":
+            with rd_trace.span("score_numpy"):
+                columns = [
+                    list(scores) for scores in zip(*[
+                        rd_metrics.score_frames(reference, frame)
+                        for frame in frames
+                    ])
+                ]
+        else:
+            columns = [
+                score_batch_tool(stage, tool, path + "-ref.y4m",
+                                 path + "-dis.y4m", len(frames))
+                for stage, tool in (("score_y_ssim", yssim),
+                                    ("score_rgb_ssim", rgbssim),
+                                    ("score_msssim", msssim),
+                                    ("score_psnrhvsm", psnrhvsm))
+            ]
+        columns.append(
+            score_vmaf_batch(width, height, path + "-ref.yuv",
+                             path + "-dis.yuv", len(frames)))
+    finally:
+        remove_files(path + "-ref.yuv", path + "-ref.y4m", path + "-dis.yuv",
+                     path + "-dis.y4m")
+
+    if None in columns:
+        sys.stderr.write(
+            "Could not read the scores of each frame, scoring them one at a time\n"
+        )
+        return [
+            score_batch(width, height, origpng_y4m, [frame])[0]
+            for frame in frames
+        ]
+    return list(zip(*columns))
+
+
+# Runs the quality points of an image, scoring them metric_batch at a time.
+# encoded holds the (target, target_file_size, encode_timing) of the quality
+# points already encoded, which are only scored.
+# Returns the results of each quality point, as returned by
+# get_lossy_results.
+def get_batch_results(subset_name, origpng, width, height, format,
+                      format_recipe, qualities, encoded=None):
+    origpng_y4m = get_reference(origpng, "y4m")
+    encoded = dict(encoded or {})
+    results = {}
+    # (quality, key, target_file_size, encode_timing, decode_timing, frame)
+    # of the quality points decoded and not scored yet
+    batch = []
+
+    def score():
+        with rd_trace.tagged(quality=[point[0] for point in batch]):
+            scores = score_batch(width, height, origpng_y4m,
+                                 [point[5] for point in batch])
+        for point, point_scores in zip(batch, scores):
+            [quality, key, target_file_size, encode_timing, decode_timing,
+             frame] = point
+            if key is not None:
+                rd_cache.store(key, (decode_timing, ) + point_scores)
+            results[quality] = (target_file_size, encode_timing,
+                                decode_timing) + point_scores
+        del batch[:]
+
+    for quality in qualities:
+        with rd_trace.tagged(quality=quality):
+            if quality not in encoded:
+                print("Processing image {}, quality {}".format(
+                    os.path.basename(origpng), quality))
+                encoded[quality] = encode_lossy(subset_name, origpng, format,
+                                                format_recipe, quality)
+            target, target_file_size, encode_timing = encoded[quality]
+            key, cached = get_cached_scores(origpng, format, format_recipe,
+                                            target)
+            if cached is not None:
+                results[quality] = (target_file_size, encode_timing) + cached
+                continue
+
+            variables = get_decode_variables(subset_name, origpng, width,
+                                             height, format, quality, target)
+            decode_timing, frame = decode_frame(format, format_recipe,
+                                                variables, width, height)
+        batch.append((quality, key, target_file_size, encode_timing,
+                      decode_timing, frame))
+        if len(batch) == metric_batch:
+            score()
+    if batch:
+        score()
+
+    return [results[quality] for quality in qualities]
+
+
+# Runs func in the default executor of the running loop, in the context of
+# the caller, so that its spans keep the tags of the quality point
+def run_in_executor(func, *args):
+    import asyncio
+
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, context.run, func,
+                                                      *args)
+
+
+async def run_silent_async(cmd):
+    import asyncio
+
+    proc = await asyncio.create_subprocess_exec(
+        *split(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rv = await proc.wait()
+    if rv != 0:
+        sys.stderr.write("Failure from subprocess:\n")
+        sys.stderr.write("\t" + cmd + "\n")
+        sys.stderr.write("Aborting!\n")
+        sys.exit(rv)
+    return rv
 
-    return (target_file_size, encode_time, decode_time, yssim_score,
-            rgb_ssim_score, msssim_score, psnrhvsm_score, vmaf_score)
 
+async def convert_img_async(inn, out):
+    with rd_trace.span("convert"):
+        cmd = "%s -y -i %s -pix_fmt yuv420p %s" % (convert, inn, out)
+        await run_silent_async(cmd)
 
-def process_image(args):
-    [format, format_recipe, subset_name, origpng] = args
 
-    result_file = "results/" + subset_name + "/" + format + "/lossy/" + \
-        os.path.splitext(os.path.basename(origpng))[0] + "." + format + ".out"
-    if os.path.isfile(result_file) and not os.stat(result_file).st_size == 0:
-        return
+# Runs a metric program, which prints its score on its last line, traced as
+# the given stage
+async def score_async(stage, tool, args, pattern):
+    import asyncio
+
+    cmd = " ".join([tool] + [str(arg) for arg in args])
+    with rd_trace.span(stage):
+        proc = await asyncio.create_subprocess_exec(
+            *split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = await proc.communicate()
+    if proc.returncode != 0:
+        sys.stderr.write("Failed process: %s\n" % (tool))
+        sys.exit(proc.returncode)
+    lines = out.decode("utf-8").split(os.linesep)
+    return float(re.search(pattern, lines[-2]).group(0))
+
+
+# Same as the end of get_file_scores, with every conversion and metric run
+# at once.
+async def score_file_async(format_recipe, target, target_dec, width, height,
+                           origpng_y4m, origpng_yuv):
+    import asyncio
+
+    conversions = []
+    if format_recipe['decode_extension'] == 'y4m':
+        target_y4m = target_dec
+    else:
+        target_y4m = path_for_file_in_tmp(target_dec) + ".y4m"
+        conversions.append(convert_img_async(target_dec, target_y4m))
 
+    if format_recipe['decode_extension'] == 'yuv':
+        target_yuv = target_dec
+    else:
+        target_yuv = path_for_file_in_tmp(target_dec) + ".yuv"
+        conversions.append(convert_img_async(target_dec, target_yuv))
+    await asyncio.gather(*conversions)
+
+    total = r'(?<=Total: )\d+\.?\d*'
+    if metric_engine == "numpy":
+        metrics = [run_in_executor(score_y4m, origpng_y4m, target_y4m)]
+    else:
+        metrics = [
+            score_async("score_y_ssim", yssim, (origpng_y4m, target_y4m),
+                        total),
+            score_async("score_rgb_ssim", rgbssim, (origpng_y4m, target_y4m),
+                        total),
+            score_async("score_msssim", msssim, (origpng_y4m, target_y4m),
+                        total),
+            score_async("score_psnrhvsm", psnrhvsm,
+                        (origpng_y4m, target_y4m), total)
+        ]
+    metrics.append(
+        score_async("score_vmaf", vmaf,
+                    (width, height, origpng_yuv, target_yuv, vmaf_model),
+                    r'(?<=VMAF score = )\d+\.?\d*'))
+    scores = await asyncio.gather(*metrics)
+    if metric_engine == "numpy":
+        scores = tuple(scores[0]) + (scores[1], )
+
+    remove_files(*{target_yuv, target_y4m} - {target_dec})
+    release_decoded(target_dec, target)
+
+    return tuple(scores)
+
+
+# Runs the quality points of an image through the pipeline. encoded holds
+# the (target, target_file_size, encode_timing) of the quality points
+# already encoded, which are only scored.
+# Returns the results of each quality point, as returned by
+# get_lossy_results.
+async def run_pipeline(subset_name, origpng, width, height, format,
+                       format_recipe, qualities, encoded=None):
+    import asyncio
+
+    # Held by encodes and decodes, so that they are timed one at a time
+    timed = asyncio.Lock()
+    # Bounds the number of decoded images in the temporary directory
+    in_flight = asyncio.Semaphore(pipeline_depth)
+    encoded = dict(encoded or {})
+
+    async def run_quality(quality):
+        # Each quality point runs in its own asyncio task, whose spans are
+        # tagged with its quality
+        with rd_trace.tagged(quality=quality):
+            return await run_point(quality)
+
+    async def run_point(quality):
+        async with in_flight:
+            if quality not in encoded:
+                async with timed:
+                    print("Processing image {}, quality {}".format(
+                        os.path.basename(origpng), quality))
+                    encoded[quality] = await run_in_executor(
+                        encode_lossy, subset_name, origpng, format,
+                        format_recipe, quality)
+            target, target_file_size, encode_timing = encoded[quality]
+            # The cache and the references are read and written in the
+            # executor, not to hold up the stages of the other quality points
+            key, cached = await run_in_executor(get_cached_scores, origpng,
+                                                format, format_recipe, target)
+            if cached is not None:
+                return (target_file_size, encode_timing) + cached
+
+            variables = await run_in_executor(get_decode_variables,
+                                              subset_name, origpng, width,
+                                              height, format, quality, target)
+            origpng_y4m = variables['origpng_y4m']
+            origpng_yuv = variables['origpng_yuv']
+            streamed = None
+            async with timed:
+                if streamable(format, format_recipe):
+                    streamed = await run_in_executor(
+                        decode_streamed, format_recipe, variables, width,
+                        height)
+                    if streamed is None:
+                        no_stream(format)
+                if streamed is None:
+                    decode_timing, target_dec = await run_in_executor(
+                        decode_file, format_recipe, variables)
+
+            if streamed is None:
+                scores = await score_file_async(format_recipe, target,
+                                                target_dec, width, height,
+                                                origpng_y4m, origpng_yuv)
+            else:
+                decode_timing, frame = streamed
+                scores = await run_in_executor(score_frame, width, height,
+                                               origpng_y4m, origpng_yuv, frame)
+
+            if key is not None:
+                await run_in_executor(rd_cache.store, key,
+                                      (decode_timing, ) + scores)
+            return (target_file_size, encode_timing, decode_timing) + scores
+
+    return await asyncio.gather(
+        *(run_quality(quality) for quality in qualities))
+
+
+# Returns the qualities giving the target numbers of bits per pixel, found by
+# bisection over the quality range of the recipe. encode(quality) returns the
+# size of the image encoded at this quality, and is called at most once per
+# quality, the measures being shared by all the targets.
+def find_target_qualities(encode, quality_list, targets, pixels):
+    if isinstance(quality_list[0], float):
+        low, high = quality_list[0], quality_list[-1]
+
+        def quality_at(position):
+            return round(float(position), 4)
+
+        def middle(low, high):
+            return (low + high) / 2
+    else:
+        low, high = 0, len(quality_list) - 1
+
+        def quality_at(position):
+            return quality_list[position]
+
+        def middle(low, high):
+            return (low + high) // 2
+
+    sizes = {}
+
+    def bpp(position):
+        quality = quality_at(position)
+        if quality not in sizes:
+            sizes[quality] = encode(quality)
+        return sizes[quality] * 8 / pixels
+
+    increasing = bpp(high) >= bpp(low)
+    measured = {low: bpp(low), high: bpp(high)}
+
+    qualities = []
+    for target in targets:
+        # Start from the tightest interval around the target among the
+        # qualities already measured.
+        lower, upper = low, high
+        for position in measured:
+            if (measured[position] < target) == increasing:
+                lower = max(lower, position)
+            else:
+                upper = min(upper, position)
+
+        for i in range(bisect_max_steps):
+            closest = min(measured,
+                          key=lambda position: abs(measured[position] - target))
+            if abs(measured[closest] - target) <= bpp_tolerance * target:
+                break
+            position = middle(lower, upper)
+            if position in (lower, upper) or lower > upper:
+                break
+            measured[position] = bpp(position)
+            if (measured[position] < target) == increasing:
+                lower = position
+            else:
+                upper = position
+
+        closest = min(measured,
+                      key=lambda position: abs(measured[position] - target))
+        qualities.append(quality_at(closest))
+    return qualities
+
+
+def get_quality_list(format_recipe):
+    import numpy as np
 
     try:
         isfloat = isinstance(format_recipe['quality_start'], float) or isinstance(format_recipe['quality_end'], float) or isinstance(format_recipe['quality_step'], float)
-        
+
         if isfloat:
             start = float(format_recipe['quality_start'])
             end = float(format_recipe['quality_end'])
@@ -338,7 +1407,7 @@ def process_image(args):
             step = int(format_recipe['quality_step'])
     except ValueError:
         print('There was an error parsing the format recipe.')
-        return
+        return None
 
     if (not 'encode_extension' in format_recipe
             or not 'decode_extension' in format_recipe
@@ -346,102 +1415,750 @@ def process_image(args):
             or not 'lossless_cmd' in format_recipe
             or not 'decode_cmd' in format_recipe):
         print('There was an error parsing the format recipe.')
-        return
+        return None
 
-    orig_file_size = os.path.getsize(origpng)
-    width = get_img_width(origpng)
-    height = get_img_height(origpng)
-    pixels = width * height
+    if isfloat:
+        return list(np.arange(start, end, step))
+    else:
+        return list(range(start, end, step))
 
-    # Lossless
-    print("Processing image {}, quality lossless".format(
-        os.path.basename(origpng)))
 
-    path = "results/" + subset_name + "/" + format + "/lossless/" + os.path.splitext(
+def lossless_result_path(subset_name, format, origpng):
+    return "results/" + subset_name + "/" + format + "/lossless/" + os.path.splitext(
         os.path.basename(origpng))[0] + "." + format + ".out"
-    create_dir(path)
-    file = open(path, "w")
-
-    file.write(
-        "file_name:orig_file_size:compressed_file_size:pixels:bpp:compression_ratio:encode_time:decode_time\n"
-    )
 
-    results = get_lossless_results(subset_name, origpng, format, format_recipe)
-    bpp = results[0] * 8 / pixels
-    compression_ratio = orig_file_size / results[0]
-    file.write("%s:%d:%d:%d:%f:%f:%f:%f\n" %
-               (os.path.splitext(os.path.basename(origpng))[0], orig_file_size,
-                results[0], pixels, bpp, compression_ratio, results[1],
-                results[2]))
 
-    file.close()
-
-    # Lossy
-    path = "results/" + subset_name + "/" + format + "/lossy/" + os.path.splitext(
+def lossy_result_path(subset_name, format, origpng):
+    return "results/" + subset_name + "/" + format + "/lossy/" + os.path.splitext(
         os.path.basename(origpng))[0] + "." + format + ".out"
-    create_dir(path)
-    file = open(path, "w")
 
-    file.write(
-        "file_name:quality:orig_file_size:compressed_file_size:pixels:bpp:compression_ratio:encode_time:decode_time:y_ssim_score:rgb_ssim_score:msssim_score:psnrhvsm_score:vmaf_score\n"
-    )
-    if isfloat:
-        quality_list = list(np.arange(start, end, step))
-    else:
-        quality_list = list(range(start, end, step))
 
-    i = 0
-    while i < len(quality_list):
-        quality = quality_list[i]
+def get_lossy_row(origpng, width, height, quality, results):
+    orig_file_size = os.path.getsize(origpng)
+    pixels = width * height
+    bpp = results[0] * 8 / pixels
+    compression_ratio = orig_file_size / results[0]
+    return ((os.path.splitext(os.path.basename(origpng))[0], quality,
+             orig_file_size, results[0], pixels, bpp, compression_ratio,
+             results[1][0], results[2][0], results[3], results[4],
+             results[5], results[6], results[7]) + results[1][1:4] +
+            results[2][1:4] + (results[1][4], results[2][4]))
+
+
+# A task is the unit of work handed to a worker: the lossless pass of an
+# image (quality is None), a single lossy quality point, the search of the
+# qualities matching a list of target bpp (quality is that list), or the
+# quality points of an image run through the pipeline (quality is a dict
+# holding them under "qualities").
+# Returns tuple containing:
+#   (format, origpng, quality, rows)
+def process_task(args):
+    import asyncio
+
+    [format, format_recipe, subset_name, origpng, width, height,
+     quality] = args
+    rd_trace.set_tags(
+        format=format, image=os.path.basename(origpng), quality=quality)
+    del encoded_targets[:]
+    del encode_records[:]
+
+    if quality is None:
+        print("Processing image {}, quality lossless".format(
+            os.path.basename(origpng)))
+        results = get_lossless_results(subset_name, origpng, format,
+                                       format_recipe)
+        orig_file_size = os.path.getsize(origpng)
+        pixels = width * height
+        bpp = results[0] * 8 / pixels
+        compression_ratio = orig_file_size / results[0]
+        rows = [(os.path.splitext(os.path.basename(origpng))[0],
+                 orig_file_size, results[0], pixels, bpp, compression_ratio,
+                 results[1][0], results[2][0]) + results[1][1:4] +
+                results[2][1:4] + (results[1][4], results[2][4])]
+    elif isinstance(quality, list):
+        encoded = {}
+
+        def encode(quality):
+            print("Processing image {}, quality {}".format(
+                os.path.basename(origpng), quality))
+            with rd_trace.tagged(quality=quality):
+                encoded[quality] = encode_lossy(subset_name, origpng, format,
+                                                format_recipe, quality)
+            return encoded[quality][1]
+
+        qualities = find_target_qualities(encode,
+                                          get_quality_list(format_recipe),
+                                          quality, width * height)
+        scores = {}
+        if metric_batch > 0:
+            unique_qualities = sorted(set(qualities))
+            results = get_batch_results(subset_name, origpng, width, height,
+                                        format, format_recipe,
+                                        unique_qualities, encoded)
+            for target_quality, result in zip(unique_qualities, results):
+                scores[target_quality] = result[2:]
+        elif pipeline_depth > 0:
+            unique_qualities = sorted(set(qualities))
+            results = asyncio.run(
+                run_pipeline(subset_name, origpng, width, height, format,
+                             format_recipe, unique_qualities, encoded))
+            for target_quality, result in zip(unique_qualities, results):
+                scores[target_quality] = result[2:]
+        rows = []
+        for target_quality in qualities:
+            target, target_file_size, encode_timing = encoded[
+                target_quality]
+            if target_quality not in scores:
+                with rd_trace.tagged(quality=target_quality):
+                    scores[target_quality] = score_lossy(
+                        subset_name, origpng, width, height, format,
+                        format_recipe, target_quality, target)
+            rows.append(
+                get_lossy_row(origpng, width, height, target_quality,
+                              (target_file_size, encode_timing) +
+                              scores[target_quality]))
+    elif isinstance(quality, dict):
+        if metric_batch > 0:
+            results = get_batch_results(subset_name, origpng, width, height,
+                                        format, format_recipe,
+                                        quality["qualities"])
+        else:
+            results = asyncio.run(
+                run_pipeline(subset_name, origpng, width, height, format,
+                             format_recipe, quality["qualities"]))
+        rows = [
+            get_lossy_row(origpng, width, height, point, result)
+            for point, result in zip(quality["qualities"], results)
+        ]
+    else:
         print("Processing image {}, quality {}".format(
             os.path.basename(origpng), quality))
         results = get_lossy_results(subset_name, origpng, width, height,
                                     format, format_recipe, quality)
-        bpp = results[0] * 8 / pixels
-        compression_ratio = orig_file_size / results[0]
-        file.write("%s:%f:%d:%d:%d:%f:%f:%f:%f:%f:%f:%f:%f:%f\n" %
-                   (os.path.splitext(os.path.basename(origpng))[0], quality,
-                    orig_file_size, results[0], pixels, bpp, compression_ratio,
-                    results[1], results[2], results[3], results[4], results[5],
-                    results[6], results[7]))
-        i += 1
+        rows = [get_lossy_row(origpng, width, height, quality, results)]
+
+    rd_trace.flush()
+    return (format, origpng, quality, rows)
+
 
+# Results files are written under a temporary name then renamed, so that a
+# results file which exists is always complete.
+def open_atomic(path):
+    create_dir(path)
+    return open(path + ".tmp", "w")
+
+
+def close_atomic(file, path):
+    file.flush()
+    os.fsync(file.fileno())
     file.close()
+    os.replace(path + ".tmp", path)
 
 
-def main(argv):
-    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
-        raise Exception("Python 3.5 or a more recent version is required.")
+def write_lossless_results(subset_name, format, origpng, row):
+    path = lossless_result_path(subset_name, format, origpng)
+    file = open_atomic(path)
+
+    file.write(":".join(name for name, type in rd_store.lossless_columns) +
+               "\n")
+    file.write("%s:%d:%d:%d:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f\n" % row)
+
+    close_atomic(file, path)
+
 
-    data = {}
+def write_lossy_results(subset_name, format, origpng, rows):
+    path = lossy_result_path(subset_name, format, origpng)
+    file = open_atomic(path)
+
+    file.write(":".join(name for name, type in rd_store.lossy_columns) +
+               "\n")
+    for row in sorted(rows, key=lambda row: row[1]):
+        file.write(
+            "%s:%f:%d:%d:%d:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f\n"
+            % row)
+
+    close_atomic(file, path)
+
+
+# Every finished task is appended to the journal of its subset and format,
+# so that an interrupted run only computes the missing tasks when started
+# again. The quality points of a task running several of them are journaled
+# one by one, under the keys of the tasks of a single quality point, so that
+# a run resumes the points done with or without --pipeline or
+# --batch-metrics.
+def journal_path(subset_name, format):
+    return "results/" + subset_name + "/" + format + "/journal.jsonl"
+
+
+# A metrics_only run keeps its own journal, which replaces the journal of
+# the subset and format once the run is complete.
+def rescore_journal_path(subset_name, format):
+    return "results/" + subset_name + "/" + format + "/rescore.jsonl"
+
+
+def current_journal_path(subset_name, format):
+    if metrics_only:
+        return rescore_journal_path(subset_name, format)
+    return journal_path(subset_name, format)
+
+
+def journal_key(origpng, quality):
+    if isinstance(quality, list):
+        quality = [float(target) for target in quality]
+    elif isinstance(quality, dict):
+        quality = {
+            "qualities": [
+                float(point) if isinstance(point, float) else point
+                for point in quality["qualities"]
+            ]
+        }
+    elif isinstance(quality, float):
+        quality = float(quality)
+    return (os.path.basename(origpng), json.dumps(quality))
+
+
+# Returns the qualities under which the rows of a task are journaled: the
+# quality points of a task running several of them, or its own quality.
+def journal_points(quality):
+    if isinstance(quality, dict):
+        return quality["qualities"]
+    return [quality]
+
+
+# Returns the list of (quality, rows) journaled for the rows of a task, one
+# per quality point
+def journal_records(quality, rows):
+    if isinstance(quality, dict):
+        return [(point, [row])
+                for point, row in zip(quality["qualities"], rows)]
+    return [(quality, rows)]
+
+
+# Returns a dict of the rows of each finished task
+# Rows journaled by older versions lack the columns added since at the end,
+# which are NaN
+def journal_row(quality, row):
+    columns = (rd_store.lossless_columns
+               if quality is None else rd_store.lossy_columns)
+    return tuple(row) + (float("nan"), ) * (len(columns) - len(row))
+
+
+def read_journal(path):
+    entries = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last record cut short by a crash
+                    continue
+                # Tasks of several quality points were journaled as a single
+                # record by older versions
+                for point, rows in journal_records(record["quality"],
+                                                   record["rows"]):
+                    entries[journal_key(record["image"], point)] = [
+                        journal_row(point, row) for row in rows
+                    ]
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def append_journal(file, origpng, quality, rows):
+    for point, point_rows in journal_records(quality, rows):
+        image, point = journal_key(origpng, point)
+        file.write(
+            json.dumps({
+                "image": image,
+                "quality": json.loads(point),
+                "rows": point_rows
+            }) + "\n")
+    file.flush()
+    os.fsync(file.fileno())
+
+
+stores = {}
+
+
+def get_store(subset_name):
+    if subset_name not in stores:
+        stores[subset_name] = rd_store.open_store(
+            rd_store.store_path("results/" + subset_name))
+    return stores[subset_name]
+
+
+def image_done(subset_name, format, origpng):
+    if rd_store.has_image(
+            get_store(subset_name), "lossy", format,
+            os.path.splitext(os.path.basename(origpng))[0]):
+        return True
+    result_file = lossy_result_path(subset_name, format, origpng)
+    return os.path.isfile(result_file) and not os.stat(
+        result_file).st_size == 0
+
+
+# Lossless timing runs the encoder and the decoder five times, so it weighs
+# more than a single lossy quality point.
+lossless_cost = 5
+
+
+# Parsed recipes, with the modification time of their file, so that a
+# process serving several runs (rd.py daemon) only parses it when it changed
+recipes_cache = {}
+
+
+def read_recipes(path="recipes.json"):
     try:
-        with open('recipes.json') as json_file:
-            data = json.load(json_file)
+        mtime = os.stat(path).st_mtime_ns
     except FileNotFoundError:
         raise Exception("Could not find recipes.json")
+    key = os.path.abspath(path)
+    if key not in recipes_cache or recipes_cache[key][0] != mtime:
+        with open(path) as json_file:
+            recipes_cache[key] = (mtime, json.load(json_file))
+    return recipes_cache[key][1]
+
+
+def get_tasks(format, format_recipe, subset_name, origpngs, targets=None):
+    quality_list = get_quality_list(format_recipe)
+    if quality_list is None:
+        return []
+
+    if targets is None:
+        targets = format_recipe.get('target_bpp')
+
+    if not metrics_only:
+        origpngs = [
+            origpng for origpng in origpngs
+            if not image_done(subset_name, format, origpng)
+        ]
+    infos = rd_probe.get_image_infos(origpngs)
+
+    tasks = []
+    for origpng in origpngs:
+        width = infos[origpng]["width"]
+        height = infos[origpng]["height"]
+        pixels = infos[origpng]["pixels"]
+
+        tasks.append((pixels * lossless_cost,
+                      (format, format_recipe, subset_name, origpng, width,
+                       height, None)))
+        if targets:
+            # About three encodes per target, and a single long task
+            tasks.append((pixels * len(targets) * 3,
+                          (format, format_recipe, subset_name, origpng,
+                           width, height, sorted(targets))))
+            continue
+
+        if pipeline_depth > 0 or metric_batch > 0:
+            tasks.append((pixels * len(quality_list),
+                          (format, format_recipe, subset_name, origpng,
+                           width, height, {
+                               "qualities": quality_list
+                           })))
+            continue
+
+        for quality in quality_list:
+            tasks.append((pixels, (format, format_recipe, subset_name,
+                                   origpng, width, height, quality)))
+
+    # Longest tasks first, so that the large images do not end up running
+    # alone at the end of the sweep. The sort is stable, which keeps the
+    # quality points of an image next to each other.
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [task[1] for task in tasks]
+
+
+# Collects the results of the tasks in the main process: journals them, and
+# writes the results of an image once all its tasks are done. Tasks found in
+# the journals are done straight away and left out of remaining_tasks.
+class TaskResults:
+    def __init__(self, tasks):
+        # Number of lossy points journaled for each image
+        self.pending = {}
+        self.subsets = {}
+        for task in tasks:
+            [format, format_recipe, subset_name, origpng, width, height,
+             quality] = task
+            self.subsets[(format, origpng)] = subset_name
+            if quality is not None:
+                self.pending[(format, origpng)] = self.pending.get(
+                    (format, origpng), 0) + len(journal_points(quality))
+
+        journals = {}
+        for format, subset_name in set((task[0], task[2]) for task in tasks):
+            path = current_journal_path(subset_name, format)
+            journals[(format, subset_name)] = read_journal(path)
+
+        self.lossy_rows = {}
+        self.done = {}
+
+        self.remaining_tasks = []
+        for task in tasks:
+            [format, format_recipe, subset_name, origpng, width, height,
+             quality] = task
+            journal = journals[(format, subset_name)]
+            missing = []
+            for point in journal_points(quality):
+                key = journal_key(origpng, point)
+                if key in journal:
+                    self.task_done(format, origpng, point, journal[key])
+                else:
+                    missing.append(point)
+            if len(missing) == len(journal_points(quality)):
+                self.remaining_tasks.append(task)
+            elif missing:
+                # Only the points left of a task of several points
+                self.remaining_tasks.append(
+                    task[:6] + ({"qualities": missing}, ))
+
+        self.journal_files = {}
+        for format, subset_name in journals:
+            path = current_journal_path(subset_name, format)
+            create_dir(path)
+            file = open(path, "a+")
+            # Do not append to the end of a record cut short by a crash
+            if file.tell() > 0:
+                file.seek(file.tell() - 1)
+                if file.read(1) != "\n":
+                    file.write("\n")
+            self.journal_files[(format, subset_name)] = file
+
+    def task_done(self, format, origpng, quality, rows):
+        key = (format, origpng)
+        store = get_store(self.subsets[key])
+        if quality is None:
+            rd_store.write_lossless(store, format, rows[0])
+            if out_files:
+                write_lossless_results(self.subsets[key], format, origpng,
+                                       rows[0])
+            return
+
+        self.lossy_rows.setdefault(key, []).extend(rows)
+        self.done[key] = self.done.get(key, 0) + len(journal_points(quality))
+        if self.done[key] == self.pending[key]:
+            rows = self.lossy_rows.pop(key)
+            rd_store.write_lossy(store, format, rows)
+            if out_files:
+                write_lossy_results(self.subsets[key], format, origpng, rows)
+
+    def add(self, format, origpng, quality, rows):
+        with rd_trace.span("write_results"):
+            append_journal(
+                self.journal_files[(format, self.subsets[(format, origpng)])],
+                origpng, quality, rows)
+            self.task_done(format, origpng, quality, rows)
+
+    def close(self):
+        for file in self.journal_files.values():
+            file.close()
+
+    # Called once every task is done
+    def finish(self):
+        self.close()
+        if metrics_only:
+            for format, subset_name in self.journal_files:
+                os.replace(
+                    rescore_journal_path(subset_name, format),
+                    journal_path(subset_name, format))
+
+
+# Runs a task in a worker.
+# Returns tuple containing:
+#   (format, origpng, quality, rows, usage)
+# usage being the stage_usage of the task.
+def run_task(args):
+    stage_usage.clear()
+    return process_task(args) + (dict(stage_usage), )
+
+
+def read_resources():
+    try:
+        with open(resources_file) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_resources(resources):
+    create_dir(resources_file)
+    with open(resources_file + ".tmp", "w") as json_file:
+        json.dump(resources, json_file, indent=4)
+    os.replace(resources_file + ".tmp", resources_file)
+
+
+def megapixels(pixels):
+    return max(1.0, pixels / 1e6)
+
+
+# Returns the resources learned for a format, which are forgotten when the
+# commands of its recipe change.
+def learned_resources(resources, format, format_recipe):
+    learned = resources.get(format, {})
+    commands = [
+        format_recipe['encode_cmd'], format_recipe['lossless_cmd'],
+        format_recipe['decode_cmd']
+    ]
+    if learned.get("commands") != commands:
+        return {"commands": commands}
+    return learned
+
+
+# Updates the resources learned for a format with the usage of a task on an
+# image of the given pixels, returning True if they changed.
+def learn_resources(resources, format, format_recipe, pixels, usage):
+    learned = learned_resources(resources, format, format_recipe)
+    changed = learned is not resources.get(format)
+    for stage, (threads, maxrss) in usage.items():
+        for key, value in ((stage + "_threads", min(threads, cores)),
+                           (stage + "_memory",
+                            round(maxrss / 1024 / megapixels(pixels), 1))):
+            if value > learned.get(key, 0):
+                learned[key] = value
+                changed = True
+    resources[format] = learned
+    return changed
+
 
+# Returns tuple containing:
+#   (threads, memory)
+# the resources needed by a task, memory being in MB.
+def task_resources(task, resources):
+    [format, format_recipe, subset_name, origpng, width, height,
+     quality] = task
+    learned = learned_resources(resources, format, format_recipe)
+
+    def get(key, default):
+        return format_recipe.get(key, learned.get(key, default))
+
+    threads = max(
+        get("encode_threads", default_threads),
+        get("decode_threads", default_threads))
+    if isinstance(quality, dict):
+        # The metrics of up to pipeline_depth quality points run alongside
+        # the encodes and decodes, the ones of a batch one program at a time
+        if metric_batch > 0:
+            threads += 1
+        else:
+            threads += metric_processes * min(pipeline_depth,
+                                              len(quality["qualities"]))
+    memory = (max(
+        get("encode_memory", default_memory),
+        get("decode_memory", default_memory)) + metric_memory) * megapixels(
+            width * height)
+    return (threads, memory)
+
+
+def run_tasks(tasks, jobs):
+    results = TaskResults(tasks)
+    # Not to be written again by the workers
+    rd_trace.flush()
+
+    resources = read_resources()
+    recipes = {}
+    pixels = {}
+    for task in results.remaining_tasks:
+        [format, format_recipe, subset_name, origpng, width, height,
+         quality] = task
+        recipes[format] = format_recipe
+        pixels[(format, origpng)] = width * height
+
+    # Returns the tasks grouped by the resources they need, each group in the
+    # order of the tasks, longest first
+    def group(tasks):
+        groups = collections.OrderedDict()
+        for position, task in sorted(tasks, key=lambda item: item[0]):
+            groups.setdefault(task_resources(task, resources),
+                              collections.deque()).append((position, task))
+        return groups
+
+    waiting = group(enumerate(results.remaining_tasks))
+
+    running = 0
+    used_threads = 0
+    used_memory = 0
+
+    # Returns the first remaining task which fits in the resources left, or
+    # any task if none is running, with the resources it needs.
+    def next_task():
+        best = None
+        for needs, group in waiting.items():
+            if running > 0 and (used_threads + needs[0] > cores
+                                or used_memory + needs[1] > memory_budget):
+                continue
+            if best is None or group[0][0] < waiting[best][0][0]:
+                best = needs
+        if best is None:
+            return None
+        position, task = waiting[best].popleft()
+        if not waiting[best]:
+            del waiting[best]
+        return (task, best)
+
+    pool = Pool(processes=jobs)
+    done = queue.Queue()
+    while waiting or running > 0:
+        while running < jobs:
+            item = next_task()
+            if item is None:
+                break
+            task, needs = item
+            running += 1
+            used_threads += needs[0]
+            used_memory += needs[1]
+            pool.apply_async(
+                run_task, (task, ),
+                callback=lambda result, needs=needs: done.put((needs, result)),
+                error_callback=lambda error: done.put((None, error)))
+
+        needs, result = done.get()
+        if needs is None:
+            pool.terminate()
+            raise result
+        running -= 1
+        used_threads -= needs[0]
+        used_memory -= needs[1]
+        format, origpng, quality, rows, usage = result
+        results.add(format, origpng, quality, rows)
+        if learn_resources(resources, format, recipes[format],
+                           pixels[(format, origpng)], usage):
+            write_resources(resources)
+            # The tasks left are packed with what was just learned
+            waiting = group(item for items in waiting.values()
+                            for item in items)
+    pool.close()
+    pool.join()
+
+    results.finish()
+
+
+def process_image(args):
+    [format, format_recipe, subset_name, origpng] = args
+
+    tasks = get_tasks(format, format_recipe, subset_name, [origpng])
+    run_tasks(tasks, 1)
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    data = read_recipes()
     supported_formats = list(data['recipes'].keys())
 
-    if len(argv) != 4:
+    global bpp_tolerance, lossless_warmup, lossless_repeat, lossy_warmup
+    global lossy_repeat, out_files, pipeline_depth, metrics_only, keep_decoded
+    global metric_batch, cores, memory_budget
+
+    # Read at each run, as the daemon of rd.py imports this module once
+    cores = os.cpu_count()
+    memory_budget = os.sysconf("SC_PHYS_PAGES") * os.sysconf(
+        "SC_PAGE_SIZE") // 2**20
+
+    jobs = 1
+    targets = None
+    trace_file = None
+    try:
+        opts, args = getopt.gnu_getopt(
+            argv[1:], "j:", [
+                "jobs=", "target-bpp=", "bpp-tolerance=", "warmup=",
+                "repeat=", "out-files", "pipeline=", "metrics-only",
+                "keep-decoded", "trace=", "batch-metrics=", "cores=",
+                "memory="
+            ])
+        for opt, value in opts:
+            if opt in ("-j", "--jobs"):
+                jobs = int(value)
+            elif opt == "--target-bpp":
+                targets = [float(target) for target in value.split(",")]
+            elif opt == "--bpp-tolerance":
+                bpp_tolerance = float(value)
+            elif opt == "--warmup":
+                lossless_warmup = lossy_warmup = int(value)
+            elif opt == "--repeat":
+                lossless_repeat = lossy_repeat = int(value)
+            elif opt == "--out-files":
+                out_files = True
+            elif opt == "--pipeline":
+                pipeline_depth = int(value)
+            elif opt == "--metrics-only":
+                metrics_only = True
+            elif opt == "--keep-decoded":
+                keep_decoded = True
+            elif opt == "--trace":
+                trace_file = value
+            elif opt == "--batch-metrics":
+                metric_batch = int(value)
+            elif opt == "--cores":
+                cores = int(value)
+            elif opt == "--memory":
+                memory_budget = int(value)
+    except (getopt.GetoptError, ValueError):
+        args = []
+
+    if (len(args) != 3 or jobs < 1 or lossy_repeat < 1 or pipeline_depth < 0
+            or metric_batch < 0 or (pipeline_depth > 0 and metric_batch > 0)
+            or cores < 1 or memory_budget < 1):
         print(
             "rd_collect.py: Generate compressed images from PNGs and calculate quality and speed metrics for a given format"
         )
         print("Arg 1: format to test {}".format(supported_formats))
         print("Arg 2: name of the subset to test (e.g. 'subset1')")
         print("Arg 3: path to the subset to test (e.g. 'subset1/')")
+        print("Option -j N, --jobs N: number of worker processes (default 1)")
+        print(
+            "Option --target-bpp LIST: comma-separated bits per pixel to reach instead of the quality range (e.g. '0.1,0.25,0.5,1')"
+        )
+        print(
+            "Option --bpp-tolerance T: relative tolerance on the target bpp (default {})".
+            format(bpp_tolerance))
+        print(
+            "Option --warmup N: untimed runs before timing an encode or a decode (default 0)"
+        )
+        print(
+            "Option --repeat N: timed runs of each encode and decode (default 5 for lossless, 1 for lossy)"
+        )
+        print(
+            "Option --out-files: also write a results file per image, besides results/<subset>/<subset>.sqlite"
+        )
+        print(
+            "Option --pipeline N: run the quality points of an image as one task, scoring up to N of them while encoding the next ones (default 0, off)"
+        )
+        print(
+            "Option --metrics-only: score again the images already done, encoding only the ones whose source, command or encoder changed"
+        )
+        print(
+            "Option --keep-decoded: keep the decoded images in <FORMAT>_decoded/ for rd_select.py"
+        )
+        print(
+            "Option --batch-metrics N: run the quality points of an image as one task, running each metric program once for up to N of them (default 0, off; not with --pipeline)"
+        )
+        print(
+            "Option --cores N: run at once only the tasks whose encoder and decoder threads fit in N cores (default: number of CPUs)"
+        )
+        print(
+            "Option --memory MB: run at once only the tasks whose memory fits in MB (default: physical memory)"
+        )
+        print(
+            "Option --trace FILE: write a Chrome trace of the stages of every task to FILE, and print the time spent in each stage"
+        )
         return
 
-    format = argv[1]
-    subset_name = argv[2]
+    format = args[0]
+    subset_name = args[1]
     if format not in supported_formats:
         print("Image format not supported. Supported formats are: {}.".format(
             supported_formats))
         return
 
-    pool = Pool(processes=1)
-    pool.map(process_image, [(format, data['recipes'][format], subset_name,
-                                origpng)
-                               for origpng in glob.glob(argv[3] + "/*.png")])
+    if trace_file is not None:
+        rd_trace.enable(trace_file + ".d")
+    tasks = get_tasks(format, data['recipes'][format], subset_name,
+                      glob.glob(args[2] + "/*.png"), targets)
+    run_tasks(tasks, jobs)
+    if trace_file is not None:
+        rd_trace.write_trace(trace_file)
 
 
 if __name__ == "__main__":
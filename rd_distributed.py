@@ -0,0 +1,670 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import base64
+import getopt
+import socket
+import threading
+import socketserver
+import collections
+from multiprocessing import Process
+import rd_collect
+
+# A coordinator hands out the tasks of rd_collect.py (lossless pass, quality
+# point or target bpp search of an image) to workers running on other hosts,
+# and gathers their results and encoded files into its results tree.
+#
+# Transports:
+#  - tcp:HOST:PORT, the coordinator listens on a TCP port, and sends the
+#    original images to the workers which do not have them.
+#  - dir:PATH, the coordinator and the workers share a directory, on a
+#    shared filesystem which must also hold the original images.
+
+# Seconds after which a task leased to a worker which stopped renewing it is
+# handed to another worker
+lease_timeout = 600
+# Number of times a task is handed out before giving up on it
+max_attempts = 3
+# Seconds between two polls of the coordinator or of the shared directory
+poll_interval = 2
+# Number of tasks waiting in the shared directory for a worker, refilled as
+# they are taken, so that the coordinator and the workers list and stat a
+# few files per poll. About twice the number of workers.
+dir_window = 16
+
+# Path to tmp dir where the workers keep the original images sent to them
+tmpdir = "/tmp/"
+
+#############################################################################
+
+
+def task_key(task):
+    return (task[0], ) + rd_collect.journal_key(task[3], task[6])
+
+
+# Files may only be uploaded to the encoded images directories
+def check_upload_path(path):
+    parts = os.path.normpath(path).split(os.sep)
+    return (not os.path.isabs(path) and ".." not in parts and len(parts) > 1
+            and parts[0].endswith("_out"))
+
+
+def encode_files(paths):
+    files = {}
+    for path in paths:
+        with open(path, "rb") as file:
+            files[path] = base64.b64encode(file.read()).decode("ascii")
+    return files
+
+
+def write_files(files):
+    for path, data in files.items():
+        if not check_upload_path(path):
+            sys.stderr.write("Refusing upload of {}\n".format(path))
+            continue
+        rd_collect.create_dir(path)
+        with open(path + ".tmp", "wb") as file:
+            file.write(base64.b64decode(data))
+        os.replace(path + ".tmp", path)
+
+
+# Adds the manifest records of the encoded images uploaded by a worker to the
+# manifests of the coordinator, so that rd_collect.py --metrics-only does not
+# encode them again
+def write_manifest(records):
+    for record in records:
+        if not check_upload_path(record["target"]):
+            sys.stderr.write("Refusing manifest record of {}\n".format(
+                record["target"]))
+            continue
+        try:
+            rd_collect.append_manifest(record)
+        except FileNotFoundError:
+            pass
+
+
+# Lease table of the tasks, shared by the transports
+class Coordinator:
+    def __init__(self, results):
+        self.results = results
+        self.queue = collections.deque(
+            json.loads(json.dumps(results.remaining_tasks)))
+        self.sources = set(os.path.abspath(task[3]) for task in self.queue)
+        self.remaining = len(self.queue)
+        self.leases = {}
+        self.lease_tasks = {}
+        self.attempts = {}
+        self.completed = set()
+        # Tasks given up on after max_attempts leases
+        self.failed = []
+        self.completions = queue.Queue()
+        # Lease ids are the token of the run followed by a counter, so that
+        # the results of the leases of an earlier run, sent by its workers or
+        # left in the shared directory, are never taken for the ones of this
+        # run
+        self.run = os.urandom(4).hex()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    # Returns tuple containing:
+    #   (lease_id, task)
+    # or None if no task is available for now.
+    def lease(self):
+        with self.lock:
+            while self.queue:
+                task = self.queue.popleft()
+                if task_key(task) in self.completed:
+                    continue
+                self.next_id += 1
+                lease_id = "{}-{}".format(self.run, self.next_id)
+                self.leases[lease_id] = time.time() + lease_timeout
+                self.lease_tasks[lease_id] = task
+                key = task_key(task)
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                return (lease_id, task)
+            return None
+
+    def renew(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                return False
+            self.leases[lease_id] = time.time() + lease_timeout
+            return True
+
+    def is_leased(self, lease_id):
+        with self.lock:
+            return lease_id in self.leases
+
+    # Completions are queued, and recorded by the main thread with
+    # process_completions. A completion is refused unless key, the task_key
+    # of the task the worker ran, is the one of the task of the lease.
+    def complete(self, lease_id, key, rows, files, manifest):
+        with self.lock:
+            if (lease_id not in self.lease_tasks or tuple(key) != task_key(
+                    self.lease_tasks[lease_id])):
+                return False
+            self.leases.pop(lease_id, None)
+        self.completions.put((lease_id, rows, files, manifest))
+        return True
+
+    def process_completions(self, timeout=0):
+        try:
+            lease_id, rows, files, manifest = self.completions.get(
+                timeout=timeout)
+        except queue.Empty:
+            return
+        with self.lock:
+            task = self.lease_tasks.pop(lease_id)
+            key = task_key(task)
+            if key in self.completed:
+                # Finished by another worker after a lease timeout
+                return
+            self.completed.add(key)
+            self.remaining -= 1
+
+        write_files(files)
+        write_manifest(manifest)
+        self.results.add(task[0], task[3], task[6],
+                         [tuple(row) for row in rows])
+        print("Task done: format {}, image {}, quality {} ({} remaining)".
+              format(task[0], os.path.basename(task[3]), task[6],
+                     self.remaining))
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for lease_id, deadline in list(self.leases.items()):
+                if deadline > now:
+                    continue
+                del self.leases[lease_id]
+                task = self.lease_tasks.pop(lease_id)
+                key = task_key(task)
+                if key in self.completed:
+                    continue
+                if self.attempts[key] < max_attempts:
+                    print("Lease {} expired, handing the task out again".
+                          format(lease_id))
+                    self.queue.appendleft(task)
+                else:
+                    print("Giving up on format {}, image {}, quality {}".
+                          format(task[0], os.path.basename(task[3]),
+                                 task[6]))
+                    self.completed.add(key)
+                    self.failed.append(task)
+                    self.remaining -= 1
+
+    def finished(self):
+        with self.lock:
+            return self.remaining == 0
+
+    def read_source(self, path):
+        if os.path.abspath(path) not in self.sources:
+            return None
+        with open(path, "rb") as file:
+            return base64.b64encode(file.read()).decode("ascii")
+
+
+#############################################################################
+# TCP transport
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coordinator = self.server.coordinator
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        op = request.get("op")
+        if op == "lease":
+            leased = coordinator.lease()
+            if leased is not None:
+                response = {
+                    "lease": leased[0],
+                    "task": leased[1],
+                    "timeout": lease_timeout
+                }
+            elif coordinator.finished():
+                response = {"done": True}
+            else:
+                response = {"wait": poll_interval}
+        elif op == "renew":
+            response = {"ok": coordinator.renew(request["lease"])}
+        elif op == "complete":
+            response = {
+                "ok":
+                coordinator.complete(request["lease"], request["key"],
+                                     request["rows"], request["files"],
+                                     request["manifest"])
+            }
+        elif op == "fetch":
+            response = {"data": coordinator.read_source(request["path"])}
+        else:
+            response = {"error": "unknown operation"}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class TcpTransport:
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+
+    def serve(self, coordinator):
+        server = CoordinatorServer(self.address, CoordinatorHandler)
+        server.coordinator = coordinator
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print("Coordinator listening on {}:{}".format(*self.address))
+
+        while not coordinator.finished():
+            coordinator.process_completions(poll_interval)
+            coordinator.expire()
+
+        # Leave the workers time to learn that there is nothing left to do
+        time.sleep(poll_interval * 2)
+        server.shutdown()
+        server.server_close()
+
+    def request(self, message):
+        with socket.create_connection(self.address) as conn:
+            conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data.decode("utf-8"))
+
+    def lease(self):
+        response = self.request({"op": "lease"})
+        if response.get("done"):
+            return "done"
+        if "lease" not in response:
+            return None
+        return (response["lease"], response["task"],
+                response.get("timeout", lease_timeout))
+
+    def renew(self, lease_id):
+        return self.request({"op": "renew", "lease": lease_id})["ok"]
+
+    def complete(self, lease_id, key, rows, files, manifest):
+        self.request({
+            "op": "complete",
+            "lease": lease_id,
+            "key": key,
+            "rows": rows,
+            "files": files,
+            "manifest": manifest
+        })
+
+    def fetch(self, path):
+        data = self.request({"op": "fetch", "path": path})["data"]
+        if data is None:
+            return None
+        return base64.b64decode(data)
+
+
+#############################################################################
+# Shared directory transport
+#
+# The coordinator writes the tasks to PATH/tasks/, a worker takes one by
+# moving it to PATH/leased/, touches it while working on it and writes the
+# results to PATH/done/. The files left by an earlier run are removed when the
+# coordinator starts.
+
+
+def write_json_atomic(path, data):
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+class DirTransport:
+    def __init__(self, path):
+        self.path = os.path.normpath(path) + "/"
+        self.worker = socket.gethostname() + "." + str(os.getpid())
+
+    def task_file(self, state, lease_id):
+        return self.path + state + "/" + str(lease_id) + ".json"
+
+    def serve(self, coordinator):
+        for state in ("tasks", "leased", "done"):
+            os.makedirs(self.path + state, exist_ok=True)
+            for path in glob.glob(self.path + state + "/*"):
+                os.remove(path)
+        try:
+            os.remove(self.path + "finished")
+        except FileNotFoundError:
+            pass
+
+        # Tasks written to the directory and not done yet, waiting for a
+        # worker or taken by one
+        published = set()
+        while not coordinator.finished():
+            waiting = 0
+            for lease_id in list(published):
+                queued = self.task_file("tasks", lease_id)
+                leased = self.task_file("leased", lease_id)
+                try:
+                    if os.path.isfile(queued):
+                        waiting += 1
+                        coordinator.renew(lease_id)
+                    elif (time.time() - os.stat(leased).st_mtime <
+                          lease_timeout):
+                        coordinator.renew(lease_id)
+                except FileNotFoundError:
+                    pass
+                if not coordinator.is_leased(lease_id):
+                    for path in (queued, leased):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    published.discard(lease_id)
+
+            while waiting < dir_window:
+                leased = coordinator.lease()
+                if leased is None:
+                    break
+                lease_id, task = leased
+                task = list(task)
+                task[3] = os.path.abspath(task[3])
+                write_json_atomic(
+                    self.task_file("tasks", lease_id), {
+                        "lease": lease_id,
+                        "task": task,
+                        "timeout": lease_timeout
+                    })
+                published.add(lease_id)
+                waiting += 1
+
+            for path in glob.glob(self.path + "done/*.json"):
+                with open(path) as file:
+                    done = json.load(file)
+                os.remove(path)
+                coordinator.complete(done["lease"], done["key"], done["rows"],
+                                     done["files"], done["manifest"])
+                published.discard(done["lease"])
+                try:
+                    os.remove(self.task_file("leased", done["lease"]))
+                except FileNotFoundError:
+                    pass
+
+            coordinator.expire()
+            coordinator.process_completions(poll_interval)
+            while not coordinator.completions.empty():
+                coordinator.process_completions()
+
+        with open(self.path + "finished", "w"):
+            pass
+
+    def lease(self):
+        if os.path.isfile(self.path + "finished"):
+            return "done"
+        # Lower lease numbers first, as the coordinator hands out the
+        # longest tasks first
+        paths = sorted(
+            glob.glob(self.path + "tasks/*.json"),
+            key=lambda path: int(
+                os.path.basename(path).split(".")[0].rsplit("-", 1)[-1]))
+        for path in paths:
+            leased = self.path + "leased/" + os.path.basename(path)
+            try:
+                os.rename(path, leased)
+            except FileNotFoundError:
+                # Taken by another worker
+                continue
+            with open(leased) as file:
+                entry = json.load(file)
+            return (entry["lease"], entry["task"],
+                    entry.get("timeout", lease_timeout))
+        return None
+
+    def renew(self, lease_id):
+        try:
+            os.utime(self.task_file("leased", lease_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, lease_id, key, rows, files, manifest):
+        write_json_atomic(
+            self.path + "done/" + str(lease_id) + "." + self.worker +
+            ".json", {
+                "lease": lease_id,
+                "key": key,
+                "rows": rows,
+                "files": files,
+                "manifest": manifest
+            })
+
+    def fetch(self, path):
+        return None
+
+
+def get_transport(address):
+    if address.startswith("tcp:"):
+        return TcpTransport(address[len("tcp:"):])
+    if address.startswith("dir:"):
+        return DirTransport(address[len("dir:"):])
+    raise ValueError("Unknown transport {}".format(address))
+
+
+#############################################################################
+# Worker
+
+
+def get_source(transport, path, subset_name):
+    if os.path.isfile(path):
+        return path
+    local_path = tmpdir + "rd_sources/" + subset_name + "/" + os.path.basename(
+        path)
+    if not os.path.isfile(local_path):
+        data = transport.fetch(path)
+        if data is None:
+            raise FileNotFoundError(path)
+        rd_collect.create_dir(local_path)
+        with open(local_path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(local_path + ".tmp", local_path)
+    return local_path
+
+
+# Renews a lease three times per timeout, the one of the coordinator which
+# handed it out
+def renew_lease(transport, lease_id, timeout, stop):
+    while not stop.wait(timeout / 3):
+        try:
+            transport.renew(lease_id)
+        except OSError:
+            pass
+
+
+# Returns tuple containing:
+#   (rows, files, manifest)
+# with files the encoded images of the task, and manifest their records in
+# the manifest of the worker.
+def run_task(transport, task):
+    [format, format_recipe, subset_name, origpng, width, height,
+     quality] = task
+    local_task = list(task)
+    local_task[3] = get_source(transport, origpng, subset_name)
+    format, local_origpng, quality, rows = rd_collect.process_task(local_task)
+    return (rows, encode_files(sorted(set(rd_collect.encoded_targets))),
+            list(rd_collect.encode_records))
+
+
+# Sends the results of a task, retrying while the coordinator cannot be
+# reached. If they never reach it, the lease expires and the task is handed
+# out again.
+def send_results(transport, lease_id, timeout, key, rows, files, manifest):
+    failures = 0
+    while True:
+        try:
+            transport.complete(lease_id, key, rows, files, manifest)
+            return
+        except (OSError, ValueError):
+            failures += 1
+            if failures * poll_interval > timeout:
+                print("Could not send the results of lease {}".format(
+                    lease_id))
+                return
+            time.sleep(poll_interval)
+
+
+def run_worker(address):
+    transport = get_transport(address)
+    # Wait for the coordinator to start, for a while
+    failures = 0
+    while True:
+        try:
+            leased = transport.lease()
+            failures = 0
+        except OSError:
+            failures += 1
+            if failures * poll_interval > lease_timeout:
+                print("Could not reach the coordinator at {}".format(address))
+                return
+            time.sleep(poll_interval)
+            continue
+
+        if leased == "done":
+            return
+        if leased is None:
+            time.sleep(poll_interval)
+            continue
+
+        lease_id, task, timeout = leased
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=renew_lease, args=(transport, lease_id, timeout, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            rows, files, manifest = run_task(transport, task)
+            send_results(transport, lease_id, timeout, task_key(task), rows,
+                         files, manifest)
+        finally:
+            stop.set()
+            thread.join()
+
+
+#############################################################################
+
+
+def usage():
+    print(
+        "rd_distributed.py: Run rd_collect.py tasks on several hosts")
+    print("rd_distributed.py coordinator ADDRESS FORMATS SUBSET_NAME SUBSET_PATH")
+    print("    ADDRESS: tcp:HOST:PORT or dir:PATH to a shared directory")
+    print("    FORMATS: comma-separated list of formats to test")
+    print("    SUBSET_NAME: name of the subset to test (e.g. 'subset1')")
+    print("    SUBSET_PATH: path to the subset to test (e.g. 'subset1/')")
+    print("rd_distributed.py worker ADDRESS")
+    print("Option -j N, --jobs N: number of worker processes (default 1)")
+    print("Option --lease-timeout S: seconds before handing out again the task of a silent worker (default {})".format(lease_timeout))
+    print("Option --window N: tasks waiting for a worker in the directory of dir: (default {})".format(dir_window))
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    global lease_timeout, dir_window
+
+    jobs = 1
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "j:",
+                                       ["jobs=", "lease-timeout=", "window="])
+        for opt, value in opts:
+            if opt in ("-j", "--jobs"):
+                jobs = int(value)
+            elif opt == "--lease-timeout":
+                lease_timeout = float(value)
+            elif opt == "--window":
+                dir_window = int(value)
+    except (getopt.GetoptError, ValueError):
+        args = []
+
+    if len(args) == 2 and args[0] == "worker":
+        workers = [
+            Process(target=run_worker, args=(args[1], )) for i in range(jobs)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return
+
+    if len(args) != 5 or args[0] != "coordinator":
+        usage()
+        return
+
+    data = rd_collect.read_recipes()
+
+    address, formats, subset_name, subset_path = args[1:]
+    tasks = []
+    for format in formats.split(","):
+        if format not in data['recipes']:
+            print("Image format {} not supported. Supported formats are: {}.".
+                  format(format, list(data['recipes'].keys())))
+            return
+        tasks += rd_collect.get_tasks(format, data['recipes'][format],
+                                      subset_name,
+                                      glob.glob(subset_path + "/*.png"))
+
+    results = rd_collect.TaskResults(tasks)
+    coordinator = Coordinator(results)
+    get_transport(address).serve(coordinator)
+    results.finish()
+
+    # The results of the images of the tasks given up on are not written,
+    # and their tasks are handed out again by the next run
+    if coordinator.failed:
+        print("Gave up on tasks of these images, whose results are missing:")
+        for format, image in sorted(
+                set((task[0], os.path.basename(task[3]))
+                    for task in coordinator.failed)):
+            print("    format {}, image {}".format(format, image))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import functools
+import numpy as np
+
+# In-process implementation of the metrics computed by the daala tools
+# dump_ssim, dump_msssim and dump_psnrhvs, working on 8 bits y4m frames.
+
+# Scores are reported in dB and capped to this value for identical images
+max_db = 100.0
+
+# Changed whenever a change alters the scores, so that the scores cached by
+# rd_cache.py are computed again
+version = 4
+
+# Multi-scale SSIM weights from Wang, Simoncelli and Bovik
+msssim_weights = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+# Contrast sensitivity of the luma DCT coefficients in dump_psnrhvs, which
+# are not the ones of N. Ponomarenko's reference implementation, and the
+# masking table daala derives from it
+csf_y = np.array(
+    [[1.6193873005, 2.2901594831, 2.08509755623, 1.48366094411, 1.00227514334, 0.678296995242, 0.466224900598, 0.3265091542],
+     [2.2901594831, 1.94321815382, 2.04793073064, 1.68731108984, 1.2305666963, 0.868920337363, 0.61280991668, 0.436405793551],
+     [2.08509755623, 2.04793073064, 1.34329019223, 1.09205635862, 0.875748795257, 0.670882927016, 0.501731932449, 0.372504254596],
+     [1.48366094411, 1.68731108984, 1.09205635862, 0.772819797575, 0.605636379554, 0.48309405692, 0.380429446972, 0.295774038565],
+     [1.00227514334, 1.2305666963, 0.875748795257, 0.605636379554, 0.448996256676, 0.352889268808, 0.283006984131, 0.226951348204],
+     [0.678296995242, 0.868920337363, 0.670882927016, 0.48309405692, 0.352889268808, 0.27032073436, 0.215017739696, 0.17408067321],
+     [0.466224900598, 0.61280991668, 0.501731932449, 0.380429446972, 0.283006984131, 0.215017739696, 0.168869545842, 0.136153931001],
+     [0.3265091542, 0.436405793551, 0.372504254596, 0.295774038565, 0.226951348204, 0.17408067321, 0.136153931001, 0.109083846276]])
+mask_y = (csf_y * 0.3885746225901003)**2
+psnrhvs_step = 7
+
+#############################################################################
+
+
+def parse_y4m(data):
+    header_end = data.index(b"\n")
+    params = data[:header_end].split(b" ")
+    if params[0] != b"YUV4MPEG2":
+        raise ValueError("Not a y4m stream")
+
+    width = height = None
+    chroma = "420"
+    for param in params[1:]:
+        if param.startswith(b"W"):
+            width = int(param[1:])
+        elif param.startswith(b"H"):
+            height = int(param[1:])
+        elif param.startswith(b"C"):
+            chroma = param[1:].decode()
+
+    if chroma.startswith("420"):
+        chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+    elif chroma.startswith("422"):
+        chroma_width, chroma_height = (width + 1) // 2, height
+    elif chroma.startswith("444"):
+        chroma_width, chroma_height = width, height
+    elif chroma.startswith("mono"):
+        chroma_width, chroma_height = 0, 0
+    else:
+        raise ValueError("Unsupported y4m chroma format %s" % chroma)
+
+    luma_size = width * height
+    chroma_size = chroma_width * chroma_height
+    frames = []
+    pos = header_end + 1
+    while pos < len(data):
+        pos = data.index(b"\n", pos) + 1
+        planes = np.frombuffer(
+            data, dtype=np.uint8, count=luma_size + 2 * chroma_size,
+            offset=pos)
+        y = planes[:luma_size].reshape(height, width)
+        u = planes[luma_size:luma_size + chroma_size].reshape(
+            chroma_height, chroma_width)
+        v = planes[luma_size + chroma_size:].reshape(chroma_height,
+                                                     chroma_width)
+        frames.append((y, u, v))
+        pos += luma_size + 2 * chroma_size
+    return frames
+
+
+def read_y4m(path):
+    with open(path, "rb") as file:
+        return parse_y4m(file.read())
+
+
+# Reference frames are kept around, as they are scored against every
+# quality of every format.
+@functools.lru_cache(maxsize=8)
+def read_cached_y4m(path, mtime, size):
+    return read_y4m(path)
+
+
+def load_y4m(path):
+    stat = os.stat(path)
+    return read_cached_y4m(path, stat.st_mtime, stat.st_size)
+
+
+def to_db(score):
+    return min(max_db, -10 * np.log10(max(1 - score, 10**(-max_db / 10))))
+
+
+def gaussian_window(size=11, sigma=1.5):
+    x = np.arange(size) - (size - 1) / 2
+    window = np.exp(-x**2 / (2 * sigma**2))
+    return window / np.sum(window)
+
+
+# Filters every pixel of the image, as the daala tools do, the window being
+# clipped at the borders and its weights normalized to the pixels left.
+def filter_clipped(img, window):
+    n = len(window)
+    rows, cols = img.shape
+    padded = np.pad(img, n // 2)
+    norm = np.pad(np.ones_like(img), n // 2)
+    tmp = sum(window[i] * padded[i:i + rows, :] for i in range(n))
+    tmp_norm = sum(window[i] * norm[i:i + rows, :] for i in range(n))
+    return (sum(window[i] * tmp[:, i:i + cols] for i in range(n)) /
+            sum(window[i] * tmp_norm[:, i:i + cols] for i in range(n)))
+
+
+# Returns tuple containing the means of the luminance and contrast-structure
+# terms of SSIM over the image:
+#   (ssim, cs)
+def ssim_terms(img1, img2):
+    c1 = (0.01 * 255)**2
+    c2 = (0.03 * 255)**2
+    window = gaussian_window()
+    mu1 = filter_clipped(img1, window)
+    mu2 = filter_clipped(img2, window)
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = filter_clipped(img1 * img1, window) - mu1_sq
+    sigma2_sq = filter_clipped(img2 * img2, window) - mu2_sq
+    sigma12 = filter_clipped(img1 * img2, window) - mu1_mu2
+    cs = (2 * sigma12 + c2) / (sigma1_sq + sigma2_sq + c2)
+    ssim = (2 * mu1_mu2 + c1) / (mu1_sq + mu2_sq + c1) * cs
+    return (np.mean(ssim), np.mean(cs))
+
+
+def ssim(img1, img2):
+    if not img1.size:
+        raise ValueError("Cannot compute the SSIM of an empty image")
+    return ssim_terms(img1, img2)[0]
+
+
+def msssim(img1, img2):
+    if min(img1.shape) < 2**(len(msssim_weights) - 1):
+        raise ValueError("Image of %dx%d too small for %d MS-SSIM scales" %
+                         (img1.shape[1], img1.shape[0], len(msssim_weights)))
+
+    mcs = []
+    for level in range(len(msssim_weights)):
+        level_ssim, level_cs = ssim_terms(img1, img2)
+        mcs.append(level_cs)
+        rows = img1.shape[0] // 2 * 2
+        cols = img1.shape[1] // 2 * 2
+        img1 = img1[:rows, :cols].reshape(rows // 2, 2, cols // 2, 2).mean(
+            axis=(1, 3))
+        img2 = img2[:rows, :cols].reshape(rows // 2, 2, cols // 2, 2).mean(
+            axis=(1, 3))
+
+    weights = np.array(msssim_weights)
+    values = np.array(mcs[:-1] + [level_ssim])
+    return np.prod(np.maximum(values, 0)**weights)
+
+
+def dct_matrix(n=8):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+    matrix[0, :] = np.sqrt(1 / n)
+    return matrix
+
+
+# Orthonormal DCT of 8x8 blocks, rounded to integers after each pass as the
+# integer transform of daala, od_bin_fdct8x8, which it approximates to
+# within one per coefficient
+def integer_dct(blocks):
+    matrix = dct_matrix()
+    return np.round(matrix @ np.round(blocks @ matrix.T))
+
+
+def block_masking(blocks, dct):
+    ac_mask = mask_y.copy()
+    ac_mask[0, 0] = 0
+    energy = np.sum(dct**2 * ac_mask, axis=(-2, -1))
+
+    def variance(b):
+        return np.sum((b - b.mean(axis=(-2, -1), keepdims=True))**2,
+                      axis=(-2, -1))
+
+    # Unbiased variances, as daala normalizes them by 64 / 63 for the block
+    # and 16 / 15 for its 4x4 quarters
+    total = variance(blocks) * 64 / 63
+    sub = (variance(blocks[..., :4, :4]) + variance(blocks[..., :4, 4:]) +
+           variance(blocks[..., 4:, 4:]) +
+           variance(blocks[..., 4:, :4])) * 16 / 15
+    pop = np.divide(sub, total, out=np.zeros_like(total), where=total != 0)
+    return np.sqrt(energy * pop) / 32
+
+
+def psnrhvsm(img1, img2):
+    if min(img1.shape) < 8:
+        mse = np.mean((img1 - img2)**2)
+    else:
+        view = np.lib.stride_tricks.sliding_window_view
+        blocks1 = view(img1, (8, 8))[::psnrhvs_step, ::psnrhvs_step]
+        blocks2 = view(img2, (8, 8))[::psnrhvs_step, ::psnrhvs_step]
+        dct1 = integer_dct(blocks1)
+        dct2 = integer_dct(blocks2)
+        mask = np.maximum(
+            block_masking(blocks1, dct1), block_masking(blocks2, dct2))
+
+        threshold = mask[..., None, None] / mask_y
+        diff = np.abs(dct1 - dct2)
+        masked = np.maximum(diff - threshold, 0)
+        masked[..., 0, 0] = diff[..., 0, 0]
+        mse = np.mean((masked * csf_y)**2)
+    if mse == 0:
+        return max_db
+    return min(max_db, 10 * np.log10(255 * 255 / mse))
+
+
+# Returns tuple containing:
+#   (yssim_score, rgb_ssim_score, msssim_score, psnrhvsm_score)
+# for two (Y', Cb, Cr) frames. rgb_ssim_score matches dump_ssim run without
+# -y, which weights Y', Cb and Cr with 0.8, 0.1 and 0.1.
+def score_frames(frame1, frame2):
+    planes1 = [plane.astype(np.float64) for plane in frame1]
+    planes2 = [plane.astype(np.float64) for plane in frame2]
+
+    y_ssim = ssim(planes1[0], planes2[0])
+    if planes1[1].size:
+        rgb_ssim = 0.8 * y_ssim + 0.1 * (ssim(planes1[1], planes2[1]) +
+                                         ssim(planes1[2], planes2[2]))
+    else:
+        rgb_ssim = y_ssim
+
+    return (to_db(y_ssim), to_db(rgb_ssim),
+            to_db(msssim(planes1[0], planes2[0])),
+            psnrhvsm(planes1[0], planes2[0]))
+
+
+# Scores the first frame of each y4m file
+def score_y4m(y4m1, y4m2):
+    return score_frames(load_y4m(y4m1)[0], read_y4m(y4m2)[0])
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) != 3:
+        print(
+            "rd_metrics.py: Compare the in-process metrics with the ones of dump_ssim, dump_msssim and dump_psnrhvs"
+        )
+        print("Arg 1: reference y4m file")
+        print("Arg 2: distorted y4m file")
+        return
+
+    import rd_collect
+
+    names = ["y_ssim_score", "rgb_ssim_score", "msssim_score",
+             "psnrhvsm_score"]
+    scores = score_y4m(argv[1], argv[2])
+    tools = [
+        rd_collect.score_y_ssim, rd_collect.score_rgb_ssim,
+        rd_collect.score_msssim, rd_collect.score_psnrhvsm
+    ]
+    print("metric:in_process:external:difference")
+    for name, score, tool in zip(names, scores, tools):
+        external = tool(argv[1], argv[2])
+        print("%s:%f:%f:%f" % (name, score, external, score - external))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -31,160 +31,189 @@
 import os
 import sys
 import glob
-import numpy as np
-import pandas as pd
-import matplotlib
-matplotlib.use('Cairo')
-import matplotlib.pyplot as plt
+import json
+import hashlib
+from multiprocessing import Pool
+import rd_store
 
+# Charts drawn from the lossy averages of a subset, one SVG file each, named
+# <subset>.<name>.(<formats>).svg, plotting column against avg_bpp.
+charts = [{
+    "name": "y-ssim",
+    "column": "wavg_y_ssim_score",
+    "title":
+    "Quality according to Y-SSIM in function of number of bits per pixel",
+    "xlabel": "Bits per pixels",
+    "ylabel": "dB (Y-SSIM)",
+    "ylim": [10, 20]
+}, {
+    "name": "rgb-ssim",
+    "column": "wavg_rgb_ssim_score",
+    "title":
+    "Quality according to RGB-SSIM in function of number of bits per pixel",
+    "xlabel": "Bits per pixels",
+    "ylabel": "dB (RGB-SSIM)",
+    "ylim": [10, 20]
+}, {
+    "name": "ms-ssim",
+    "column": "wavg_msssim_score",
+    "title":
+    "Quality according to MS-SSIM in function of number of bits per pixel",
+    "xlabel": "Bits per pixels",
+    "ylabel": "dB (MS-SSIM)",
+    "ylim": [15, 35]
+}, {
+    "name": "psnr-hvs-m",
+    "column": "wavg_psnrhvsm_score",
+    "title":
+    "Quality according to PSNR-HVS-M in function of number of bits per pixel",
+    "xlabel": "Bits per pixels",
+    "ylabel": "dB (PSNR-HVS-M)",
+    "ylim": [25, 50]
+}, {
+    "name": "vmaf",
+    "column": "wavg_vmaf_score",
+    "title":
+    "Quality according to VMAF in function of number of bits per pixel",
+    "xlabel": "Bits per pixels",
+    "ylabel": "Score (VMAF)",
+    "ylim": [75, 100]
+}, {
+    "name": "encoding_time",
+    "column": "wavg_encode_time",
+    "title": "Encoding time in function of average bpp",
+    "xlabel": "Bits per pixel",
+    "ylabel": "Time (s)",
+    "ylim": [0, 25]
+}]
 
-def generate_plots(path, requested_formats):
-    data = {}
-    subset_name = os.path.basename(path)
+# Settings shared by every chart
+figure_size = (25, 15)
+xlim = [0.1, 2]
 
-    for format in requested_formats:
-        file = path + "/" + subset_name + "." + format + ".lossy.out"
-        data[format] = pd.read_csv(file, sep=":")
+# Hashes of the spec and data of the charts last drawn in a subset folder,
+# for the charts which did not change to be skipped.
+plot_index = "plots.json"
+
+
+# Returns a dict of the lossy averages of each format, read from the results
+# database of the subset, or from the files written by rd_average.py.
+def load_averages(path):
+    averages = {}
+    for f in glob.glob(path + "/*.lossy.out"):
+        averages[os.path.basename(f).split(".")[1]] = f
+
+    if os.path.isfile(rd_store.store_path(path)):
+        conn = rd_store.open_store(rd_store.store_path(path))
+        for format in rd_store.get_formats(conn, "lossy_average"):
+            averages[format] = rd_store.read_average(conn, "lossy_average",
+                                                     format)
+        conn.close()
+
+    for format in averages:
+        if isinstance(averages[format], str):
+            import pandas as pd
+
+            averages[format] = pd.read_csv(averages[format], sep=":")
+    return averages
+
+
+def chart_path(path, subset_name, chart, requested_formats):
+    return path + "/" + subset_name + "." + chart["name"] + ".(" + ','.join(
+        requested_formats) + ").svg"
+
+
+# matplotlib is only imported to draw a chart, so that the charts which are
+# up to date are skipped without loading it
+def import_pyplot():
+    import matplotlib
+    matplotlib.use('Cairo')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def chart_hash(subset_name, chart, series):
+    from importlib.metadata import version
 
+    return hashlib.sha1(
+        json.dumps([
+            version("matplotlib"), figure_size, xlim, subset_name, chart,
+            series
+        ]).encode("utf-8")).hexdigest()
+
+
+def load_plot_index(path):
+    try:
+        with open(path + "/" + plot_index) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_plot_index(path, index):
+    tmp_file = path + "/" + plot_index + ".tmp"
+    with open(tmp_file, "w") as json_file:
+        json.dump(index, json_file)
+    os.replace(tmp_file, path + "/" + plot_index)
+
+
+# Draws a chart, from the (format, avg_bpp, values) of each format
+def render_chart(args):
+    [svg, subset_name, chart, series] = args
+
+    plt = import_pyplot()
     plt.rcParams['svg.fonttype'] = 'svgfont'
 
-    # Y-SSIM
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to Y-SSIM in function of number of bits per pixel")
+    fig = plt.figure(figsize=figure_size)
+    plt.title(chart["title"])
     plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (Y-SSIM)")
+    plt.xlabel(chart["xlabel"])
+    plt.ylabel(chart["ylabel"])
     plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([10, 20])
+    plt.xlim(xlim)
+    plt.ylim(chart["ylim"])
     plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_y_ssim_score"],
-            label=format)
+    plt.grid(True, which='both', color='0.65', linestyle='--')
+    for format, bpp, values in series:
+        plt.plot(bpp, values, label=format)
     plt.legend()
-    plt.savefig(path + "/" + subset_name + ".y-ssim.(" +
-                ','.join(requested_formats) + ").svg")
+    fig.savefig(svg)
     plt.close(fig)
 
-    # RGB-SSIM
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to RGB-SSIM in function of number of bits per pixel"
-    )
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (RGB-SSIM)")
-    plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([10, 20])
-    plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_rgb_ssim_score"],
-            label=format)
-    plt.legend()
-    plt.savefig(path + "/" + subset_name + ".rgb-ssim.(" +
-                ','.join(requested_formats) + ").svg")
-    plt.close(fig)
 
-    # MS-SSIM
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to MS-SSIM in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (MS-SSIM)")
-    plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([15, 35])
-    plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_msssim_score"],
-            label=format)
-    plt.legend()
-    plt.savefig(path + "/" + subset_name + ".ms-ssim.(" +
-                ','.join(requested_formats) + ").svg")
-    plt.close(fig)
+# Draws the charts of the requested formats in parallel, except the ones
+# whose spec and data did not change since they were last drawn.
+def generate_plots(path, requested_formats, averages, jobs=None):
+    subset_name = os.path.basename(path)
+    index = load_plot_index(path)
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to PSNR-HVS-M in function of number of bits per pixel"
-    )
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (PSNR-HVS-M)")
-    plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([25, 50])
-    plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_psnrhvsm_score"],
-            label=format)
-    plt.legend()
-    plt.savefig(path + "/" + subset_name + ".psnr-hvs-m.(" +
-                ','.join(requested_formats) + ").svg")
-    plt.close(fig)
+    tasks = []
+    hashes = {}
+    for chart in charts:
+        series = [[
+            format, [float(value) for value in averages[format]["avg_bpp"]],
+            [float(value) for value in averages[format][chart["column"]]]
+        ] for format in requested_formats]
+        svg = chart_path(path, subset_name, chart, requested_formats)
+        key = chart_hash(subset_name, chart, series)
+        if index.get(os.path.basename(svg)) == key and os.path.isfile(svg):
+            continue
+        tasks.append((svg, subset_name, chart, series))
+        hashes[os.path.basename(svg)] = key
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to VMAF in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Score (VMAF)")
-    plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([75, 100])
-    plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_vmaf_score"],
-            label=format)
-    plt.legend()
-    plt.savefig(path + "/" + subset_name + ".vmaf.(" +
-                ','.join(requested_formats) + ").svg")
-    plt.close(fig)
+    if tasks:
+        # Imported once for all the processes
+        import_pyplot()
+        pool = Pool(processes=jobs or min(len(tasks), os.cpu_count()))
+        pool.map(render_chart, tasks, chunksize=1)
+        pool.close()
+        pool.join()
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Encoding time in function of average bpp")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixel")
-    plt.ylabel("Time (s)")
-    plt.xscale("log")
-    plt.xlim([0.1, 2])
-    plt.ylim([0, 25])
-    plt.minorticks_on()
-    plt.grid(b=True, which='both', color='0.65', linestyle='--')
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_encode_time"],
-            label=format)
-    plt.legend()
-    plt.savefig(path + "/" + subset_name + ".encoding_time.(" +
-                ','.join(requested_formats) + ").svg")
-    plt.close(fig)
-    
-    plt.close("all")
+    index.update(hashes)
+    save_plot_index(path, index)
+    print("{} charts drawn, {} up to date".format(
+        len(tasks),
+        len(charts) - len(tasks)))
 
 
 def main(argv):
@@ -202,16 +231,20 @@ def main(argv):
 
     results_folder = os.path.normpath(argv[1])
 
-    if (not os.path.isdir(results_folder)
-            or not glob.glob(results_folder + "/*.lossy.out")):
+    if not os.path.isdir(results_folder):
+        print(
+            "Could not find all results file. Please make sure the path provided is correct."
+        )
+        return
+
+    averages = load_averages(results_folder)
+    if not averages:
         print(
             "Could not find all results file. Please make sure the path provided is correct."
         )
         return
 
-    available_formats = []
-    for f in glob.glob(results_folder + "/*.lossy.out"):
-        available_formats.append(os.path.basename(f).split(".")[1])
+    available_formats = list(averages.keys())
 
     try:
         requested_formats = [format.strip() for format in argv[2].split(",")]
@@ -224,7 +257,7 @@ def main(argv):
                   format(format, available_formats))
             return
 
-    generate_plots(results_folder, requested_formats)
+    generate_plots(results_folder, requested_formats, averages)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import fcntl
+import struct
+import subprocess
+
+# Image dimensions are read from the PNG header, or with ImageMagick's
+# identify for other files, and remembered in this index, keyed by path,
+# size and modification time. Runs probing at once merge their entries into
+# the index on disk under a lock on index_file + ".lock".
+index_file = "results/image_index.json"
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+png_color_types = {
+    0: "gray",
+    2: "rgb",
+    3: "palette",
+    4: "graya",
+    6: "rgba"
+}
+
+#############################################################################
+
+
+# Returns tuple containing:
+#   (width, height, pixel_format)
+# or None if the file is not a PNG.
+def probe_png(path):
+    with open(path, "rb") as file:
+        header = file.read(33)
+    if (len(header) < 33 or header[:8] != png_signature
+            or header[12:16] != b"IHDR"):
+        return None
+    width, height, bit_depth, color_type = struct.unpack(
+        ">IIBB", header[16:26])
+    if color_type not in png_color_types:
+        return None
+    return (width, height, png_color_types[color_type] + str(bit_depth))
+
+
+def probe_identify(path):
+    proc = subprocess.Popen(
+        ["identify", "-format", "%w %h %[channels]", path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8")
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        sys.stderr.write("Failed process: identify\n")
+        sys.exit(proc.returncode)
+    # Multi-frame files print one entry per frame, only the first is used
+    fields = out.strip().split(" ")
+    return (int(fields[0]), int(fields[1]), fields[2])
+
+
+def load_index():
+    try:
+        with open(index_file) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+# Adds the entries to the index on disk, keeping the ones saved by other
+# runs since it was loaded.
+def save_index(entries):
+    if not os.path.exists(os.path.dirname(index_file)):
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = load_index()
+        index.update(entries)
+        tmp_file = index_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, "w") as json_file:
+            json.dump(index, json_file)
+        os.replace(tmp_file, index_file)
+
+
+# Returns dict containing width, height, pixels and pixel_format, and
+# updates the index if the file was not in it or changed since.
+def get_image_info(path, index):
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    info = index.get(key)
+    if (info is not None and info["size"] == stat.st_size
+            and info["mtime"] == stat.st_mtime):
+        return info
+
+    probe = probe_png(path)
+    if probe is None:
+        probe = probe_identify(path)
+    width, height, pixel_format = probe
+    info = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "width": width,
+        "height": height,
+        "pixels": width * height,
+        "pixel_format": pixel_format
+    }
+    index[key] = info
+    return info
+
+
+# Returns a dict of image informations for a list of files, reading and
+# saving the index once.
+def get_image_infos(paths):
+    index = load_index()
+    infos = {}
+    changed = {}
+    for path in paths:
+        key = os.path.abspath(path)
+        before = index.get(key)
+        infos[path] = get_image_info(path, index)
+        if infos[path] is not before:
+            changed[key] = infos[path]
+    if changed:
+        save_index(changed)
+    return infos
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) < 2:
+        print("rd_probe.py: Print the dimensions of images and add them to the index")
+        print("Args: images to probe (e.g. subset1/*.png)")
+        return
+
+    infos = get_image_infos(argv[1:])
+    print("file_name:width:height:pixels:pixel_format")
+    for path in argv[1:]:
+        print("%s:%d:%d:%d:%s" % (path, infos[path]["width"],
+                                  infos[path]["height"],
+                                  infos[path]["pixels"],
+                                  infos[path]["pixel_format"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -36,8 +36,12 @@ import glob
 import shlex
 import string
 import json
+import bisect
+import getopt
+import fcntl
 from multiprocessing import Pool
-from shutil import copy
+import shutil
+import rd_store
 
 # Paths to various programs and config files used by the tests #
 # Conversion
@@ -46,6 +50,19 @@ convert = "ffmpeg"
 # Path to tmp dir to be used by the tests
 tmpdir = "/tmp/"
 
+# zlib compression level of the exported PNG files, from 0 to 9, or None for
+# the default of ffmpeg
+png_compression = None
+
+# Files are published to comparisonfiles/ by copying them ("copy"), or by
+# sharing their data with the encoded files ("link"): as a reflink where the
+# filesystem supports it, else as a hardlink, else as a copy. Files whose
+# size and modification time did not change are left alone.
+publish_mode = "copy"
+
+# ioctl cloning a file on Linux filesystems with reflinks (Btrfs, XFS)
+FICLONE = 0x40049409
+
 #############################################################################
 
 
@@ -81,42 +98,183 @@ def path_for_file_in_tmp(path):
     return tmpdir + str(os.getpid()) + os.path.basename(path)
 
 
-def convert_img(inn, out):
-    cmd = "%s -y -i %s -pix_fmt yuv420p %s" % (convert, inn, out)
-    run_silent(cmd)
+def convert_png(inn, out):
+    cmd = "%s -y -i %s -pix_fmt yuv420p" % (convert, inn)
+    if png_compression is not None:
+        cmd += " -compression_level %d" % png_compression
+    run_silent(cmd + " " + out)
 
 
-def find_by_size(size, path):
-    result = []
-    files = [
-        f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))
-    ]
-    for f in files:
-        if os.path.getsize(os.path.join(path, f)) == size:
-            result.append(
-                [os.path.join(f),
-                 os.path.getsize(os.path.join(path, f))])
-    if not result:
-        print("Nothing of size %d was found" % size)
-    return result
-
-
-def find_closest_size(size, path):
-    file_sizes = []
-    result = []
-    files = [
-        f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))
-    ]
-    for f in files:
-        file_sizes.append(os.path.getsize(os.path.join(path, f)))
-    result = find_by_size(min(file_sizes, key=lambda x: abs(x - size)), path)
-    if not result:
+def reflink(source, target):
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def hardlink(source, target):
+    try:
+        os.link(source, target)
+        return True
+    except OSError:
+        return False
+
+
+def same_file(stat1, stat2):
+    return (stat1.st_size == stat2.st_size
+            and stat1.st_mtime_ns == stat2.st_mtime_ns)
+
+
+# Publishes source to target, a file or a directory.
+# Returns True if target was written, False if it was already up to date.
+def publish(source, target):
+    if os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(source))
+    stat = os.stat(source)
+    try:
+        if same_file(os.stat(target), stat):
+            return False
+    except FileNotFoundError:
+        pass
+
+    # Written under a temporary name then renamed, so that the published
+    # file is never partial
+    tmp_target = target + ".tmp"
+    try:
+        os.remove(tmp_target)
+    except FileNotFoundError:
+        pass
+    if publish_mode == "link" and reflink(source, tmp_target):
+        os.utime(tmp_target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    elif not (publish_mode == "link" and hardlink(source, tmp_target)):
+        shutil.copy2(source, tmp_target)
+    if not same_file(os.stat(tmp_target), stat):
+        print("Publishing {} to {} failed".format(source, target))
+        sys.exit(1)
+    os.replace(tmp_target, target)
+    return True
+
+
+# Path of the decoded image kept by rd_collect.py --keep-decoded
+def decoded_path(target, extension):
+    parts = os.path.normpath(target).split(os.sep)
+    parts[0] = parts[0][:-len("_out")] + "_decoded"
+    return os.path.splitext(os.sep.join(parts))[0] + "." + extension
+
+
+def png_up_to_date(target):
+    try:
+        return os.path.getmtime(os.path.splitext(target)[0] +
+                                ".png") > os.path.getmtime(target)
+    except FileNotFoundError:
+        return False
+
+
+# Exports a selected file to PNG, from the decoded image kept by
+# rd_collect.py if there is one.
+def export_png(args):
+    [format_recipe, origpng, target, decoded] = args
+
+    png = os.path.splitext(target)[0] + ".png"
+    if os.path.isfile(decoded):
+        convert_png(decoded, png)
+        return
+
+    target_dec = path_for_file_in_tmp(target)
+    target_dec += "." + format_recipe['decode_extension']
+    cmd = string.Template(format_recipe['decode_cmd']).substitute(locals())
+    run_silent(cmd)
+    convert_png(target_dec, png)
+    try:
+        os.remove(target_dec)
+    except FileNotFoundError:
+        pass
+
+
+def get_file_name(origpng, format_recipe, quality):
+    name = os.path.splitext(os.path.basename(origpng))[0]
+    if quality is None:
+        return name + "-lossless." + format_recipe['encode_extension']
+    # Same quality formatting as the file names of rd_collect.py
+    if (isinstance(format_recipe['quality_start'], float)
+            or isinstance(format_recipe['quality_end'], float)
+            or isinstance(format_recipe['quality_step'], float)):
+        quality = float(quality)
+    else:
+        quality = int(quality)
+    return name + "-q" + str(quality) + "." + format_recipe['encode_extension']
+
+
+# Returns a dict of the sizes of the encoded images of each image, as sorted
+# lists of (size, file name), read from the compressed_file_size of the
+# results of rd_collect.py instead of the encoded files.
+def read_size_index(subset_name, format, format_recipe):
+    rows = []
+    path = rd_store.store_path("results/" + subset_name)
+    if os.path.isfile(path):
+        conn = rd_store.open_store(path)
+        rows = rd_store.read_sizes(conn, format)
+        conn.close()
+
+    # Results files of older versions of rd_collect.py, only read for the
+    # images missing from the database
+    known = {
+        "lossless": set(row[0] for row in rows if row[1] is None),
+        "lossy": set(row[0] for row in rows if row[1] is not None)
+    }
+    suffix = "." + format + ".out"
+    for kind in ("lossless", "lossy"):
+        for path in glob.glob("results/" + subset_name + "/" + format + "/" +
+                              kind + "/*" + suffix):
+            if os.path.basename(path)[:-len(suffix)] in known[kind]:
+                continue
+            with open(path) as file:
+                columns = file.readline().strip().split(":")
+                for line in file:
+                    values = dict(zip(columns, line.strip().split(":")))
+                    rows.append((values["file_name"],
+                                 float(values["quality"])
+                                 if kind == "lossy" else None,
+                                 int(values["compressed_file_size"])))
+
+    index = {}
+    for file_name, quality, size in rows:
+        index.setdefault(file_name, []).append(
+            (size, get_file_name(file_name, format_recipe, quality)))
+    for sizes in index.values():
+        sizes.sort()
+    return index
+
+
+# Same as read_size_index for a single image, from its encoded files
+def scan_sizes(path):
+    sizes = []
+    for entry in os.scandir(path):
+        if entry.is_file():
+            sizes.append((entry.stat().st_size, entry.name))
+    sizes.sort()
+    return sizes
+
+
+# Returns the name of the file whose size is the closest to size, from a
+# sorted list of (size, file name).
+def find_closest_size(size, sizes):
+    if not sizes:
         print("Nothing of size close to %d was found" % size)
-    return result[0][0]
+        return None
+    position = bisect.bisect_left(sizes, (size, ))
+    candidates = sizes[max(position - 1, 0):position + 1]
+    return min(candidates, key=lambda entry: abs(entry[0] - size))[1]
 
 
 def process_image(args):
-    [format, format_recipe, subset_name, origpng] = args
+    [format, format_recipe, subset_name, origpng, sizes] = args
 
     try:
         start = float(format_recipe['quality_start'])
@@ -141,7 +299,7 @@ def process_image(args):
     create_dir(orig_target_path)
 
     # Copy original
-    copy(origpng, orig_target_path)
+    publish(origpng, orig_target_path)
 
     # Lossless
     if not os.path.isdir(path):
@@ -150,17 +308,8 @@ def process_image(args):
             format(path))
         return
 
-    lossless_target = [
-        f for f in os.listdir(path)
-        if f.startswith(
-            os.path.splitext(os.path.basename(origpng))[0] + "-lossless")
-    ]
-    if not lossless_target[0]:
-        print(
-            "Compressed image files not found in {}. You must run rd_collect first.".
-            format(path))
-        return
-    lossless_target = os.path.join(path, lossless_target[0])
+    lossless_target = os.path.join(
+        path, get_file_name(origpng, format_recipe, None))
 
     # BPG @ crf24
     ref_file = "BPG_out" + '/' + subset_name + "/" + os.path.splitext(
@@ -177,10 +326,21 @@ def process_image(args):
     small_size = medium_size * 0.60
     tiny_size = small_size * 0.60
 
-    large_target = os.path.join(path, find_closest_size(large_size, path))
-    medium_target = os.path.join(path, find_closest_size(medium_size, path))
-    small_target = os.path.join(path, find_closest_size(small_size, path))
-    tiny_target = os.path.join(path, find_closest_size(tiny_size, path))
+    # The results may be missing or out of date, in which case the sizes
+    # are read from the encoded files.
+    for attempt in range(2):
+        if not sizes:
+            sizes = scan_sizes(path)
+        targets = [
+            find_closest_size(size, sizes)
+            for size in (large_size, medium_size, small_size, tiny_size)
+        ]
+        if all(target is not None and os.path.isfile(os.path.join(
+                path, target)) for target in targets):
+            break
+        sizes = None
+    targets = [os.path.join(path, target or "") for target in targets]
+    large_target, medium_target, small_target, tiny_target = targets
 
     if not os.path.isfile(lossless_target) or not os.path.isfile(
             large_target) or not os.path.isfile(
@@ -199,53 +359,53 @@ def process_image(args):
         os.path.splitext(os.path.basename(lossless_target))[1])
 
     create_dir(lossless_target_path)
-    copy(lossless_target, lossless_target_path)
+    publish(lossless_target, lossless_target_path)
     large_target_path = os.path.join(
         target_path, "large/",
         format.upper() + "/",
         os.path.splitext(os.path.basename(large_target))[0].rsplit(
             '-q', 1)[0] + os.path.splitext(os.path.basename(large_target))[1])
     create_dir(large_target_path)
-    copy(large_target, large_target_path)
+    publish(large_target, large_target_path)
     medium_target_path = os.path.join(
         target_path, "medium/",
         format.upper() + "/",
         os.path.splitext(os.path.basename(medium_target))[0].rsplit(
             '-q', 1)[0] + os.path.splitext(os.path.basename(medium_target))[1])
     create_dir(medium_target_path)
-    copy(medium_target, medium_target_path)
+    publish(medium_target, medium_target_path)
     small_target_path = os.path.join(
         target_path, "small/",
         format.upper() + "/",
         os.path.splitext(os.path.basename(small_target))[0].rsplit(
             '-q', 1)[0] + os.path.splitext(os.path.basename(small_target))[1])
     create_dir(small_target_path)
-    copy(small_target, small_target_path)
+    publish(small_target, small_target_path)
     tiny_target_path = os.path.join(
         target_path, "tiny/",
         format.upper() + "/",
         os.path.splitext(os.path.basename(tiny_target))[0].rsplit(
             '-q', 1)[0] + os.path.splitext(os.path.basename(tiny_target))[1])
     create_dir(tiny_target_path)
-    copy(tiny_target, tiny_target_path)
+    publish(tiny_target, tiny_target_path)
 
     files_list = [
-        lossless_target_path, large_target_path, medium_target_path,
-        small_target_path, tiny_target_path
+        (lossless_target, lossless_target_path),
+        (large_target, large_target_path),
+        (medium_target, medium_target_path),
+        (small_target, small_target_path),
+        (tiny_target, tiny_target_path)
     ]
 
-    if format_recipe['export_to_png']:
-        for target in files_list:
-            target_dec = path_for_file_in_tmp(target)
-            target_dec += "." + format_recipe['decode_extension']
-            cmd = string.Template(format_recipe['decode_cmd']).substitute(
-                locals())
-            run_silent(cmd)
-            convert_img(target_dec, os.path.splitext(target)[0] + ".png")
-            try:
-                os.remove(target_dec)
-            except FileNotFoundError:
-                pass
+    # Files to export to PNG, run by a separate pool once every image is
+    # selected
+    if not format_recipe['export_to_png']:
+        return []
+    # PNG files more recent than their published file are up to date
+    return [(format_recipe, origpng, target,
+             decoded_path(source, format_recipe['decode_extension']))
+            for source, target in files_list
+            if not png_up_to_date(target)]
 
 
 def main(argv):
@@ -262,22 +422,53 @@ def main(argv):
 
     supported_formats = list(data['recipes'].keys())
 
-    if len(argv) != 4:
+    global png_compression, publish_mode
+
+    # Number of PNG exports run at once, by default the number of CPUs
+    jobs = None
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "j:",
+                                       ["jobs=", "png-compression=", "publish="])
+        for opt, value in opts:
+            if opt in ("-j", "--jobs"):
+                jobs = int(value)
+            elif opt == "--png-compression":
+                png_compression = int(value)
+            elif opt == "--publish":
+                publish_mode = value
+    except (getopt.GetoptError, ValueError):
+        args = []
+
+    if (len(args) != 3 or (jobs is not None and jobs < 1)
+            or publish_mode not in ("copy", "link")):
         print("rd_select.py: Select images among the ones generated by rd_collect.py at fifth quality levels (lossless, large, medium, small and tiny)")
         print("Arg 1: format to test {}".format(supported_formats))
         print("Arg 2: name of the subset to test (e.g. 'subset1')")
         print("Arg 3: path to subset to test (e.g. 'subset1')")
+        print("Option -j N, --jobs N: number of PNG exports run at once (default: number of CPUs)")
+        print("Option --png-compression N: zlib compression level of the exported PNG files, from 0 to 9 (default: ffmpeg's)")
+        print("Option --publish MODE: copy (default) the selected files, or link them to the encoded files with reflinks or hardlinks when possible")
         return
 
-    format = argv[1]
-    subset_name = argv[2]
+    format = args[0]
+    subset_name = args[1]
     if format not in supported_formats:
         print("Image format not supported!")
         return
 
-    Pool().map(process_image, [(format, data['recipes'][format], subset_name,
-                                origpng)
-                               for origpng in glob.glob(os.path.normpath(argv[3]) + "/*.png")])
+    index = read_size_index(subset_name, format, data['recipes'][format])
+    exports = Pool().map(process_image, [
+        (format, data['recipes'][format], subset_name, origpng,
+         index.get(os.path.splitext(os.path.basename(origpng))[0]))
+        for origpng in glob.glob(os.path.normpath(args[2]) + "/*.png")
+    ])
+
+    pool = Pool(processes=jobs)
+    pool.map(
+        export_png, [export for image in exports if image for export in image],
+        chunksize=1)
+    pool.close()
+    pool.join()
 
 
 if __name__ == "__main__":
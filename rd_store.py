@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import glob
+import sqlite3
+
+# Results of a subset are kept in a single SQLite database,
+# results/<subset>/<subset>.sqlite, with one table for the lossless results
+# and one for the lossy results of every format. rd_average.py adds the
+# averages to it in the lossless_average and lossy_average tables.
+
+lossless_columns = [
+    ("file_name", "TEXT"), ("orig_file_size", "INTEGER"),
+    ("compressed_file_size", "INTEGER"), ("pixels", "INTEGER"),
+    ("bpp", "REAL"), ("compression_ratio", "REAL"), ("encode_time", "REAL"),
+    ("decode_time", "REAL"), ("encode_time_min", "REAL"),
+    ("encode_time_stddev", "REAL"), ("encode_cpu_time", "REAL"),
+    ("decode_time_min", "REAL"), ("decode_time_stddev", "REAL"),
+    ("decode_cpu_time", "REAL"), ("encode_time_median", "REAL"),
+    ("decode_time_median", "REAL")
+]
+
+lossy_columns = [
+    ("file_name", "TEXT"), ("quality", "REAL"), ("orig_file_size", "INTEGER"),
+    ("compressed_file_size", "INTEGER"), ("pixels", "INTEGER"),
+    ("bpp", "REAL"), ("compression_ratio", "REAL"), ("encode_time", "REAL"),
+    ("decode_time", "REAL"), ("y_ssim_score", "REAL"),
+    ("rgb_ssim_score", "REAL"), ("msssim_score", "REAL"),
+    ("psnrhvsm_score", "REAL"), ("vmaf_score", "REAL"),
+    ("encode_time_min", "REAL"), ("encode_time_stddev", "REAL"),
+    ("encode_cpu_time", "REAL"), ("decode_time_min", "REAL"),
+    ("decode_time_stddev", "REAL"), ("decode_cpu_time", "REAL"),
+    ("encode_time_median", "REAL"), ("decode_time_median", "REAL")
+]
+
+# Times and scores averaged over the images of a format, weighted by their
+# pixels
+lossless_weighted = [
+    "encode_time", "decode_time", "encode_time_min", "encode_time_stddev",
+    "encode_cpu_time", "decode_time_min", "decode_time_stddev",
+    "decode_cpu_time", "encode_time_median", "decode_time_median"
+]
+
+lossy_weighted = lossless_weighted[:2] + [
+    "y_ssim_score", "rgb_ssim_score", "msssim_score", "psnrhvsm_score",
+    "vmaf_score"
+] + lossless_weighted[2:]
+
+# The lossless_sums and lossy_sums tables hold the running sums of the
+# results of every format, and of every row_index of the lossy results, so
+# that rd_average.py reads one row per format and quality instead of every
+# image. They are updated in the same transaction as the results. Weighted
+# values are summed as pixels * value, and counted, as an average is NaN when
+# an image lacks the value. Qualities are also summed squared, for
+# rd_average.py to check that the images have the same qualities.
+sum_columns = {
+    table: [("images", "INTEGER", "COUNT(*)")] +
+    [(name, "INTEGER", "SUM(%s)" % name)
+     for name in ("orig_file_size", "compressed_file_size", "pixels")] +
+    [(name, "REAL", "TOTAL(%s)" % name) for name in extra] +
+    [(name + "_sq", "REAL", "TOTAL(%s * %s)" % (name, name))
+     for name in extra] +
+    [("w_" + name, "REAL", "TOTAL(pixels * %s)" % name)
+     for name in weighted] + [("n_" + name, "INTEGER", "COUNT(%s)" % name)
+                              for name in weighted]
+    for table, extra, weighted in (("lossless", [], lossless_weighted),
+                                   ("lossy", ["quality"], lossy_weighted))
+}
+
+sum_keys = {"lossless": ["format"], "lossy": ["format", "row_index"]}
+
+# The rows of an image are numbered in quality order by row_index, which
+# also tells apart two targets of the target bpp mode reaching the same
+# quality.
+schema = """
+CREATE TABLE IF NOT EXISTS lossless (
+    format TEXT NOT NULL, %s,
+    PRIMARY KEY (format, file_name));
+CREATE TABLE IF NOT EXISTS lossy (
+    format TEXT NOT NULL, row_index INTEGER NOT NULL, %s,
+    PRIMARY KEY (format, file_name, row_index));
+CREATE INDEX IF NOT EXISTS lossy_format_quality ON lossy (format, quality);
+CREATE INDEX IF NOT EXISTS lossy_file_name ON lossy (file_name);
+CREATE TABLE IF NOT EXISTS lossless_sums (
+    format TEXT NOT NULL, %s,
+    PRIMARY KEY (format));
+CREATE TABLE IF NOT EXISTS lossy_sums (
+    format TEXT NOT NULL, row_index INTEGER NOT NULL, %s,
+    PRIMARY KEY (format, row_index));
+""" % tuple(", ".join(column[0] + " " + column[1] for column in columns)
+            for columns in (lossless_columns, lossy_columns,
+                            sum_columns["lossless"], sum_columns["lossy"]))
+
+#############################################################################
+
+
+def store_path(results_folder):
+    results_folder = os.path.normpath(results_folder)
+    return results_folder + "/" + os.path.basename(results_folder) + ".sqlite"
+
+
+def open_store(path):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=600)
+    conn.executescript(schema)
+    # Columns added since the database was written are added to its tables,
+    # at the end as in the schema, and the sums computed again. Databases
+    # written before the sums existed get them once.
+    added = False
+    for table, columns in (("lossless", lossless_columns),
+                           ("lossy", lossy_columns),
+                           ("lossless_sums", sum_columns["lossless"]),
+                           ("lossy_sums", sum_columns["lossy"])):
+        names = set(row[1] for row in conn.execute("PRAGMA table_info(%s)" %
+                                                   table))
+        for column in columns:
+            if column[0] not in names:
+                with conn:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                                 (table, column[0], column[1]))
+                added = True
+    if added or conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        with conn:
+            for table in sum_columns:
+                conn.execute("DELETE FROM %s_sums" % table)
+                update_sums(conn, table, "1", ())
+            conn.execute("PRAGMA user_version = 1")
+    return conn
+
+
+def get_formats(conn, table):
+    try:
+        return [
+            row[0]
+            for row in conn.execute("SELECT DISTINCT format FROM " + table)
+        ]
+    except sqlite3.OperationalError:
+        return []
+
+
+def has_format(conn, table, format):
+    return conn.execute(
+        "SELECT 1 FROM " + table + "_sums WHERE format = ? LIMIT 1",
+        (format, )).fetchone() is not None
+
+
+def has_image(conn, table, format, file_name):
+    return conn.execute(
+        "SELECT 1 FROM " + table + " WHERE format = ? AND file_name = ? LIMIT 1",
+        (format, file_name)).fetchone() is not None
+
+
+# Returns the list of (file_name, quality, compressed_file_size) of the
+# encoded images of a format, with a quality of None for the lossless ones.
+def read_sizes(conn, format):
+    try:
+        return conn.execute(
+            "SELECT file_name, NULL, compressed_file_size FROM lossless "
+            "WHERE format = ? UNION ALL "
+            "SELECT file_name, quality, compressed_file_size FROM lossy "
+            "WHERE format = ?", (format, format)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+
+# NumPy scalars are stored as the Python values they hold
+def sql_row(row):
+    return tuple(value.item() if hasattr(value, "item") else value
+                 for value in row)
+
+
+# Adds to the sums of a table the rows selected by where, or subtracts them
+# if sign is -1. Sums of no image left are removed.
+def update_sums(conn, table, where, params, sign=1):
+    keys = ", ".join(sum_keys[table])
+    names = [column[0] for column in sum_columns[table]]
+    conn.execute(
+        "INSERT INTO %s_sums (%s, %s) SELECT %s, %s FROM %s WHERE %s "
+        "GROUP BY %s ON CONFLICT (%s) DO UPDATE SET %s" %
+        (table, keys, ", ".join(names), keys, ", ".join(
+            "%d * %s" % (sign, column[2])
+            for column in sum_columns[table]), table, where, keys, keys,
+         ", ".join("%s = %s + excluded.%s" % (name, name, name)
+                   for name in names)), params)
+    if sign < 0:
+        conn.execute("DELETE FROM %s_sums WHERE images = 0" % table)
+
+
+def write_lossless(conn, format, row):
+    image = "format = ? AND file_name = ?"
+    with conn:
+        update_sums(conn, "lossless", image, (format, row[0]), -1)
+        conn.execute(
+            "INSERT OR REPLACE INTO lossless VALUES (?, %s)" % ", ".join(
+                "?" * len(lossless_columns)), (format, ) + sql_row(row))
+        update_sums(conn, "lossless", image, (format, row[0]))
+
+
+# Replaces all the lossy rows of an image in a single transaction
+def write_lossy(conn, format, rows):
+    rows = sorted(rows, key=lambda row: row[1])
+    image = "format = ? AND file_name = ?"
+    with conn:
+        update_sums(conn, "lossy", image, (format, rows[0][0]), -1)
+        conn.execute("DELETE FROM lossy WHERE " + image, (format, rows[0][0]))
+        conn.executemany(
+            "INSERT INTO lossy VALUES (?, ?, %s)" % ", ".join(
+                "?" * len(lossy_columns)),
+            [(format, i) + sql_row(row) for i, row in enumerate(rows)])
+        update_sums(conn, "lossy", image, (format, rows[0][0]))
+
+
+# Returns a DataFrame with the rows of a format, or None if there are none
+def read_results(conn, table, format):
+    import pandas as pd
+
+    data = pd.read_sql_query(
+        "SELECT * FROM " + table + " WHERE format = ? ORDER BY file_name" +
+        (", row_index" if table == "lossy" else ""),
+        conn,
+        params=(format, ))
+    if data.empty:
+        return None
+    return data.drop(columns=["format"])
+
+
+# Returns a DataFrame with the sums of a format, one row per row_index for the
+# lossy results, or None if there are none
+def read_sums(conn, table, format):
+    import pandas as pd
+
+    data = pd.read_sql_query(
+        "SELECT * FROM " + table + "_sums WHERE format = ?" +
+        (" ORDER BY row_index" if table == "lossy" else ""),
+        conn,
+        params=(format, ))
+    if data.empty:
+        return None
+    return data.drop(columns=["format"])
+
+
+# Replaces the averages of a format, or the whole table if format is None and
+# data has a format column.
+def write_average(conn, table, data, format=None):
+    with conn:
+        if format is None:
+            conn.execute("DROP TABLE IF EXISTS " + table)
+        else:
+            data = data.copy()
+            data.insert(0, "format", format)
+            try:
+                conn.execute("DELETE FROM " + table + " WHERE format = ?",
+                             (format, ))
+            except sqlite3.OperationalError:
+                pass
+        data.to_sql(table, conn, if_exists="append", index=False)
+
+
+def read_average(conn, table, format):
+    import pandas as pd
+
+    try:
+        data = pd.read_sql_query(
+            "SELECT * FROM " + table + " WHERE format = ?",
+            conn,
+            params=(format, ))
+    except (sqlite3.OperationalError, pd.errors.DatabaseError):
+        return None
+    if data.empty:
+        return None
+    return data.drop(columns=["format"])
+
+
+# Imports the results files written by older versions of rd_collect.py
+def import_results(results_folder):
+    import pandas as pd
+
+    conn = open_store(store_path(results_folder))
+    count = 0
+    for format in next(os.walk(results_folder))[1]:
+        for kind, columns in (("lossless", lossless_columns), ("lossy",
+                                                              lossy_columns)):
+            for f in glob.glob(results_folder + "/" + format + "/" + kind +
+                               "/*.out"):
+                data = pd.read_csv(f, sep=":")
+                if data.empty:
+                    continue
+                for name, type in columns:
+                    if name not in data:
+                        data[name] = None
+                rows = [
+                    tuple(row)
+                    for row in data[[name for name, type in columns]]
+                    .itertuples(index=False)
+                ]
+                if kind == "lossless":
+                    write_lossless(conn, format, rows[0])
+                else:
+                    write_lossy(conn, format, rows)
+                count += 1
+    conn.close()
+    return count
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) != 3 or argv[1] != "import":
+        print(
+            "rd_store.py: Import the results files of a subset into its results database"
+        )
+        print("Arg 1: import")
+        print("Arg 2: Path to the results of a subset generated by rd_collect.py")
+        print("       For ex: rd_store.py import \"results/subset1\"")
+        return
+
+    results_folder = os.path.normpath(argv[2])
+    if not os.path.isdir(results_folder):
+        print("Could not find {}.".format(results_folder))
+        return
+
+    count = import_results(results_folder)
+    print("{} results files imported into {}.".format(
+        count, store_path(results_folder)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import threading
+import contextlib
+import contextvars
+
+# Opt-in tracing of the stages of rd_collect.py. Each stage run is recorded
+# as a span, tagged with the format, image and quality of the task and with
+# the worker pid, and buffered in the process which ran it. Buffers are
+# appended to <trace_dir>/trace.<pid>.jsonl, one Chrome trace event per line,
+# and merged by write_trace into a Chrome trace file (chrome://tracing,
+# Perfetto), with a summary of the time spent in each stage.
+enabled = False
+trace_dir = None
+
+# Events buffered before being written
+flush_every = 1000
+
+events = []
+tags = {}
+# Tags of the spans recorded in the current context, over the ones of
+# set_tags, for the quality points of a task which are run at once
+context_tags = contextvars.ContextVar("context_tags", default={})
+
+#############################################################################
+
+
+class Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.monotonic_ns(), self.args)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_span = NullSpan()
+
+
+# Returns a context manager recording a span around its block, doing nothing
+# unless tracing is enabled.
+def span(name, **args):
+    if not enabled:
+        return null_span
+    return Span(name, args)
+
+
+def enable(path):
+    global enabled, trace_dir
+
+    enabled = True
+    trace_dir = path
+    os.makedirs(trace_dir, exist_ok=True)
+    for f in glob.glob(trace_dir + "/trace.*.jsonl"):
+        os.remove(f)
+
+
+# Tags added to the spans recorded from now on by this process
+def set_tags(**new_tags):
+    tags.clear()
+    tags.update(new_tags)
+
+
+# Returns a context manager adding tags to the spans recorded in its block,
+# and in the asyncio tasks and executor calls started from it with their
+# context.
+@contextlib.contextmanager
+def tagged(**new_tags):
+    token = context_tags.set(dict(context_tags.get(), **new_tags))
+    try:
+        yield
+    finally:
+        context_tags.reset(token)
+
+
+# Spans of the coroutines of an asyncio pipeline overlap in a same thread,
+# and are given the id of their task as thread id to keep them apart.
+# asyncio is only looked at once imported by the pipeline.
+def get_tid():
+    asyncio = sys.modules.get("asyncio")
+    try:
+        task = asyncio.current_task() if asyncio else None
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task)
+    return threading.get_ident()
+
+
+def record(name, start, end, args):
+    event = {
+        "name": name,
+        "ph": "X",
+        "ts": start / 1000,
+        "dur": (end - start) / 1000,
+        "pid": os.getpid(),
+        "tid": get_tid()
+    }
+    extra_tags = context_tags.get()
+    if tags or extra_tags or args:
+        event["args"] = dict(tags)
+        event["args"].update(extra_tags)
+        event["args"].update(args)
+    events.append(event)
+    if len(events) >= flush_every:
+        flush()
+
+
+# Writes the buffered events. Called at the end of every task, as the
+# processes of a Pool do not run exit handlers.
+def flush():
+    if not enabled or not events:
+        return
+    with open(trace_dir + "/trace.%d.jsonl" % os.getpid(), "a") as file:
+        file.write("".join(json.dumps(event) + "\n" for event in events))
+    del events[:]
+
+
+def read_events(path):
+    if path.endswith(".json"):
+        with open(path) as json_file:
+            return json.load(json_file)["traceEvents"]
+    trace_events = []
+    for f in glob.glob(path + "/trace.*.jsonl"):
+        with open(f) as file:
+            trace_events += [json.loads(line) for line in file if line.strip()]
+    return trace_events
+
+
+# Prints the count, total and percentiles of the durations of each stage,
+# the stages taking the most time first.
+def print_summary(trace_events):
+    import numpy as np
+
+    durations = {}
+    for event in trace_events:
+        durations.setdefault(event["name"], []).append(event["dur"] / 1e6)
+
+    print("%-20s %8s %10s %9s %9s %9s %9s" %
+          ("stage", "count", "total (s)", "mean (s)", "p50 (s)", "p90 (s)",
+           "p99 (s)"))
+    for name, values in sorted(
+            durations.items(), key=lambda item: sum(item[1]), reverse=True):
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        print("%-20s %8d %10.3f %9.4f %9.4f %9.4f %9.4f" %
+              (name, len(values), sum(values), np.mean(values), p50, p90,
+               p99))
+
+
+# Merges the events of every process into a Chrome trace file, and prints
+# their summary.
+def write_trace(path):
+    flush()
+    trace_events = read_events(trace_dir)
+    trace_events.sort(key=lambda event: event["ts"])
+    with open(path + ".tmp", "w") as json_file:
+        json.dump({
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms"
+        }, json_file)
+    os.replace(path + ".tmp", path)
+    print_summary(trace_events)
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) != 2:
+        print("rd_trace.py: Print the time spent in each stage of a trace written by rd_collect.py --trace")
+        print("Arg 1: trace file, or directory of the per-process traces")
+        return
+
+    print_summary(read_events(argv[1]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,176 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_bench
+
+# Tests of rd.py and of its daemon, run as separate processes as by a user,
+# from a working directory holding a small image
+
+rd_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     "rd.py")
+
+# Runs rd.py as python would, its folder first in sys.path
+run_script = """
+import os
+import sys
+import runpy
+
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    for module in list(sys.modules):
+        if module.startswith("rd_"):
+            sys.stderr.write("imported: " + module + "\\n")
+"""
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.workdir.name, "rd.sock")
+        self.cwd = os.path.join(self.workdir.name, "work")
+        os.makedirs(self.cwd)
+        rd_bench.make_image(os.path.join(self.cwd, "img.png"), 0)
+        self.daemon = subprocess.Popen(
+            [sys.executable, rd_py, "daemon", self.socket_path],
+            cwd=self.workdir.name,
+            stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 60
+        while not os.path.exists(self.socket_path):
+            self.assertIsNone(self.daemon.poll())
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.send_signal(signal.SIGTERM)
+            self.daemon.wait()
+        self.workdir.cleanup()
+
+    # Runs rd.py, which then writes on its standard error whether it
+    # imported the script of the command
+    def run_rd(self, *args, socket_path=None):
+        return subprocess.run(
+            [sys.executable, "-c", run_script, rd_py, "--daemon",
+             socket_path or self.socket_path] + list(args),
+            cwd=self.cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8")
+
+    def imported(self, proc, module):
+        return "imported: " + module in proc.stderr.splitlines()
+
+    # The command runs in the working directory of rd.py, writing to its
+    # standard streams
+    def test_command(self):
+        for run in range(2):
+            proc = self.run_rd("probe", "img.png")
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            # Run by the daemon, rd.py not importing the script
+            self.assertFalse(self.imported(proc, "rd_probe"))
+            self.assertEqual(proc.stdout.splitlines()[1].split(":")[0],
+                             "img.png")
+            self.assertTrue(
+                os.path.isfile(
+                    os.path.join(self.cwd, "results", "image_index.json")))
+        # The daemon serves the next commands
+        self.assertIsNone(self.daemon.poll())
+
+    def test_exit_status(self):
+        proc = self.run_rd("probe", "missing.png")
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn("FileNotFoundError", proc.stderr)
+        self.assertIsNone(self.daemon.poll())
+
+        proc = self.run_rd("unknown")
+        self.assertEqual(proc.returncode, 2)
+        self.assertIn("Commands:", proc.stdout)
+
+    # Without a daemon, the command runs in rd.py
+    def test_no_daemon(self):
+        proc = self.run_rd("probe", "img.png",
+                           socket_path=self.socket_path + ".missing")
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertTrue(self.imported(proc, "rd_probe"))
+        self.assertEqual(proc.stdout.splitlines()[1].split(":")[0],
+                         "img.png")
+
+    # A command whose rd.py is killed is stopped by the daemon
+    def test_interrupted(self):
+        fifo = os.path.join(self.cwd, "blocked.png")
+        os.mkfifo(fifo)
+        client = subprocess.Popen(
+            [sys.executable, rd_py, "--daemon", self.socket_path, "probe",
+             "blocked.png"],
+            cwd=self.cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+        # Waits for the command to read the fifo, then for it to stop reading
+        # it once rd.py is killed
+        def has_reader():
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                return True
+            except OSError:
+                return False
+
+        deadline = time.monotonic() + 30
+        while not has_reader():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        client.kill()
+        client.wait()
+        deadline = time.monotonic() + 30
+        while has_reader():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertIsNone(self.daemon.poll())
+
+    def test_stop(self):
+        self.daemon.send_signal(signal.SIGTERM)
+        self.daemon.wait(timeout=30)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
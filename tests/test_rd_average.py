@@ -0,0 +1,254 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import io
+import sys
+import glob
+import shutil
+import contextlib
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_store
+import rd_collect
+import rd_average
+
+# Averages of rd_average.py over a small tree of results, from the sums of the
+# results database and from the per-image results files, against the
+# averages of the formulas of the first rd_average.py: sizes summed, times and
+# scores averaged with np.average weighted by the pixels of each image.
+
+formats = ["ref", "other"]
+qualities = [10.0, 50.0, 90.0]
+pixels = [64 * 64, 100 * 30, 512 * 512]
+
+
+# Returns the rows of an image, with values the results files keep exactly
+def make_rows(random, columns, name, image, qualities):
+    rows = []
+    for quality in qualities:
+        row = []
+        for column, type in columns:
+            if column == "file_name":
+                row.append(name)
+            elif column == "quality":
+                row.append(quality)
+            elif column == "pixels":
+                row.append(pixels[image])
+            elif column == "orig_file_size":
+                row.append(pixels[image] * 3)
+            elif type == "INTEGER":
+                row.append(int(random.integers(100, 3 * 2**20)))
+            else:
+                row.append(float(random.integers(1, 10000)) / 1000)
+        rows.append(tuple(row))
+    return rows
+
+
+class AverageTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (rd_average.jobs, rd_average.get_chunk_rows,
+                      rd_average.target_bpp)
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+
+        random = np.random.default_rng(1)
+        self.lossless = {}
+        self.lossy = {}
+        for format in formats:
+            for image in range(len(pixels)):
+                name = "img%d.png" % image
+                self.lossless.setdefault(format, []).extend(
+                    make_rows(random, rd_store.lossless_columns, name, image,
+                              [None]))
+                self.lossy.setdefault(format, []).append(
+                    make_rows(random, rd_store.lossy_columns, name, image,
+                              qualities))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        (rd_average.jobs, rd_average.get_chunk_rows,
+         rd_average.target_bpp) = self.saved
+        self.workdir.cleanup()
+
+    def write_store(self):
+        conn = rd_store.open_store(rd_store.store_path("results/subset"))
+        for format in formats:
+            for row in self.lossless[format]:
+                rd_store.write_lossless(conn, format, row)
+            for rows in self.lossy[format]:
+                rd_store.write_lossy(conn, format, rows)
+        conn.close()
+
+    def write_files(self):
+        for format in formats:
+            for row in self.lossless[format]:
+                rd_collect.write_lossless_results("subset", format, row[0],
+                                                  row)
+            for rows in self.lossy[format]:
+                rd_collect.write_lossy_results("subset", format, rows[0][0],
+                                               rows)
+
+    # Returns the averages of the first rd_average.py
+    # Returns tuple containing:
+    #   (lossless, lossy), lossy being a dict of the averages of each format
+    def baseline(self):
+        lossless = {}
+        lossy = {}
+        for format in formats:
+            data = pd.DataFrame(
+                self.lossless[format],
+                columns=[name for name, type in rd_store.lossless_columns])
+            lossless[format] = self.baseline_averages(
+                data, rd_store.lossless_weighted)
+            images = [
+                pd.DataFrame(
+                    rows,
+                    columns=[name for name, type in rd_store.lossy_columns])
+                for rows in self.lossy[format]
+            ]
+            lossy[format] = pd.DataFrame([
+                dict(
+                    quality=np.mean(merged["quality"]),
+                    **self.baseline_averages(merged,
+                                             rd_store.lossy_weighted))
+                for merged in (pd.concat([data.iloc[[i]] for data in images])
+                               for i in range(len(qualities)))
+            ])
+        return (lossless, lossy)
+
+    def baseline_averages(self, data, weighted):
+        avg_compression_ratio = np.sum(data["orig_file_size"]) / np.sum(
+            data["compressed_file_size"])
+        averages = {
+            "avg_bpp":
+            np.sum(data["compressed_file_size"]) * 8 / np.sum(data["pixels"]),
+            "avg_compression_ratio": avg_compression_ratio,
+            "avg_space_saving": 1 - (1 / avg_compression_ratio)
+        }
+        for column in weighted:
+            averages["wavg_" + column] = np.average(data[column],
+                                                    weights=data["pixels"])
+        return averages
+
+    def check_averages(self):
+        rd_average.main(["rd_average.py", "-j", "1", "results/subset", "ref"])
+        lossless, lossy = self.baseline()
+
+        data = pd.read_csv("results/subset/subset.lossless.out", sep=":",
+                           index_col=0)
+        self.assertEqual(sorted(data.index), sorted(formats))
+        for format in formats:
+            for column, value in lossless[format].items():
+                self.assertAlmostEqual(data.loc[format, column], value,
+                                       places=9, msg=column)
+
+        for format in formats:
+            data = pd.read_csv(
+                "results/subset/subset." + format + ".lossy.out", sep=":")
+            expected = lossy[format]
+            self.assertEqual(len(data), len(qualities))
+            for column in expected.columns:
+                np.testing.assert_allclose(data[column], expected[column],
+                                           rtol=1e-12, err_msg=column)
+
+    def test_database_sums(self):
+        self.write_store()
+        self.check_averages()
+
+    def test_results_files(self):
+        self.write_files()
+        # A single image per chunk, the sums being added chunk by chunk
+        rd_average.get_chunk_rows = lambda columns: 1
+        self.check_averages()
+
+    # Results files written before the times added to rd_collect.py
+    def test_old_results_files(self):
+        self.write_files()
+        old_columns = 8
+        for path in glob.glob("results/subset/*/lossless/*.out"):
+            data = pd.read_csv(path, sep=":")
+            data.iloc[:, :old_columns].to_csv(path, sep=":", index=False)
+
+        rd_average.main(["rd_average.py", "-j", "1", "results/subset", "ref"])
+        with open("results/subset/subset.lossless.out") as file:
+            header = file.readline().strip().split(":")
+        self.assertEqual(header, [
+            "format", "format", "avg_bpp", "avg_compression_ratio",
+            "avg_space_saving", "wavg_encode_time", "wavg_decode_time",
+            "weissman_score"
+        ])
+        data = pd.read_csv("results/subset/subset.lossless.out", sep=":",
+                           index_col=0)
+        self.assertFalse(data.isna().any().any())
+        with open("results/subset/subset.lossless.md") as file:
+            self.assertNotIn("wavg_encode_time_min", file.read())
+
+    # Runs rd_average.py, which must fail with a message containing error
+    def check_error(self, error, *options):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(SystemExit):
+                rd_average.main(["rd_average.py", "-j", "1"] + list(options) +
+                                ["results/subset", "ref"])
+        self.assertIn(error, output.getvalue())
+
+    def test_missing_rows(self):
+        self.lossy["other"][1] = self.lossy["other"][1][1:]
+        for write in (self.write_store, self.write_files):
+            with self.subTest(write=write.__name__):
+                shutil.rmtree("results", ignore_errors=True)
+                write()
+                self.check_error("do not have the same number of rows")
+
+    def test_other_qualities(self):
+        rows = self.lossy["other"][2]
+        self.lossy["other"][2] = [(row[0], row[1] + 5) + row[2:]
+                                  for row in rows]
+        for write in (self.write_store, self.write_files):
+            with self.subTest(write=write.__name__):
+                shutil.rmtree("results", ignore_errors=True)
+                write()
+                self.check_error("same quality for every image at row 0")
+                # The qualities of the targets of --target-bpp differ
+                rd_average.main([
+                    "rd_average.py", "-j", "1", "--target-bpp",
+                    "results/subset", "ref"
+                ])
+                rd_average.target_bpp = False
+
+
+if __name__ == "__main__":
+    unittest.main()
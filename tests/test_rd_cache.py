@@ -0,0 +1,129 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import shutil
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_cache
+import rd_collect
+from test_rd_collect import SubsetTest
+
+# Tests of the metric cache of rd_cache.py, through runs of rd_collect.py on
+# a subset with the stand-in tools of rd_bench.py
+
+
+class MetricCacheTest(SubsetTest):
+    columns = ("file_name, quality, compressed_file_size, decode_time, "
+               "y_ssim_score, rgb_ssim_score, msssim_score, psnrhvsm_score, "
+               "vmaf_score")
+
+    def setUp(self):
+        super().setUp()
+        self.collect()
+        self.lossy = self.read_lossy()
+        self.first = self.tool_counts()
+        self.points = len(self.lossy)
+
+    def tearDown(self):
+        # Opened by rd_cache.main in this process
+        if getattr(rd_cache.connections, "pid", None) == os.getpid():
+            rd_cache.connections.conn.close()
+            del rd_cache.connections.pid
+        super().tearDown()
+
+    def read_lossy(self):
+        conn = sqlite3.connect("results/subset/subset.sqlite")
+        try:
+            return conn.execute("SELECT " + self.columns +
+                                " FROM lossy ORDER BY file_name, quality"
+                                ).fetchall()
+        finally:
+            conn.close()
+
+    # Runs the subset again from scratch, but for the metric cache.
+    # Returns the number of runs of each stand-in tool.
+    def collect_again(self):
+        shutil.rmtree("results/subset")
+        shutil.rmtree("BENCH_out")
+        self.collect()
+        return self.tool_counts()
+
+    # Changes a stand-in tool, as an update of the program would
+    def change_tool(self, name):
+        with open(os.path.join("bin", name), "a") as file:
+            file.write("# changed\n")
+
+    # Identical bitstreams are not decoded nor scored again, their decode
+    # timings and scores being the cached ones
+    def test_hits(self):
+        counts = self.collect_again()
+        self.assertEqual(counts["rd_bench_enc"], self.first["rd_bench_enc"])
+        self.assertEqual(counts["rd_bench_dec"],
+                         self.first["rd_bench_dec"] - self.points)
+        self.assertEqual(counts.get("dump_ssim", 0), 0)
+        self.assertEqual(counts.get("vmafossexec", 0), 0)
+        self.assertEqual(self.read_lossy(), self.lossy)
+
+    def test_changed_tools(self):
+        for name in ("rd_bench_dec", "dump_psnrhvs", "vmafossexec"):
+            with self.subTest(tool=name):
+                self.change_tool(name)
+                counts = self.collect_again()
+                self.assertEqual(counts["rd_bench_dec"],
+                                 self.first["rd_bench_dec"])
+                self.assertEqual(counts["dump_psnrhvs"], self.points)
+
+    def test_changed_image(self):
+        os.rename("subset/img0.png", "subset/img0.tmp")
+        shutil.copy("subset/img1.png", "subset/img0.png")
+        counts = self.collect_again()
+        # The bitstreams of the first image changed with its content
+        self.assertEqual(counts["dump_psnrhvs"], self.points // 2)
+
+    def test_disabled(self):
+        rd_collect.metric_cache = False
+        try:
+            counts = self.collect_again()
+        finally:
+            rd_collect.metric_cache = True
+        self.assertEqual(counts["dump_psnrhvs"], self.points)
+
+    def test_clear(self):
+        rd_cache.main(["rd_cache.py", "clear"])
+        counts = self.collect_again()
+        self.assertEqual(counts["dump_psnrhvs"], self.points)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,610 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import sys
+import glob
+import json
+import shutil
+import time
+import sqlite3
+import tempfile
+import threading
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_bench
+import rd_store
+import rd_collect
+
+# Tests of rd_collect.py: target bpp search, with stand-in size functions
+# instead of encoders, packing of tasks by their resources, with a pool of
+# threads instead of processes, and runs of whole subsets with the stand-in
+# tools of rd_bench.py
+
+
+class Encoder:
+    def __init__(self, size):
+        self.size = size
+        self.calls = []
+
+    def __call__(self, quality):
+        self.calls.append(quality)
+        return self.size(quality)
+
+
+class FindTargetQualitiesTest(unittest.TestCase):
+    pixels = 1000
+
+    def find(self, size, quality_list, targets):
+        encoder = Encoder(size)
+        qualities = rd_collect.find_target_qualities(encoder, quality_list,
+                                                     targets, self.pixels)
+        self.assertEqual(len(encoder.calls), len(set(encoder.calls)))
+        return qualities, encoder
+
+    def bpp(self, size, quality):
+        return size(quality) * 8 / self.pixels
+
+    def assertNearTarget(self, size, quality, target):
+        self.assertLessEqual(
+            abs(self.bpp(size, quality) - target),
+            rd_collect.bpp_tolerance * target)
+
+    def test_increasing(self):
+        # bpp = 0.8 * quality
+        def size(quality):
+            return quality * 100
+
+        targets = [8, 20.4, 56, 79]
+        qualities, encoder = self.find(size, list(range(101)), targets)
+        for quality, target in zip(qualities, targets):
+            self.assertNearTarget(size, quality, target)
+        # A bisection, not a scan of the range
+        self.assertLess(len(encoder.calls), 2 + len(targets) *
+                        rd_collect.bisect_max_steps)
+
+    def test_decreasing(self):
+        # Quantizer-like scale, bpp = 0.8 * (100 - quality)
+        def size(quality):
+            return (100 - quality) * 100
+
+        targets = [8, 40, 72]
+        qualities, encoder = self.find(size, list(range(101)), targets)
+        for quality, target in zip(qualities, targets):
+            self.assertNearTarget(size, quality, target)
+        self.assertEqual(qualities, sorted(qualities, reverse=True))
+
+    def test_clamped(self):
+        def increasing(quality):
+            return quality * 100
+
+        def decreasing(quality):
+            return (100 - quality) * 100
+
+        quality_list = list(range(10, 91))
+        self.assertEqual(
+            self.find(increasing, quality_list, [0.01, 1000])[0], [10, 90])
+        self.assertEqual(
+            self.find(decreasing, quality_list, [0.01, 1000])[0], [90, 10])
+
+    def test_nonlinear(self):
+        # Sizes growing fast at the top of the range, with steps of several
+        # qualities giving the same size, so that some targets can only be
+        # approached
+        def size(quality):
+            return (quality // 4 * 4)**2
+
+        targets = [1, 10, 50]
+        qualities, encoder = self.find(size, list(range(101)), targets)
+        for quality, target in zip(qualities, targets):
+            best = min(
+                abs(self.bpp(size, other) - target) for other in range(101))
+            self.assertAlmostEqual(
+                abs(self.bpp(size, quality) - target), best)
+
+    def test_float_qualities(self):
+        def size(quality):
+            return quality * 1000
+
+        quality_list = [i / 4 for i in range(41)]
+        qualities, encoder = self.find(size, quality_list, [20, 61])
+        for quality, target in zip(qualities, [20, 61]):
+            self.assertIsInstance(quality, float)
+            self.assertNearTarget(size, quality, target)
+
+    def test_measures_shared(self):
+        def size(quality):
+            return quality * 100
+
+        encoder = Encoder(size)
+        rd_collect.find_target_qualities(encoder, list(range(101)),
+                                         [40, 40.5], self.pixels)
+        once = len(encoder.calls)
+        encoder = Encoder(size)
+        rd_collect.find_target_qualities(encoder, list(range(101)), [40],
+                                         self.pixels)
+        self.assertEqual(once, len(encoder.calls))
+
+
+# Settings of rd_collect.py changed by the runs of a subset, restored after
+# each test
+run_settings = [
+    "convert", "metric_engine", "tmpdir", "refcache_dir", "lossless_repeat",
+    "lossy_repeat", "lossless_warmup", "lossy_warmup", "resources_file",
+    "stream_decode"
+]
+
+# Settings of rd_collect.py set by its options, back to their defaults before
+# each run
+option_settings = [
+    "bpp_tolerance", "out_files", "pipeline_depth", "metrics_only",
+    "keep_decoded", "metric_batch", "cores", "memory_budget"
+]
+
+
+# Stands for the Pool of rd_collect.py, running each task for a while in a
+# thread, and recording the threads used by the tasks running at once
+class ThreadPool:
+    def __init__(self, processes):
+        self.lock = threading.Lock()
+        self.used = 0
+        self.peaks = []
+
+    def apply_async(self, func, args, callback, error_callback):
+        task = args[0]
+        threads = rd_collect.task_resources(task, {})[0]
+
+        def run():
+            with self.lock:
+                self.used += threads
+                self.peaks.append((task[3], self.used))
+            time.sleep(0.05)
+            with self.lock:
+                self.used -= threads
+            callback((task[0], task[3], task[6], [], {}))
+
+        threading.Thread(target=run).start()
+
+    def terminate(self):
+        pass
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+# Stands for the TaskResults of rd_collect.py, all the tasks remaining
+class Results:
+    def __init__(self, tasks):
+        self.remaining_tasks = tasks
+
+    def add(self, format, origpng, quality, rows):
+        pass
+
+    def finish(self):
+        pass
+
+
+class ResourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = {
+            name: getattr(rd_collect, name)
+            for name in option_settings +
+            ["Pool", "TaskResults", "resources_file"]
+        }
+        self.workdir = tempfile.TemporaryDirectory()
+        rd_collect.resources_file = os.path.join(self.workdir.name,
+                                                 "resources.json")
+        rd_collect.TaskResults = Results
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(rd_collect, name, value)
+        self.workdir.cleanup()
+
+    def task(self, name, quality, **recipe):
+        return ("bench", dict(rd_bench.recipe, **recipe), "subset", name, 100,
+                100, quality)
+
+    def test_task_threads(self):
+        rd_collect.pipeline_depth = 2
+        points = {"qualities": [10, 55, 100]}
+        self.assertEqual(
+            rd_collect.task_resources(
+                self.task("a.png", 10, encode_threads=3), {})[0], 3)
+        # Five metric programs for each of two points scored at once
+        self.assertEqual(
+            rd_collect.task_resources(
+                self.task("a.png", points, encode_threads=3), {})[0], 13)
+        self.assertEqual(
+            rd_collect.task_resources(
+                self.task("a.png", {"qualities": [10]}), {})[0], 6)
+        rd_collect.pipeline_depth = 0
+        rd_collect.metric_batch = 3
+        self.assertEqual(
+            rd_collect.task_resources(
+                self.task("a.png", points, encode_threads=3), {})[0], 4)
+
+    def test_packing(self):
+        rd_collect.cores = 4
+        rd_collect.memory_budget = 2**20
+        rd_collect.pipeline_depth = 1
+        pools = []
+
+        def make_pool(processes):
+            pools.append(ThreadPool(processes))
+            return pools[-1]
+
+        rd_collect.Pool = make_pool
+        # The pipeline task needs 2 + 5 threads, more than the cores
+        tasks = [
+            self.task("img%d.png" % index, 10, encode_threads=2)
+            for index in range(4)
+        ] + [self.task("big.png", {"qualities": [10]}, encode_threads=2)]
+        rd_collect.run_tasks(tasks, 4)
+
+        peaks = dict(pools[0].peaks)
+        self.assertEqual(len(peaks), 5)
+        self.assertEqual(peaks["big.png"], 7)
+        self.assertLessEqual(
+            max(used for name, used in peaks.items() if name != "big.png"),
+            4)
+        self.assertEqual(max(peaks.values()), 7)
+
+    def test_main_reads_machine(self):
+        rd_collect.cores = 1
+        rd_collect.memory_budget = 1
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        try:
+            with open("recipes.json", "w") as json_file:
+                json.dump({"recipes": {"bench": rd_bench.recipe}}, json_file)
+            with open(os.devnull, "w") as null, contextlib.redirect_stdout(
+                    null):
+                rd_collect.main(["rd_collect.py"])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(rd_collect.cores, os.cpu_count())
+        self.assertGreater(rd_collect.memory_budget, 1)
+
+
+# Runs rd_collect.py on a subset of small images in a temporary directory,
+# with the stand-in tools of rd_bench.py
+class SubsetTest(unittest.TestCase):
+    images = 2
+    recipe = dict(rd_bench.recipe, quality_start=10, quality_end=100,
+                  quality_step=45)
+
+    def setUp(self):
+        self.saved = {
+            name: getattr(rd_collect, name)
+            for name in run_settings + option_settings
+        }
+        self.cwd = os.getcwd()
+        self.path = os.environ["PATH"]
+        self.workdir = tempfile.TemporaryDirectory()
+        workdir = self.workdir.name
+        os.chdir(workdir)
+
+        bin_dir = os.path.join(workdir, "bin")
+        rd_bench.install_tools(bin_dir)
+        os.environ["PATH"] = bin_dir + os.pathsep + self.path
+        self.tool_log = os.path.join(workdir, "tools.log")
+        os.environ["RD_BENCH_LOG"] = self.tool_log
+
+        rd_collect.convert = "rd_bench_convert"
+        rd_collect.metric_engine = "external"
+        rd_collect.tmpdir = workdir + "/tmp/"
+        rd_collect.refcache_dir = rd_collect.tmpdir + "rd_refcache/"
+        os.makedirs(rd_collect.tmpdir)
+
+        os.makedirs("subset")
+        for index in range(self.images):
+            rd_bench.make_image("subset/img%d.png" % index, index)
+        self.write_recipe(self.recipe)
+
+    def tearDown(self):
+        self.close_stores()
+        os.chdir(self.cwd)
+        os.environ["PATH"] = self.path
+        del os.environ["RD_BENCH_LOG"]
+        for name, value in self.saved.items():
+            setattr(rd_collect, name, value)
+        rd_collect.unstreamable_formats.clear()
+        self.workdir.cleanup()
+
+    def close_stores(self):
+        for conn in rd_collect.stores.values():
+            conn.close()
+        rd_collect.stores.clear()
+
+    def write_recipe(self, recipe):
+        with open("recipes.json", "w") as json_file:
+            json.dump({"recipes": {"bench": recipe}}, json_file)
+
+    def collect(self, *options):
+        for name in option_settings:
+            setattr(rd_collect, name, self.saved[name])
+        rd_collect.main(["rd_collect.py", "-j", "1", "--repeat", "1"] +
+                        list(options) + ["bench", "subset", "subset"])
+        self.close_stores()
+
+    # Returns the number of runs of each stand-in tool since the last call
+    def tool_counts(self):
+        try:
+            with open(self.tool_log) as file:
+                calls = [line.split()[0] for line in file]
+        except FileNotFoundError:
+            return {}
+        os.remove(self.tool_log)
+        return {name: calls.count(name) for name in set(calls)}
+
+    # Returns the number of runs of the stand-in tool since the last call
+    def tool_calls(self, name):
+        return self.tool_counts().get(name, 0)
+
+    def read_rows(self, table):
+        conn = sqlite3.connect("results/subset/subset.sqlite")
+        try:
+            return conn.execute("SELECT * FROM " + table +
+                                " ORDER BY file_name").fetchall()
+        finally:
+            conn.close()
+
+
+class JournalResumeTest(SubsetTest):
+    def test_resume(self):
+        self.collect()
+        journal = rd_collect.journal_path("subset", "bench")
+        with open(journal) as file:
+            lines = file.readlines()
+        tasks = len(lines)
+        self.assertEqual(tasks, self.images * 3)
+        self.assertEqual(self.tool_calls("rd_bench_enc"), tasks)
+        lossless = self.read_rows("lossless")
+        lossy = self.read_rows("lossy")
+
+        # A run interrupted after three tasks, the lossless ones and a lossy
+        # one, while journaling the fourth, and before any image was complete
+        # in the database
+        kept = 3
+        with open(journal, "w") as file:
+            file.writelines(lines[:kept])
+            file.write(lines[kept][:len(lines[kept]) // 2])
+        os.remove("results/subset/subset.sqlite")
+
+        self.collect()
+        self.assertEqual(self.tool_calls("rd_bench_enc"), tasks - kept)
+        with open(journal) as file:
+            records = []
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+        keys = [(record["image"], json.dumps(record["quality"]))
+                for record in records]
+        self.assertEqual(len(keys), tasks)
+        self.assertEqual(len(set(keys)), tasks)
+
+        # Replayed rows are the ones of the first run, and the task whose
+        # record was cut short gives a single set of rows
+        self.assertEqual(len(self.read_rows("lossless")), len(lossless))
+        self.assertEqual(len(self.read_rows("lossy")), len(lossy))
+        journaled = [json.loads(line) for line in lines[:kept]]
+        for record in journaled:
+            if record["quality"] is None:
+                table = [row[1:] for row in self.read_rows("lossless")]
+            else:
+                table = [row[2:] for row in self.read_rows("lossy")]
+            for row in record["rows"]:
+                self.assertIn(tuple(row), table)
+
+        # Nothing is run again once the subset is complete
+        self.collect()
+        self.assertEqual(self.tool_calls("rd_bench_enc"), 0)
+
+    # Points journaled by tasks of a single point are not run again by the
+    # tasks of several points of --batch-metrics, and the other way round
+    def test_resume_other_mode(self):
+        self.collect()
+        journal = rd_collect.journal_path("subset", "bench")
+        with open(journal) as file:
+            lines = file.readlines()
+        tasks = len(lines)
+        self.tool_counts()
+
+        kept = 3
+        with open(journal, "w") as file:
+            file.writelines(lines[:kept])
+        os.remove("results/subset/subset.sqlite")
+        self.collect("--batch-metrics", "3")
+        self.assertEqual(self.tool_calls("rd_bench_enc"), tasks - kept)
+        with open(journal) as file:
+            self.assertEqual(len(file.readlines()), tasks)
+        lossy = sorted(self.read_rows("lossy"))
+
+        os.remove("results/subset/subset.sqlite")
+        self.collect()
+        self.assertEqual(self.tool_calls("rd_bench_enc"), 0)
+        self.assertEqual(sorted(self.read_rows("lossy")), lossy)
+
+
+# Runs of --metrics-only, which reuse the encodes recorded in the manifest
+# whose inputs did not change
+class ManifestTest(SubsetTest):
+    def setUp(self):
+        super().setUp()
+        self.collect()
+        self.first = self.tool_counts()
+        self.encodes = self.first["rd_bench_enc"]
+        self.lossy = self.read_rows("lossy")
+
+    def read_manifest(self):
+        records = []
+        for path in glob.glob("BENCH_out/*/manifest.jsonl"):
+            with open(path) as file:
+                records.extend(json.loads(line) for line in file)
+        return records
+
+    def test_reuse(self):
+        records = self.read_manifest()
+        self.assertEqual(len(records), self.encodes)
+        self.assertEqual(len(set(record["target"] for record in records)),
+                         self.encodes)
+
+        self.collect("--metrics-only")
+        counts = self.tool_counts()
+        self.assertEqual(counts.get("rd_bench_enc", 0), 0)
+        # Every image is decoded and scored again
+        self.assertEqual(counts["rd_bench_dec"], self.first["rd_bench_dec"])
+        self.assertEqual(counts["dump_psnrhvs"], self.first["dump_psnrhvs"])
+        lossy = self.read_rows("lossy")
+        columns = [name for name, type in rd_store.lossy_columns]
+        encode_time = columns.index("encode_time") + 2
+        self.assertEqual([row[encode_time] for row in lossy],
+                         [row[encode_time] for row in self.lossy])
+
+    def test_changed_encoder(self):
+        with open(os.path.join("bin", "rd_bench_enc"), "a") as file:
+            file.write("# changed\n")
+        self.collect("--metrics-only")
+        self.assertEqual(self.tool_calls("rd_bench_enc"), self.encodes)
+        self.assertEqual(len(self.read_manifest()), 2 * self.encodes)
+
+    def test_changed_inputs(self):
+        # An encoded image changed since, and an original image whose
+        # encodes are all done again
+        target = sorted(glob.glob("BENCH_out/subset/*/*.rdb"))[0]
+        with open(target, "ab") as file:
+            file.write(b"\0")
+        os.remove("subset/img1.png")
+        rd_bench.make_image("subset/img1.png", 5)
+        self.collect("--metrics-only")
+        encodes = self.encodes // self.images
+        if "img1" not in target:
+            encodes += 1
+        self.assertEqual(self.tool_calls("rd_bench_enc"), encodes)
+
+# Runs of the pipeline of --pipeline, which give the rows of the runs of one
+# quality point per task, timings aside
+class PipelineTest(SubsetTest):
+    columns = ("file_name, quality, orig_file_size, compressed_file_size, "
+               "pixels, bpp, compression_ratio, y_ssim_score, "
+               "rgb_ssim_score, msssim_score, psnrhvsm_score, vmaf_score")
+
+    def read_untimed(self):
+        conn = sqlite3.connect("results/subset/subset.sqlite")
+        try:
+            return conn.execute("SELECT " + self.columns +
+                                " FROM lossy ORDER BY file_name, quality"
+                                ).fetchall()
+        finally:
+            conn.close()
+
+    def test_pipeline(self):
+        for pipe_target in (None, "/dev/stdout"):
+            recipe = dict(self.recipe)
+            if pipe_target is not None:
+                recipe['decode_pipe_target'] = pipe_target
+            self.write_recipe(recipe)
+            shutil.rmtree("results", ignore_errors=True)
+            shutil.rmtree("BENCH_out", ignore_errors=True)
+            self.collect()
+            rows = self.read_untimed()
+            self.assertEqual(len(rows), self.images * 2)
+
+            for depth in ("1", "2"):
+                with self.subTest(pipe_target=pipe_target, depth=depth):
+                    shutil.rmtree("results", ignore_errors=True)
+                    shutil.rmtree("BENCH_out", ignore_errors=True)
+                    self.tool_counts()
+                    self.collect("--pipeline", depth)
+                    self.assertEqual(self.read_untimed(), rows)
+                    self.assertEqual(self.tool_calls("rd_bench_enc"),
+                                     self.images * 3)
+
+
+class StreamDecodeTest(SubsetTest):
+    scores = ("file_name, quality, y_ssim_score, rgb_ssim_score, "
+              "msssim_score, psnrhvsm_score, vmaf_score")
+
+    def read_scores(self):
+        conn = sqlite3.connect("results/subset/subset.sqlite")
+        try:
+            return conn.execute("SELECT " + self.scores +
+                                " FROM lossy ORDER BY file_name, quality"
+                                ).fetchall()
+        finally:
+            conn.close()
+
+    # Runs the subset from scratch.
+    # Returns tuple containing:
+    #   (scores, tool_counts)
+    def run_subset(self, pipe_target, *options):
+        shutil.rmtree("results", ignore_errors=True)
+        recipe = dict(self.recipe)
+        if pipe_target is not None:
+            recipe['decode_pipe_target'] = pipe_target
+        self.write_recipe(recipe)
+        self.tool_counts()
+        self.collect(*options)
+        return (self.read_scores(), self.tool_counts())
+
+    def test_streamed(self):
+        files, file_counts = self.run_subset(None)
+
+        for options in ([], ["--pipeline", "3"], ["--batch-metrics", "3"]):
+            with self.subTest(options=options):
+                scores, counts = self.run_subset("/dev/stdout", *options)
+                self.assertEqual(scores, files)
+                self.assertEqual(counts["rd_bench_dec"],
+                                 file_counts["rd_bench_dec"])
+                # The references are in the cache since the first run, and
+                # the decoded images are not converted for the metrics
+                self.assertEqual(counts.get("rd_bench_convert", 0), 0)
+
+    def test_fallback(self):
+        files, file_counts = self.run_subset(None)
+
+        # The decoder writes nothing on its standard output, the first point
+        # is decoded again to a file, and so are the next ones
+        scores, counts = self.run_subset("/dev/null")
+        self.assertEqual(scores, files)
+        self.assertEqual(counts["rd_bench_dec"],
+                         file_counts["rd_bench_dec"] + 1)
+        self.assertGreater(counts["rd_bench_convert"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
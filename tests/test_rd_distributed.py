@@ -0,0 +1,185 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_collect
+import rd_distributed
+from test_rd_collect import SubsetTest
+
+# Tests of rd_distributed.py: a coordinator and a worker on localhost, with
+# the tcp: and dir: transports, running the subset of SubsetTest with the
+# stand-in tools of rd_bench.py
+
+
+class DistributedTest(SubsetTest):
+    results = ("SELECT file_name, quality, orig_file_size, "
+               "compressed_file_size, pixels, y_ssim_score, rgb_ssim_score, "
+               "msssim_score, psnrhvsm_score, vmaf_score FROM lossy "
+               "UNION ALL SELECT file_name, NULL, orig_file_size, "
+               "compressed_file_size, pixels, NULL, NULL, NULL, NULL, NULL "
+               "FROM lossless ORDER BY 1, 2")
+
+    def setUp(self):
+        super().setUp()
+        self.poll_interval = rd_distributed.poll_interval
+        self.tmpdir = rd_distributed.tmpdir
+        rd_distributed.poll_interval = 0.1
+        rd_distributed.tmpdir = rd_collect.tmpdir
+
+        # Results of a run of rd_collect.py, without the timings
+        self.collect()
+        self.expected = self.read_results()
+        shutil.rmtree("results")
+        shutil.rmtree("BENCH_out")
+        self.tool_counts()
+
+    def tearDown(self):
+        rd_distributed.poll_interval = self.poll_interval
+        rd_distributed.tmpdir = self.tmpdir
+        super().tearDown()
+
+    def read_results(self):
+        conn = sqlite3.connect("results/subset/subset.sqlite")
+        try:
+            return conn.execute(self.results).fetchall()
+        finally:
+            conn.close()
+
+    # Runs a coordinator in this process and a worker in a child process,
+    # in its own directory, which starts once the coordinator has removed
+    # the finished file of the shared directory
+    def distribute(self, address, shared=None):
+        worker_dir = os.path.abspath("worker")
+        os.makedirs(worker_dir, exist_ok=True)
+
+        def run_worker():
+            os.chdir(worker_dir)
+            while shared and os.path.exists(os.path.join(shared, "finished")):
+                time.sleep(0.05)
+            rd_distributed.run_worker(address)
+
+        worker = multiprocessing.get_context("fork").Process(target=run_worker)
+        worker.start()
+        try:
+            rd_distributed.main([
+                "rd_distributed.py", "coordinator", address, "bench",
+                "subset", "subset"
+            ])
+        finally:
+            worker.join(60)
+            self.close_stores()
+        self.assertEqual(worker.exitcode, 0)
+
+    def test_tcp(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.distribute("tcp:127.0.0.1:%d" % port)
+        # The worker was sent the original images it did not have, whose
+        # path is written in the bitstreams of the stand-in encoder, which
+        # changes their sizes
+        self.assertTrue(
+            os.path.isfile(rd_collect.tmpdir + "rd_sources/subset/img0.png"))
+        without_sizes = [row[:3] + row[4:] for row in self.expected]
+        self.assertEqual(
+            [row[:3] + row[4:] for row in self.read_results()], without_sizes)
+
+    def test_dir_restart(self):
+        shared = os.path.abspath("shared")
+        tasks = rd_collect.get_tasks("bench", self.recipe, "subset",
+                                     glob.glob("subset/*.png"))
+        key = list(rd_distributed.task_key(json.loads(json.dumps(tasks[0]))))
+
+        # Files left by a crashed run: tasks, a leased task, and results
+        # with the lease ids of that run and of an older version, of rows
+        # which are not the ones of the subset
+        for state in ("tasks", "leased", "done"):
+            os.makedirs(os.path.join(shared, state))
+        for lease_id in ("1", "0badcafe-1", "0badcafe-2"):
+            for state in ("tasks", "leased"):
+                rd_distributed.write_json_atomic(
+                    os.path.join(shared, state, lease_id + ".json"), {
+                        "lease": lease_id,
+                        "task": tasks[0],
+                        "timeout": 60
+                    })
+            rd_distributed.write_json_atomic(
+                os.path.join(shared, "done", lease_id + ".old.json"), {
+                    "lease": lease_id,
+                    "key": key,
+                    "rows": [["img0"] + [1] * 15],
+                    "files": {},
+                    "manifest": []
+                })
+        with open(os.path.join(shared, "finished"), "w"):
+            pass
+
+        self.distribute("dir:" + shared, shared)
+        self.assertEqual(self.read_results(), self.expected)
+        for state in ("tasks", "leased", "done"):
+            self.assertEqual(os.listdir(os.path.join(shared, state)), [])
+
+    def test_complete_checks_key(self):
+        tasks = rd_collect.get_tasks("bench", self.recipe, "subset",
+                                     glob.glob("subset/*.png"))
+        results = rd_collect.TaskResults(tasks)
+        try:
+            coordinator = rd_distributed.Coordinator(results)
+            lease_id, task = coordinator.lease()
+            other_id, other = coordinator.lease()
+            self.assertNotEqual(lease_id, other_id)
+            key = list(rd_distributed.task_key(task))
+            other_key = list(rd_distributed.task_key(other))
+
+            self.assertFalse(
+                coordinator.complete(lease_id, other_key, [], {}, []))
+            self.assertFalse(
+                coordinator.complete(lease_id.split("-")[-1], key, [], {},
+                                     []))
+            self.assertTrue(coordinator.complete(lease_id, key, [], {}, []))
+            # Later runs hand out other lease ids
+            again = rd_distributed.Coordinator(results)
+            self.assertNotEqual(again.lease()[0], lease_id)
+        finally:
+            results.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
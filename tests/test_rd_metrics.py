@@ -0,0 +1,139 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_metrics
+
+# Parity of rd_metrics.py with dump_ssim, dump_msssim and dump_psnrhvs, on
+# the fixture images of tests/data, each scored against its -dist version.
+# The scores of the daala tools are recorded in parity_scores.json by
+# running this file with the record argument, the tools being in the PATH.
+# Without recorded scores, the tools are run when they are in the PATH.
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+scores_file = os.path.join(data_dir, "parity_scores.json")
+fixtures = ["gradient", "texture", "checker-odd"]
+metrics = ["y_ssim_score", "rgb_ssim_score", "msssim_score", "psnrhvsm_score"]
+
+# Largest difference allowed with the daala tools, in dB. rd_metrics.py uses
+# the tables of the tools, and its DCT differs from the integer one of
+# dump_psnrhvs by at most one per coefficient.
+tolerance = 0.01
+
+
+def fixture_paths(name):
+    return (os.path.join(data_dir, name + ".y4m"),
+            os.path.join(data_dir, name + "-dist.y4m"))
+
+
+def read_recorded_scores():
+    if not os.path.isfile(scores_file):
+        return None
+    with open(scores_file) as file:
+        return json.load(file)
+
+
+# Returns the scores of the daala tools for each fixture, or None if they are
+# not in the PATH
+def tool_scores():
+    import shutil
+    import rd_collect
+
+    cmds = [
+        rd_collect.yssim, rd_collect.rgbssim, rd_collect.msssim,
+        rd_collect.psnrhvsm
+    ]
+    if not all(shutil.which(cmd.split()[0]) for cmd in cmds):
+        return None
+    tools = [
+        rd_collect.score_y_ssim, rd_collect.score_rgb_ssim,
+        rd_collect.score_msssim, rd_collect.score_psnrhvsm
+    ]
+    return {
+        name: {
+            metric: tool(*fixture_paths(name))
+            for metric, tool in zip(metrics, tools)
+        }
+        for name in fixtures
+    }
+
+
+def record_scores():
+    recorded = tool_scores()
+    if recorded is None:
+        sys.exit("dump_ssim, dump_msssim and dump_psnrhvs must be in the PATH")
+    with open(scores_file, "w") as file:
+        json.dump(recorded, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+class ParityTest(unittest.TestCase):
+    def test_parity(self):
+        expected = read_recorded_scores() or tool_scores()
+        if expected is None:
+            self.skipTest("no scores of the daala tools recorded in " +
+                          scores_file + ", and the tools are not in the PATH")
+        for name in fixtures:
+            scores = rd_metrics.score_y4m(*fixture_paths(name))
+            for metric, score in zip(metrics, scores):
+                with self.subTest(image=name, metric=metric):
+                    self.assertAlmostEqual(
+                        score, expected[name][metric], delta=tolerance)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_identical(self):
+        frame = rd_metrics.read_y4m(fixture_paths("texture")[0])[0]
+        scores = rd_metrics.score_frames(frame, frame)
+        self.assertEqual(scores, (rd_metrics.max_db, ) * 4)
+
+    def test_small_image(self):
+        rng = np.random.default_rng(0)
+        img1 = rng.integers(0, 256, (5, 7)).astype(np.float64)
+        img2 = img1 + rng.normal(0, 8, img1.shape)
+        mse_score = 1 - np.mean((img1 - img2)**2) / (255 * 255)
+        score = rd_metrics.ssim(img1, img2)
+        self.assertLess(score, 1)
+        self.assertNotAlmostEqual(score, mse_score)
+        self.assertRaises(ValueError, rd_metrics.msssim, img1, img2)
+        self.assertRaises(ValueError, rd_metrics.ssim, img1[:0], img2[:0])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["record"]:
+        record_scores()
+    else:
+        unittest.main()
@@ -0,0 +1,143 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_store
+import rd_plot
+
+# Tests of the incremental drawing of rd_plot.py: charts whose spec and data
+# did not change are skipped. The charts are drawn by record_chart, which
+# writes the arguments of render_chart instead of an SVG file, so that the
+# tests do not depend on the backend of matplotlib.
+
+
+def record_chart(args):
+    [svg, subset_name, chart, series] = args
+    with open(svg, "w") as file:
+        json.dump([subset_name, chart, series], file)
+    with open(os.path.join(os.path.dirname(svg), "drawn.log"), "a") as file:
+        file.write(os.path.basename(svg) + "\n")
+
+
+@unittest.skipUnless(importlib.util.find_spec("matplotlib"),
+                     "matplotlib is not installed")
+class IncrementalPlotTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (rd_plot.render_chart, rd_plot.charts)
+        rd_plot.render_chart = record_chart
+        rd_plot.charts = [dict(chart) for chart in rd_plot.charts]
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, "subset")
+        os.makedirs(self.path)
+        self.averages = {
+            format: self.make_averages(offset)
+            for offset, format in enumerate(["ref", "other"])
+        }
+
+    def tearDown(self):
+        rd_plot.render_chart, rd_plot.charts = self.saved
+        self.workdir.cleanup()
+
+    def make_averages(self, offset):
+        import pandas as pd
+
+        data = pd.DataFrame({"avg_bpp": [0.25, 0.5, 1.0]})
+        for chart in rd_plot.charts:
+            data[chart["column"]] = [10.0 + offset, 15.0, 20.0 - offset]
+        return data
+
+    # Returns the names of the charts drawn since the last call
+    def read_log(self):
+        log = os.path.join(self.path, "drawn.log")
+        try:
+            with open(log) as file:
+                names = sorted(line.strip() for line in file)
+        except FileNotFoundError:
+            return []
+        os.remove(log)
+        return names
+
+    # Returns the names of the charts drawn for formats
+    def drawn(self, formats=("ref", "other")):
+        rd_plot.generate_plots(self.path, list(formats), self.averages, 2)
+        return self.read_log()
+
+    def chart_name(self, chart, formats=("ref", "other")):
+        return os.path.basename(
+            rd_plot.chart_path(self.path, "subset", chart, list(formats)))
+
+    def test_skip_unchanged(self):
+        names = sorted(self.chart_name(chart) for chart in rd_plot.charts)
+        self.assertEqual(self.drawn(), names)
+        self.assertEqual(self.drawn(), [])
+
+        vmaf = [chart for chart in rd_plot.charts
+                if chart["name"] == "vmaf"][0]
+        self.averages["other"].loc[1, "wavg_vmaf_score"] = 90.0
+        self.assertEqual(self.drawn(), [self.chart_name(vmaf)])
+
+        # A chart removed, or whose spec changed, is drawn again
+        ssim = rd_plot.charts[0]
+        os.remove(os.path.join(self.path, self.chart_name(ssim)))
+        vmaf["ylim"] = [50, 100]
+        self.assertEqual(self.drawn(),
+                         sorted([self.chart_name(ssim),
+                                 self.chart_name(vmaf)]))
+
+        # Other formats are other charts
+        self.assertEqual(len(self.drawn(["ref"])), len(rd_plot.charts))
+        self.assertEqual(self.drawn(), [])
+
+    # Averages read from the results database by main
+    def test_main(self):
+        conn = rd_store.open_store(rd_store.store_path(self.path))
+        for format, data in self.averages.items():
+            rd_store.write_average(conn, "lossy_average", data, format)
+        conn.close()
+        rd_plot.main(["rd_plot.py", self.path, "ref,other"])
+        self.assertEqual(len(self.read_log()), len(rd_plot.charts))
+        with open(os.path.join(self.path, self.chart_name(
+                rd_plot.charts[0]))) as file:
+            subset_name, chart, series = json.load(file)
+        self.assertEqual(series[1], [
+            "other", [0.25, 0.5, 1.0], [11.0, 15.0, 19.0]
+        ])
+        self.assertEqual(self.drawn(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
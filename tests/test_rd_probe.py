@@ -0,0 +1,99 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_bench
+import rd_probe
+
+# Tests of the image index of rd_probe.py, probed by several processes at
+# once
+
+
+class IndexTest(unittest.TestCase):
+    images = 24
+
+    def setUp(self):
+        self.saved = rd_probe.index_file
+        self.workdir = tempfile.TemporaryDirectory()
+        rd_probe.index_file = os.path.join(self.workdir.name, "results",
+                                           "image_index.json")
+        self.paths = []
+        for index in range(self.images):
+            path = os.path.join(self.workdir.name, "img%d.png" % index)
+            rd_bench.make_image(path, index)
+            self.paths.append(path)
+
+    def tearDown(self):
+        rd_probe.index_file = self.saved
+        self.workdir.cleanup()
+
+    def read_index(self):
+        with open(rd_probe.index_file) as json_file:
+            return json.load(json_file)
+
+    def test_probe(self):
+        infos = rd_probe.get_image_infos(self.paths[:1])
+        info = infos[self.paths[0]]
+        self.assertEqual(info["pixels"], info["width"] * info["height"])
+        self.assertEqual(info["pixel_format"], "rgb8")
+        self.assertEqual(self.read_index(), {self.paths[0]: info})
+
+    # Entries saved by another run since the index was loaded are kept
+    def test_merge(self):
+        index = rd_probe.load_index()
+        rd_probe.get_image_infos(self.paths[:2])
+        info = rd_probe.get_image_info(self.paths[2], index)
+        rd_probe.save_index({self.paths[2]: info})
+        self.assertEqual(sorted(self.read_index()), sorted(self.paths[:3]))
+
+    def test_processes(self):
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=rd_probe.get_image_infos,
+                            args=(self.paths[start::4], ))
+            for start in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(sorted(self.read_index()), sorted(self.paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
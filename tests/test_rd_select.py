@@ -0,0 +1,292 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_bench
+import rd_store
+import rd_select
+import rd_collect
+from test_rd_collect import SubsetTest
+
+# Tests of rd_select.py on a subset run by rd_collect.py with the stand-in
+# tools of rd_bench.py: selection from the size index, export to PNG, and
+# publishing of the selected files
+
+
+class SelectTest(SubsetTest):
+    recipe = dict(SubsetTest.recipe, quality_step=15)
+    collect_options = ["--out-files"]
+    levels = ["lossless", "large", "medium", "small", "tiny"]
+
+    def setUp(self):
+        super().setUp()
+        self.saved_select = (rd_select.convert, rd_select.tmpdir,
+                             rd_select.publish_mode,
+                             rd_select.png_compression)
+        rd_select.convert = "rd_bench_convert"
+        rd_select.tmpdir = rd_collect.tmpdir
+        self.collect(*self.collect_options)
+        self.names = ["img%d" % index for index in range(self.images)]
+        # References looked up by rd_select.py, as in rd_bench.py
+        for name in self.names:
+            reference = "BPG_out/subset/" + name + "/" + name + "-q24.bpg"
+            os.makedirs(os.path.dirname(reference))
+            shutil.copy(
+                rd_collect.get_lossy_target("subset", "subset/" + name +
+                                            ".png", "bench", self.recipe, 55),
+                reference)
+        self.tool_counts()
+
+    def tearDown(self):
+        (rd_select.convert, rd_select.tmpdir, rd_select.publish_mode,
+         rd_select.png_compression) = self.saved_select
+        super().tearDown()
+
+    def select(self, *options):
+        rd_select.main(["rd_select.py"] + list(options) +
+                       ["bench", "subset", "subset"])
+
+    def encoded_dir(self, name):
+        return "BENCH_out/subset/" + name + "/"
+
+    # Returns the encoded files which rd_select.py should select for an
+    # image, at each level, from its encoded files
+    def expected_selection(self, name):
+        sizes = rd_select.scan_sizes(self.encoded_dir(name))
+        size = os.path.getsize("BPG_out/subset/" + name + "/" + name +
+                               "-q24.bpg")
+        selection = [name + "-lossless.rdb"]
+        for level in self.levels[1:]:
+            selection.append(rd_select.find_closest_size(size, sizes))
+            size *= 0.60
+        return selection
+
+    def published_path(self, level, name):
+        return ("comparisonfiles/subset/" + level + "/BENCH/" + name +
+                ".rdb")
+
+    def check_published(self, names):
+        for name in names:
+            self.assertTrue(
+                os.path.isfile("comparisonfiles/subset/Original/" + name +
+                               ".png"))
+            for level, selected in zip(self.levels,
+                                       self.expected_selection(name)):
+                with open(self.published_path(level, name), "rb") as file:
+                    published = file.read()
+                with open(self.encoded_dir(name) + selected, "rb") as file:
+                    self.assertEqual(published, file.read(), level)
+
+
+class SizeIndexTest(SelectTest):
+    # The index read from the results database, and from the results files
+    # without it, has the sizes of the encoded files
+    def test_index(self):
+        recipe = self.recipe
+        index = rd_select.read_size_index("subset", "bench", recipe)
+        self.assertEqual(sorted(index), self.names)
+        for name in self.names:
+            self.assertEqual(index[name],
+                             rd_select.scan_sizes(self.encoded_dir(name)))
+
+        os.remove(rd_store.store_path("results/subset"))
+        self.assertEqual(
+            rd_select.read_size_index("subset", "bench", recipe), index)
+
+    def test_select(self):
+        self.select()
+        self.check_published(self.names)
+
+    # Sizes of files which are not there any more are read again from the
+    # encoded files
+    def test_stale_index(self):
+        name = self.names[0]
+        sizes = [(size * 2, "missing.rdb")
+                 for size, file_name in rd_select.scan_sizes(
+                     self.encoded_dir(name))]
+        rd_select.process_image(("bench", self.recipe, "subset",
+                                 "subset/" + name + ".png", sizes))
+        self.check_published([name])
+
+
+class ExportTest(SelectTest):
+    recipe = dict(SelectTest.recipe, export_to_png=True)
+    collect_options = ["--keep-decoded"]
+
+    # Returns the number of selected files which rd_collect.py did not keep
+    # decoded
+    def not_kept(self, names):
+        return sum(not os.path.isfile(
+            rd_select.decoded_path(self.encoded_dir(name) + selected, "y4m"))
+                   for name in names
+                   for selected in self.expected_selection(name))
+
+    def check_exported(self):
+        for name in self.names:
+            shape = rd_bench.read_png("subset/" + name + ".png").shape
+            for level in self.levels:
+                png = os.path.splitext(self.published_path(level, name))[0]
+                self.assertEqual(rd_bench.read_png(png + ".png").shape, shape)
+
+    def test_export(self):
+        self.select("-j", "2")
+        self.check_published(self.names)
+        self.check_exported()
+        counts = self.tool_counts()
+        # The decoded images kept by rd_collect.py are not decoded again
+        self.assertEqual(counts.get("rd_bench_dec", 0),
+                         self.not_kept(self.names))
+        self.assertEqual(counts["rd_bench_convert"],
+                         len(self.levels) * self.images)
+
+        # PNG files more recent than their published file are not exported
+        # again
+        self.select()
+        self.assertEqual(self.tool_calls("rd_bench_convert"), 0)
+
+        # Without the kept decoded images, the selected files are decoded
+        shutil.rmtree("BENCH_decoded")
+        name = self.names[0]
+        for level in self.levels:
+            os.remove(
+                os.path.splitext(self.published_path(level, name))[0] +
+                ".png")
+        self.select()
+        counts = self.tool_counts()
+        self.assertEqual(counts["rd_bench_dec"], len(self.levels))
+        self.assertEqual(counts["rd_bench_convert"], len(self.levels))
+        self.check_exported()
+
+
+class PublishTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = rd_select.publish_mode
+        self.workdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.workdir.name, "source.rdb")
+        self.target = os.path.join(self.workdir.name, "target.rdb")
+        self.write_source(b"first")
+
+    def tearDown(self):
+        rd_select.publish_mode = self.saved
+        self.workdir.cleanup()
+
+    def write_source(self, data):
+        with open(self.source, "wb") as file:
+            file.write(data)
+
+    def check_target(self, data):
+        with open(self.target, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(os.stat(self.target).st_mtime_ns,
+                         os.stat(self.source).st_mtime_ns)
+        # Without the temporary file
+        self.assertEqual(sorted(os.listdir(self.workdir.name)),
+                         ["source.rdb", "target.rdb"])
+
+    # Whether link makes a hardlink here, the filesystem not supporting
+    # reflinks
+    def hardlinks(self):
+        probe = os.path.join(self.workdir.name, "probe")
+        reflinked = rd_select.reflink(self.source, probe)
+        if reflinked:
+            os.remove(probe)
+        return not reflinked
+
+    def test_copy(self):
+        self.assertTrue(rd_select.publish(self.source, self.target))
+        self.check_target(b"first")
+        self.assertNotEqual(os.stat(self.target).st_ino,
+                            os.stat(self.source).st_ino)
+
+        # Left alone while the source does not change
+        inode = os.stat(self.target).st_ino
+        self.assertFalse(rd_select.publish(self.source, self.target))
+        self.assertEqual(os.stat(self.target).st_ino, inode)
+
+        self.write_source(b"second")
+        self.assertTrue(rd_select.publish(self.source, self.target))
+        self.check_target(b"second")
+
+    def test_link(self):
+        rd_select.publish_mode = "link"
+        hardlinks = self.hardlinks()
+        self.assertTrue(rd_select.publish(self.source, self.target))
+        self.check_target(b"first")
+        if hardlinks:
+            self.assertEqual(os.stat(self.target).st_ino,
+                             os.stat(self.source).st_ino)
+        self.assertFalse(rd_select.publish(self.source, self.target))
+
+        # A new source, as encoded again by rd_collect.py
+        os.remove(self.source)
+        self.write_source(b"second")
+        self.assertTrue(rd_select.publish(self.source, self.target))
+        self.check_target(b"second")
+
+    def test_directory(self):
+        directory = os.path.join(self.workdir.name, "published")
+        os.makedirs(directory)
+        self.assertTrue(rd_select.publish(self.source, directory))
+        with open(os.path.join(directory, "source.rdb"), "rb") as file:
+            self.assertEqual(file.read(), b"first")
+
+
+class PublishSelectionTest(SelectTest):
+    def test_link(self):
+        self.select("--publish", "link")
+        self.check_published(self.names)
+        for name in self.names:
+            published = self.published_path("large", name)
+            selected = self.encoded_dir(name) + self.expected_selection(
+                name)[1]
+            self.assertEqual(os.stat(published).st_mtime_ns,
+                             os.stat(selected).st_mtime_ns)
+
+        # Published files are left alone on the next run
+        inodes = [
+            os.stat(path).st_ino
+            for path in glob.glob("comparisonfiles/subset/*/*/*")
+        ]
+        self.select("--publish", "link")
+        self.assertEqual([
+            os.stat(path).st_ino
+            for path in glob.glob("comparisonfiles/subset/*/*/*")
+        ], inodes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_store
+import rd_collect
+from test_rd_average import make_rows
+
+# Tests of the results database of rd_store.py: running sums of the results,
+# and import of the results files of older versions of rd_collect.py
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+        self.random = np.random.default_rng(2)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def lossy_rows(self, image, qualities=(10.0, 50.0, 90.0)):
+        return make_rows(self.random, rd_store.lossy_columns,
+                         "img%d.png" % image, image, qualities)
+
+    def lossless_row(self, image):
+        return make_rows(self.random, rd_store.lossless_columns,
+                         "img%d.png" % image, image, [None])[0]
+
+    def select(self, conn, table):
+        order = {
+            "lossless": "format, file_name",
+            "lossy": "format, file_name, row_index",
+            "lossless_sums": "format",
+            "lossy_sums": "format, row_index"
+        }[table]
+        return conn.execute("SELECT * FROM " + table + " ORDER BY " +
+                            order).fetchall()
+
+
+class SumsTest(StoreTest):
+    # Returns the sums of every format computed again from the results
+    def recomputed(self, conn, table):
+        with conn:
+            conn.execute("DELETE FROM %s_sums" % table)
+            rd_store.update_sums(conn, table, "1", ())
+        return self.select(conn, table + "_sums")
+
+    def test_running_sums(self):
+        conn = rd_store.open_store(rd_store.store_path("results/subset"))
+        for image in range(3):
+            rd_store.write_lossless(conn, "fmt", self.lossless_row(image))
+            rd_store.write_lossy(conn, "fmt", self.lossy_rows(image))
+            rd_store.write_lossy(conn, "other", self.lossy_rows(image))
+        # Images done again replace their rows in the sums
+        rd_store.write_lossless(conn, "fmt", self.lossless_row(1))
+        rd_store.write_lossy(conn, "fmt", self.lossy_rows(1))
+        rd_store.write_lossy(conn, "fmt", self.lossy_rows(2, (20.0, 60.0,
+                                                              95.0)))
+
+        # Sums of floats replaced by subtracting the old rows are only close
+        # to the ones computed again, the counts and sizes are the same
+        for table in ("lossless", "lossy"):
+            sums = self.select(conn, table + "_sums")
+            recomputed = self.recomputed(conn, table)
+            self.assertEqual(len(sums), len(recomputed))
+            for row, expected in zip(sums, recomputed):
+                for value, expected_value in zip(row, expected):
+                    if isinstance(value, float):
+                        self.assertAlmostEqual(value / expected_value, 1,
+                                               places=12)
+                    else:
+                        self.assertEqual(value, expected_value)
+        sums = rd_store.read_sums(conn, "lossy", "fmt")
+        self.assertEqual(list(sums["row_index"]), [0, 1, 2])
+        self.assertEqual(list(sums["images"]), [3, 3, 3])
+        self.assertEqual(list(sums["quality"]), [40.0, 160.0, 275.0])
+        self.assertEqual(list(sums["quality_sq"]),
+                         [600.0, 8600.0, 25225.0])
+        conn.close()
+
+    # Sizes are summed as 64-bit integers
+    def test_large_sizes(self):
+        conn = rd_store.open_store(rd_store.store_path("results/subset"))
+        size = 2**31 + 1
+        for image in range(3):
+            rows = [(row[:2] + (size, size) + row[4:])
+                    for row in self.lossy_rows(image)]
+            rd_store.write_lossy(conn, "fmt", rows)
+        sums = rd_store.read_sums(conn, "lossy", "fmt")
+        self.assertEqual(sums["compressed_file_size"].dtype, np.int64)
+        self.assertEqual(list(sums["compressed_file_size"]), [3 * size] * 3)
+        conn.close()
+
+    # Databases written before a sum column existed get it, and their sums
+    # are computed again
+    def test_added_column(self):
+        path = rd_store.store_path("results/subset")
+        conn = rd_store.open_store(path)
+        for image in range(2):
+            rd_store.write_lossy(conn, "fmt", self.lossy_rows(image))
+        expected = self.select(conn, "lossy_sums")
+        conn.execute("ALTER TABLE lossy_sums DROP COLUMN quality_sq")
+        conn.execute("UPDATE lossy_sums SET images = 0")
+        conn.commit()
+        conn.close()
+
+        conn = rd_store.open_store(path)
+        names = [row[1] for row in conn.execute(
+            "PRAGMA table_info(lossy_sums)")]
+        self.assertEqual(names[-1], "quality_sq")
+        sums = rd_store.read_sums(conn, "lossy", "fmt")
+        self.assertEqual(list(sums["images"]), [2, 2, 2])
+        self.assertEqual(len(self.select(conn, "lossy_sums")), len(expected))
+        conn.close()
+
+
+class ImportTest(StoreTest):
+    def test_import(self):
+        lossless = [self.lossless_row(image) for image in range(3)]
+        lossy = [self.lossy_rows(image) for image in range(3)]
+        for row, rows in zip(lossless, lossy):
+            rd_collect.write_lossless_results("subset", "fmt", row[0], row)
+            rd_collect.write_lossy_results("subset", "fmt", row[0], rows)
+        # A results file of a version without the columns added since
+        path = rd_collect.lossy_result_path("subset", "old", "img0.png")
+        os.makedirs(os.path.dirname(path))
+        columns = [name for name, type in rd_store.lossy_columns[:14]]
+        pd.DataFrame([row[:14] for row in lossy[0]],
+                     columns=columns).to_csv(path, sep=":", index=False)
+
+        for run in range(2):
+            # Importing again replaces the rows, and their sums
+            self.assertEqual(rd_store.import_results("results/subset"), 7)
+            conn = rd_store.open_store(rd_store.store_path("results/subset"))
+            self.assertEqual(self.select(conn, "lossless"),
+                             [("fmt", ) + row for row in lossless])
+            expected = [("fmt", i) + row for rows in lossy
+                        for i, row in enumerate(rows)]
+            self.assertEqual(
+                [row for row in self.select(conn, "lossy")
+                 if row[0] == "fmt"], expected)
+            old = [row for row in self.select(conn, "lossy")
+                   if row[0] == "old"]
+            self.assertEqual([row[:16] for row in old],
+                             [("old", i) + row[:14]
+                              for i, row in enumerate(lossy[0])])
+            self.assertEqual(set(value for row in old for value in row[16:]),
+                             {None})
+
+            sums = rd_store.read_sums(conn, "lossy", "fmt")
+            self.assertEqual(list(sums["images"]), [3, 3, 3])
+            self.assertEqual(
+                list(sums["compressed_file_size"]),
+                [sum(rows[i][3] for rows in lossy) for i in range(3)])
+            sums = rd_store.read_sums(conn, "lossy", "old")
+            self.assertEqual(list(sums["n_encode_time_min"]), [0, 0, 0])
+            conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
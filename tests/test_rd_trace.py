@@ -0,0 +1,171 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import io
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rd_trace
+from test_rd_collect import SubsetTest
+
+# Tests of the spans of rd_trace.py, recorded in this process and by the
+# workers of rd_collect.py --trace on a subset run with the stand-in tools of
+# rd_bench.py
+
+
+class TraceState:
+    def setUp(self):
+        super().setUp()
+        self.saved_trace = (rd_trace.enabled, rd_trace.trace_dir,
+                            dict(rd_trace.tags))
+        del rd_trace.events[:]
+
+    def tearDown(self):
+        rd_trace.enabled, rd_trace.trace_dir, tags = self.saved_trace
+        rd_trace.set_tags(**tags)
+        del rd_trace.events[:]
+        super().tearDown()
+
+    def summary(self, path):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            rd_trace.main(["rd_trace.py", path])
+        return [line.split()[0] for line in output.getvalue().splitlines()]
+
+
+class SpanTest(TraceState, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.trace_dir = os.path.join(self.workdir.name, "trace.json.d")
+
+    def tearDown(self):
+        super().tearDown()
+        self.workdir.cleanup()
+
+    def test_disabled(self):
+        rd_trace.enabled = False
+        with rd_trace.span("encode"):
+            pass
+        self.assertEqual(rd_trace.events, [])
+
+    def test_spans(self):
+        rd_trace.enable(self.trace_dir)
+        rd_trace.set_tags(format="bench", image="img0.png", quality=None)
+        with rd_trace.span("encode", run=1):
+            with rd_trace.tagged(quality=10):
+                with rd_trace.span("decode"):
+                    pass
+        decode, encode = rd_trace.events
+        self.assertEqual(encode["name"], "encode")
+        self.assertEqual(encode["args"], {
+            "format": "bench",
+            "image": "img0.png",
+            "quality": None,
+            "run": 1
+        })
+        self.assertEqual(decode["args"]["quality"], 10)
+        self.assertEqual(encode["pid"], os.getpid())
+        self.assertLessEqual(encode["ts"], decode["ts"])
+        self.assertGreaterEqual(encode["dur"], decode["dur"])
+
+        rd_trace.flush()
+        self.assertEqual(rd_trace.events, [])
+        path = os.path.join(self.workdir.name, "trace.json")
+        with contextlib.redirect_stdout(io.StringIO()):
+            rd_trace.write_trace(path)
+        with open(path) as json_file:
+            self.assertEqual(
+                [event["name"] for event in json.load(json_file)[
+                    "traceEvents"]], ["encode", "decode"])
+        self.assertEqual(self.summary(path), ["stage", "encode", "decode"])
+
+    # The spans of the coroutines run at once are kept apart by their task,
+    # and tagged with the tags of their own task
+    def test_asyncio_tasks(self):
+        rd_trace.enable(self.trace_dir)
+
+        async def point(quality):
+            with rd_trace.tagged(quality=quality):
+                with rd_trace.span("decode"):
+                    await asyncio.sleep(0.01)
+
+        async def points():
+            await asyncio.gather(point(10), point(55))
+
+        asyncio.run(points())
+        self.assertEqual(
+            sorted(event["args"]["quality"] for event in rd_trace.events),
+            [10, 55])
+        self.assertEqual(len(set(event["tid"] for event in rd_trace.events)),
+                         2)
+
+
+class CollectTraceTest(TraceState, SubsetTest):
+    def check_trace(self, *options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.collect("--trace", "trace.json", *options)
+        with open("trace.json") as json_file:
+            events = json.load(json_file)["traceEvents"]
+        encodes = sorted((event["args"]["image"], str(event["args"][
+            "quality"])) for event in events if event["name"] == "encode")
+        self.assertEqual(encodes, [(image, quality)
+                                   for image in ("img0.png", "img1.png")
+                                   for quality in ("10", "55", "None")])
+        stages = set(event["name"] for event in events)
+        for stage in ("encode", "decode", "score_y_ssim", "score_vmaf",
+                      "write_results"):
+            self.assertIn(stage, stages)
+        # Encodes are run by the workers, and the results written by this
+        # process
+        pids = {
+            name: set(event["pid"] for event in events
+                      if event["name"] == name)
+            for name in ("encode", "write_results")
+        }
+        self.assertNotIn(os.getpid(), pids["encode"])
+        self.assertEqual(pids["write_results"], {os.getpid()})
+        self.assertEqual(set(self.summary("trace.json")[1:]), stages)
+
+    def test_trace(self):
+        self.check_trace()
+
+    def test_trace_pipeline(self):
+        self.check_trace("--pipeline", "2")
+
+
+if __name__ == "__main__":
+    unittest.main()